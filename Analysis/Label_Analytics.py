@@ -0,0 +1,406 @@
+import os
+import sys
+import json
+import sqlite3
+import hashlib
+import argparse
+from collections import Counter
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Shared_Utils'))
+from Comment_Store import is_store, scan_comments, MANIFEST_NAME
+
+# Bit i of a technique mask is TECHNIQUES[i]; the order must never change once a database is built
+TECHNIQUES = [
+    'Loaded_Language', 'Name_Calling,Labeling', 'Repetition', 'Exaggeration,Minimisation',
+    'Appeal_to_fear-prejudice', 'Flag-Waving', 'Causal_Oversimplification', 'Appeal_to_Authority',
+    'Slogans/Thought-terminating_Cliches', 'Whataboutism,Straw_Men', 'Black-and-White_Fallacy',
+    'Bandwagon,Reductio_ad_hitlerum', 'Doubt', 'Appeal_to_Time',
+]
+TECHNIQUE_BITS = {technique: 1 << bit for bit, technique in enumerate(TECHNIQUES)}
+
+# Groupings the aggregates are kept for; 'all' is the whole corpus
+DIMENSIONS = ['ChannelLeaning', 'Period', 'Source', 'VideoID', 'ThreadID']
+METADATA_COLUMNS = ['CommentID'] + DIMENSIONS
+
+DEFAULT_DB_NAME = 'label_analytics.sqlite'
+BATCH = 10000         # lines applied per transaction
+LOOKUP_BATCH = 500    # ids looked up per query (under SQLite's limit of bound parameters)
+TAIL_BYTES = 4096     # bytes before the saved offset kept as a fingerprint of the part of a file already read
+
+
+def techniques_to_mask(techniques: Iterable[str]) -> int:
+    return sum(TECHNIQUE_BITS[technique] for technique in set(techniques) if technique in TECHNIQUE_BITS)
+
+
+def mask_to_techniques(mask: int) -> List[str]:
+    return [technique for bit, technique in enumerate(TECHNIQUES) if mask >> bit & 1]
+
+
+def mask_bits(masks: np.ndarray) -> np.ndarray:
+    """(len(masks), 14) 0/1 matrix: column i tells whether technique i is in each mask"""
+    return (np.asarray(masks, dtype=np.int64)[:, None] >> np.arange(len(TECHNIQUES))) & 1
+
+
+def complete_lines(f, offset: int) -> Iterator[Tuple[bytes, int]]:
+    """(line, offset after it) for every complete line from offset; a line cut by a crash is left for later"""
+    f.seek(offset)
+    for line in f:
+        if not line.endswith(b'\n'):
+            break
+        offset += len(line)
+        yield line, offset
+
+
+def prefix_tail(f, offset: int) -> str:
+    """Fingerprint of the TAIL_BYTES bytes before offset: changes when the part already read is rewritten"""
+    start = max(0, offset - TAIL_BYTES)
+    f.seek(start)
+    return hashlib.sha256(f.read(offset - start)).hexdigest()
+
+
+def tail_at(path: str, offset: int) -> str:
+    with open(path, 'rb') as f:
+        return prefix_tail(f, offset)
+
+
+def prefix_unchanged(f, offset: int, size: int, tail: Optional[str]) -> bool:
+    """Whether the file still holds the bytes read up to offset (databases without a fingerprint only
+    check that offset follows a newline)"""
+    if size < offset:
+        return False
+    if offset == 0:
+        return True
+    if tail is None:
+        f.seek(offset - 1)
+        return f.read(1) == b'\n'
+    return prefix_tail(f, offset) == tail
+
+
+def jsonl_files(path: str, prefixes: Tuple[str, ...] = ()) -> List[str]:
+    if os.path.isfile(path):
+        return [path]
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if name.endswith('.jsonl') and (not prefixes or name.startswith(prefixes))]
+
+
+class LabelAnalytics:
+    """Rhetoric and stance labels joined with the scraper metadata, with aggregates kept up to date.
+
+    Every comment is one row of `comments` (its metadata and a 14-bit technique mask) and its stance
+    labels are rows of `stances`. For every grouping of DIMENSIONS, `mask_counts` keeps how many comments
+    have each technique mask and `stance_counts` how many have each label. Each batch of new labels or
+    metadata updates them by the difference between the batch's comments before and after, so a
+    rerun over the same files changes nothing and a new file costs only its own comments. Technique
+    frequencies and co-occurrences come from the mask histograms with numpy bit operations.
+    """
+
+    def __init__(self, db_path: str):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(f'''CREATE TABLE IF NOT EXISTS comments (
+                                  id TEXT PRIMARY KEY,
+                                  {', '.join(f"{dim} TEXT" for dim in DIMENSIONS)},
+                                  techniques INTEGER) WITHOUT ROWID''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS stances (
+                                 id TEXT NOT NULL,
+                                 topic TEXT NOT NULL,
+                                 label INTEGER NOT NULL,
+                                 PRIMARY KEY (id, topic)) WITHOUT ROWID''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS mask_counts (
+                                 dim TEXT NOT NULL,
+                                 value TEXT NOT NULL,
+                                 mask INTEGER NOT NULL,
+                                 count INTEGER NOT NULL,
+                                 PRIMARY KEY (dim, value, mask)) WITHOUT ROWID''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS stance_counts (
+                                 dim TEXT NOT NULL,
+                                 value TEXT NOT NULL,
+                                 topic TEXT NOT NULL,
+                                 label INTEGER NOT NULL,
+                                 count INTEGER NOT NULL,
+                                 PRIMARY KEY (dim, value, topic, label)) WITHOUT ROWID''')
+        # How far each input file has been read, its size/mtime then and a fingerprint of the bytes read
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS ingested_files (
+                                 path TEXT PRIMARY KEY,
+                                 offset INTEGER NOT NULL,
+                                 size INTEGER NOT NULL,
+                                 mtime REAL NOT NULL,
+                                 tail TEXT)''')
+        # Databases written before the fingerprint was kept
+        if 'tail' not in [row[1] for row in self.conn.execute('PRAGMA table_info(ingested_files)')]:
+            self.conn.execute('ALTER TABLE ingested_files ADD COLUMN tail TEXT')
+        self.stats = Counter()
+
+    # Incremental updates
+
+    def state(self, ids: List[str]) -> Tuple[List[Tuple], List[Tuple]]:
+        """comments and stances rows of ids"""
+        comment_rows, stance_rows = [], []
+        for start in range(0, len(ids), LOOKUP_BATCH):
+            chunk = ids[start:start + LOOKUP_BATCH]
+            placeholders = ','.join('?' * len(chunk))
+            comment_rows += self.conn.execute(f'SELECT * FROM comments WHERE id IN ({placeholders})', chunk).fetchall()
+            stance_rows += self.conn.execute(f'SELECT id, topic, label FROM stances WHERE id IN ({placeholders})',
+                                             chunk).fetchall()
+        return comment_rows, stance_rows
+
+    @staticmethod
+    def contributions(comment_rows: List[Tuple], stance_rows: List[Tuple], sign: int,
+                      masks: Counter, labels: Counter) -> None:
+        """Add what the rows count for in mask_counts and stance_counts (times sign) to masks and labels"""
+        dims = {}
+        for comment_id, *values, techniques in comment_rows:
+            dims[comment_id] = [('all', '')] + [(dim, value) for dim, value in zip(DIMENSIONS, values) if value is not None]
+            if techniques is not None:
+                for dim, value in dims[comment_id]:
+                    masks[dim, value, techniques] += sign
+        for comment_id, topic, label in stance_rows:
+            # Labels of comments without metadata yet only count for the whole corpus
+            for dim, value in dims.get(comment_id, [('all', '')]):
+                labels[dim, value, topic, label] += sign
+
+    def apply(self, metadata: List[Tuple], masks: List[Tuple], stances: List[Tuple],
+              progress: Optional[Tuple] = None) -> None:
+        """Write one batch of metadata (CommentID + DIMENSIONS), (CommentID, mask) and (CommentID, topic, label)
+        rows with the aggregates and the file progress, in one transaction"""
+        ids = list({row[0] for row in metadata} | {row[0] for row in masks} | {row[0] for row in stances})
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            mask_delta, label_delta = Counter(), Counter()
+            self.contributions(*self.state(ids), -1, mask_delta, label_delta)
+            if metadata:
+                updates = ', '.join(f"{dim} = excluded.{dim}" for dim in DIMENSIONS)
+                self.conn.executemany(f'''INSERT INTO comments (id, {', '.join(DIMENSIONS)})
+                                          VALUES ({','.join('?' * len(METADATA_COLUMNS))})
+                                          ON CONFLICT (id) DO UPDATE SET {updates}''', metadata)
+            if masks:
+                self.conn.executemany('''INSERT INTO comments (id, techniques) VALUES (?, ?)
+                                         ON CONFLICT (id) DO UPDATE SET techniques = excluded.techniques''', masks)
+            if stances:
+                self.conn.executemany('INSERT OR REPLACE INTO stances (id, topic, label) VALUES (?, ?, ?)', stances)
+            self.contributions(*self.state(ids), 1, mask_delta, label_delta)
+
+            mask_delta = [key + (count,) for key, count in mask_delta.items() if count != 0]
+            label_delta = [key + (count,) for key, count in label_delta.items() if count != 0]
+            self.conn.executemany('''INSERT INTO mask_counts (dim, value, mask, count) VALUES (?, ?, ?, ?)
+                                     ON CONFLICT (dim, value, mask) DO UPDATE SET count = count + excluded.count''',
+                                  mask_delta)
+            self.conn.executemany('''INSERT INTO stance_counts (dim, value, topic, label, count) VALUES (?, ?, ?, ?, ?)
+                                     ON CONFLICT (dim, value, topic, label) DO UPDATE SET count = count + excluded.count''',
+                                  label_delta)
+            if progress is not None:
+                self.conn.execute('INSERT OR REPLACE INTO ingested_files (path, offset, size, mtime, tail) '
+                                  'VALUES (?, ?, ?, ?, ?)', progress)
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.stats['batches'] += 1
+        self.stats['aggregate_rows_changed'] += len(mask_delta) + len(label_delta)
+
+    def rows_of(self, record: Dict, stance_topic: Optional[str]) -> Tuple[Optional[Tuple], Optional[Tuple], List[Tuple]]:
+        comment_id = record['CommentID']
+        metadata = None
+        if 'VideoID' in record:
+            metadata = tuple([comment_id] + [record.get(dim) for dim in DIMENSIONS])
+        mask = None
+        if isinstance(record.get('Techniques'), list):
+            unknown = [technique for technique in record['Techniques'] if technique not in TECHNIQUE_BITS]
+            self.stats['unknown_techniques'] += len(unknown)
+            mask = (comment_id, techniques_to_mask(record['Techniques']))
+        labels = dict(record.get('Stance_Labels') or {})
+        if record.get('Stance_Label') is not None:
+            labels[stance_topic or 'stance'] = record['Stance_Label']
+        # Labels left None by a failed request are not labels
+        stances = [(comment_id, topic, int(label)) for topic, label in labels.items() if label is not None]
+        return metadata, mask, stances
+
+    def ingest_file(self, path: str, append_only: bool, stance_topic: Optional[str] = None) -> int:
+        """Apply the lines of path not ingested yet: from the last offset for files that are mostly appended
+        to, from the start when a rewritten file changed. Returns the lines applied.
+
+        An appended file is still read from the start when the bytes before the last offset changed: the
+        scraper cuts a file back to its checkpoint and writes it again, and a full rerun of the rhetoric
+        script starts its output over.
+        """
+        size, mtime = os.path.getsize(path), os.path.getmtime(path)
+        row = self.conn.execute('SELECT offset, size, mtime, tail FROM ingested_files WHERE path = ?',
+                                (path,)).fetchone()
+        if row is not None and row[1] == size and row[2] == mtime:
+            return 0
+
+        applied = 0
+        with open(path, 'rb') as f:
+            offset = 0
+            if row is not None and append_only and prefix_unchanged(f, row[0], size, row[3]):
+                offset = row[0]
+            lines = complete_lines(f, offset)
+            while True:
+                batch = list(islice(lines, BATCH))
+                if not batch:
+                    break
+                metadata, masks, stances = [], [], []
+                for line, _ in batch:
+                    if not line.strip():
+                        continue
+                    record_metadata, mask, record_stances = self.rows_of(json.loads(line), stance_topic)
+                    if record_metadata is not None:
+                        metadata.append(record_metadata)
+                    if mask is not None:
+                        masks.append(mask)
+                    stances += record_stances
+                end = batch[-1][1]
+                self.apply(metadata, masks, stances, (path, end, size, mtime, tail_at(path, end)))
+                applied += len(batch)
+        if applied == 0:
+            self.conn.execute('INSERT OR REPLACE INTO ingested_files (path, offset, size, mtime, tail) '
+                              'VALUES (?, ?, ?, ?, ?)', (path, offset, size, mtime, tail_at(path, offset)))
+        return applied
+
+    def ingest_store(self, store_dir: str) -> int:
+        """Metadata of a comment store; read again only when the store was compacted since"""
+        manifest = os.path.join(store_dir, MANIFEST_NAME)
+        size, mtime = os.path.getsize(manifest), os.path.getmtime(manifest)
+        row = self.conn.execute('SELECT size, mtime FROM ingested_files WHERE path = ?', (manifest,)).fetchone()
+        if row is not None and tuple(row) == (size, mtime):
+            return 0
+        applied = 0
+        comments = scan_comments(store_dir, columns=METADATA_COLUMNS)
+        while True:
+            batch = list(islice(comments, BATCH))
+            if not batch:
+                break
+            self.apply([tuple(record[column] for column in METADATA_COLUMNS) for record in batch], [], [])
+            applied += len(batch)
+        self.conn.execute('INSERT OR REPLACE INTO ingested_files (path, offset, size, mtime) VALUES (?, ?, ?, ?)',
+                          (manifest, 0, size, mtime))
+        return applied
+
+    def update(self, metadata: Optional[List[str]] = None, rhetoric: Optional[List[str]] = None,
+               stance: Optional[List[str]] = None, stance_topic: Optional[str] = None) -> Counter:
+        """Bring the database up to date with the scraper metadata and label outputs given"""
+        counts = Counter()
+        for path in metadata or []:
+            if is_store(path):
+                counts['metadata'] += self.ingest_store(path)
+                continue
+            for file_path in jsonl_files(path, ('comments_', 'MAP_Precomments_')):
+                # The scraper appends (after cutting a file back to its checkpoint); Parent_Join.py rewrites its files
+                counts['metadata'] += self.ingest_file(file_path, os.path.basename(file_path).startswith('comments_'))
+        for path in rhetoric or []:
+            for file_path in jsonl_files(path):
+                # The rhetoric script appends to its output (resume: True), or starts it over
+                counts['rhetoric'] += self.ingest_file(file_path, append_only=True)
+        for path in stance or []:
+            for file_path in jsonl_files(path, ('Label_',)):
+                # Stance_Engine.py rewrites each Label_ file, metadata included
+                counts['stance'] += self.ingest_file(file_path, append_only=False, stance_topic=stance_topic)
+        return counts
+
+    # Queries: read the aggregates only
+
+    def mask_histogram(self, dim: str = 'all', value: Optional[str] = None) -> pd.DataFrame:
+        query, params = 'SELECT value, mask, count FROM mask_counts WHERE dim = ? AND count > 0', [dim]
+        if value is not None:
+            query, params = query + ' AND value = ?', params + [value]
+        return pd.DataFrame(self.conn.execute(query, params).fetchall(), columns=['value', 'mask', 'count'])
+
+    def technique_counts(self, dim: str = 'all') -> pd.DataFrame:
+        """Labelled comments, comments with any technique and comments with each technique, per value of dim"""
+        histogram = self.mask_histogram(dim)
+        counts = histogram['count'].to_numpy()
+        frame = pd.DataFrame(mask_bits(histogram['mask']) * counts[:, None], columns=TECHNIQUES)
+        frame.insert(0, 'any_technique', (histogram['mask'].to_numpy() != 0) * counts)
+        frame.insert(0, 'comments', counts)
+        frame.insert(0, dim, histogram['value'])
+        return frame.groupby(dim).sum()
+
+    def cooccurrence(self, dim: str = 'all', value: Optional[str] = None) -> pd.DataFrame:
+        """Comments with both techniques, for every pair (the diagonal is each technique's count), in the
+        whole corpus or in one group, e.g. dim='ChannelLeaning', value='left'"""
+        histogram = self.mask_histogram(dim, value)
+        bits = mask_bits(histogram['mask'])
+        pairs = bits.T @ (bits * histogram['count'].to_numpy()[:, None])
+        return pd.DataFrame(pairs, index=TECHNIQUES, columns=TECHNIQUES)
+
+    def stance_distribution(self, topic: str, dim: str = 'all') -> pd.DataFrame:
+        rows = self.conn.execute('SELECT value, label, count FROM stance_counts WHERE dim = ? AND topic = ? AND count > 0',
+                                 (dim, topic)).fetchall()
+        frame = pd.DataFrame(rows, columns=[dim, 'label', 'count'])
+        return frame.pivot_table(index=dim, columns='label', values='count', fill_value=0, aggfunc='sum')
+
+    def techniques_by_stance(self, topic: str) -> pd.DataFrame:
+        """Technique counts per stance label of topic, from the comments with both labels"""
+        rows = self.conn.execute('''SELECT s.label, c.techniques FROM stances s JOIN comments c ON c.id = s.id
+                                    WHERE s.topic = ? AND c.techniques IS NOT NULL''', (topic,)).fetchall()
+        if not rows:
+            return pd.DataFrame(columns=['comments'] + TECHNIQUES)
+        labels, masks = np.array(rows, dtype=np.int64).T
+        # One histogram of (label, mask) pairs, then the same bit operations as for the aggregates
+        histogram = np.bincount(labels * (1 << len(TECHNIQUES)) + masks)
+        keys = np.flatnonzero(histogram)
+        counts = histogram[keys]
+        frame = pd.DataFrame(mask_bits(keys & ((1 << len(TECHNIQUES)) - 1)) * counts[:, None], columns=TECHNIQUES)
+        frame.insert(0, 'comments', counts)
+        frame.insert(0, 'label', keys >> len(TECHNIQUES))
+        return frame.groupby('label').sum()
+
+    def topics(self) -> List[str]:
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT topic FROM stance_counts WHERE dim = 'all'")]
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Technique and stance aggregates, updated as new label files arrive")
+    parser.add_argument('--db', default=DEFAULT_DB_NAME, help="Analytics database (SQLite)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    update_parser = subparsers.add_parser('update', help="Add new or grown metadata and label files")
+    update_parser.add_argument('--metadata', nargs='+', default=None,
+                               help="Folders of comments_*.jsonl / MAP_Precomments_*.jsonl files, or comment stores")
+    update_parser.add_argument('--rhetoric', nargs='+', default=None, help="Output files (or folders) of Divisive_Rhetoric.py")
+    update_parser.add_argument('--stance', nargs='+', default=None, help="Output folders of the stance scripts (Label_*.jsonl)")
+    update_parser.add_argument('--stance-topic', default=None,
+                               help="Topic of the outputs of single-topic stance runs (Stance_Label), e.g. climate")
+
+    report_parser = subparsers.add_parser('report', help="Print (or save as CSV) the aggregates")
+    report_parser.add_argument('--by', default='ChannelLeaning', choices=['all'] + DIMENSIONS)
+    report_parser.add_argument('--csv', default=None, help="Folder to save the tables as CSV files")
+    args = parser.parse_args()
+
+    analytics = LabelAnalytics(args.db)
+    try:
+        if args.command == 'update':
+            counts = analytics.update(args.metadata, args.rhetoric, args.stance, args.stance_topic)
+            print(f"Lines applied: {counts['metadata']} metadata, {counts['rhetoric']} rhetoric, "
+                  f"{counts['stance']} stance ({analytics.stats['aggregate_rows_changed']} aggregate rows changed)")
+            if analytics.stats['unknown_techniques']:
+                print(f"{analytics.stats['unknown_techniques']} techniques not in the list of 14 were left out")
+            return
+
+        tables = {'techniques': analytics.technique_counts(args.by), 'cooccurrence': analytics.cooccurrence()}
+        for topic in analytics.topics():
+            tables[f'stance_{topic}'] = analytics.stance_distribution(topic, args.by)
+            tables[f'techniques_by_stance_{topic}'] = analytics.techniques_by_stance(topic)
+        for name, table in tables.items():
+            print(f"\n{name}:\n{table.to_string()}")
+            if args.csv:
+                os.makedirs(args.csv, exist_ok=True)
+                table.to_csv(os.path.join(args.csv, f"{name}_by_{args.by}.csv" if name != 'cooccurrence' else f"{name}.csv"))
+    finally:
+        analytics.close()
+
+
+if __name__ == '__main__':
+    main()
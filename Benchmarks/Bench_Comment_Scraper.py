@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import io
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scraping_Scripts'))
+from Comment_Scraper import crawl
+from Quota_Ledger import QuotaLedger
+from Fake_YouTube_API import FakeYouTubeServer, FakeYouTubeData
+
+
+def make_video_list(n_videos):
+    return pd.DataFrame({
+        'video_id': [f"vid{index:05d}" for index in range(n_videos)],
+        'period': ['2023'] * n_videos,
+        'channel_leaning': ['center'] * n_videos,
+        'Source': ['bench'] * n_videos
+    })
+
+
+def count_lines(output_path):
+    total = 0
+    for filename in os.listdir(output_path):
+        if filename.startswith('comments_') and filename.endswith('.jsonl'):
+            with open(os.path.join(output_path, filename), 'r', encoding='utf-8') as f:
+                for line in f:
+                    json.loads(line)  # every line must still be valid JSON
+                    total += 1
+    return total
+
+
+def run_mode(name, server, videos_df, video_workers, reply_workers):
+    with tempfile.TemporaryDirectory() as output_path:
+        ledger_path = os.path.join(output_path, 'quota_ledger.sqlite')
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            crawl(videos_df, output_path, 'FAKE_KEY', quota_limit=10 ** 9, video_workers=video_workers,
+                  reply_workers=reply_workers, api_endpoint=server.api_endpoint, ledger_path=ledger_path)
+        elapsed = time.perf_counter() - start
+
+        comments = count_lines(output_path)
+        with contextlib.redirect_stdout(io.StringIO()), QuotaLedger(ledger_path) as ledger:
+            quota_used = ledger.used_today()
+
+    print(f"{name:<12} workers={video_workers}/{reply_workers:<4} comments={comments:<7} "
+          f"quota={quota_used:<6} time={elapsed:7.2f}s  {comments / elapsed:9.1f} comments/sec")
+    return comments, quota_used
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--videos', type=int, default=8)
+    parser.add_argument('--threads-per-video', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds added to each fake API response")
+    parser.add_argument('--video-workers', type=int, default=4)
+    parser.add_argument('--reply-workers', type=int, default=16)
+    args = parser.parse_args()
+
+    videos_df = make_video_list(args.videos)
+    data = FakeYouTubeData(threads_per_video=args.threads_per_video)
+
+    with FakeYouTubeServer(data=data, latency=args.latency) as server:
+        serial = run_mode('serial', server, videos_df, 1, 1)
+        concurrent = run_mode('concurrent', server, videos_df, args.video_workers, args.reply_workers)
+
+    if serial != concurrent:
+        print(f"Mismatch between modes: serial={serial} concurrent={concurrent}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
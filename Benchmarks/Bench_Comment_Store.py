@@ -0,0 +1,130 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+from Bench_Near_Duplicates import make_vocabulary, sentence
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Shared_Utils'))
+from Comment_Store import compact, open_store, scan_comments
+
+SOURCES = ['BBC', 'Fox News', 'CNN', 'GB News']
+PERIODS = ['P1', 'P2', 'P3']
+LEANINGS = ['left', 'right']
+
+
+def make_comments(comments_dir, n_comments, n_videos, reply_share=0.35, seed=0):
+    """comments_{video_id}.jsonl files in the scraper's format, videos spread over Source/Period/ChannelLeaning"""
+    rng = random.Random(seed)
+    words = make_vocabulary(rng)
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    os.makedirs(comments_dir, exist_ok=True)
+    per_video = n_comments // n_videos
+    for v in range(n_videos):
+        video_id = f"vid{v:08d}"
+        metadata = {'Period': PERIODS[v % 3], 'ChannelLeaning': LEANINGS[v % 2], 'Source': SOURCES[v % 4]}
+        with open(os.path.join(comments_dir, f"comments_{video_id}.jsonl"), 'w', encoding='utf-8') as f:
+            parent_id, thread = None, 0
+            for written in range(per_video):
+                if parent_id is None or rng.random() >= reply_share:
+                    thread += 1
+                    comment_id = parent_id = f"Ugz{v:06d}t{thread:07d}"
+                    is_reply, parent = 'False', ''
+                else:
+                    comment_id = f"{parent_id}.r{written:07d}"
+                    is_reply, parent = 'True', parent_id
+                timestamp = start + timedelta(seconds=rng.randrange(2 * 365 * 86400))
+                f.write(json.dumps({
+                    'CommentID': comment_id, 'ThreadID': parent_id, 'VideoID': video_id, 'ParentCommentID': parent,
+                    'CommentText': sentence(rng, words, weights, 3, 60), 'AuthorName': f"@user{rng.randint(0, 10 ** 6)}",
+                    'NumberOfLikes': int(rng.paretovariate(1.2)) - 1, 'IsReply': is_reply,
+                    'Timestamp': timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'), **metadata}) + '\n')
+
+
+def jsonl_scan(comments_dir, columns=None, keep=None):
+    """What the scripts do today: parse every line of every file, then keep what they need"""
+    rows = 0
+    for filename in sorted(os.listdir(comments_dir)):
+        with open(os.path.join(comments_dir, filename), 'r', encoding='utf-8') as f:
+            for line in f:
+                comment = json.loads(line)
+                if keep is not None and not keep(comment):
+                    continue
+                if columns is not None:
+                    comment = {column: comment[column] for column in columns}
+                rows += 1
+    return rows
+
+
+def store_scan(store_dir, columns=None, where=None):
+    return sum(1 for _ in scan_comments(store_dir, columns=columns, where=where))
+
+
+def arrow_scan(store_dir, columns=None):
+    """Column batches only, for code that works on Arrow/pandas directly instead of one dict per comment"""
+    return open_store(store_dir).to_table(columns=columns).num_rows
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, default=1000000)
+    parser.add_argument('--videos', type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        comments_dir, store_dir = os.path.join(tmp, 'comments'), os.path.join(tmp, 'store')
+        make_comments(comments_dir, args.comments, args.videos)
+        stats, compaction = timed(compact, comments_dir, store_dir)
+        jsonl_mb, store_mb = folder_size(comments_dir) / 2 ** 20, folder_size(store_dir) / 2 ** 20
+        print(f"{stats['rows']} comments in {args.videos} videos, {stats['partitions']} partitions")
+        print(f"Size: JSONL {jsonl_mb:.0f} MB, store {store_mb:.0f} MB ({jsonl_mb / store_mb:.1f}x smaller); "
+              f"compaction {compaction:.1f}s ({stats['rows'] / compaction:.0f} comments/sec)")
+
+        # 1% new comments in one video: only its partition is written again
+        with open(os.path.join(comments_dir, 'comments_vid00000000.jsonl'), 'r', encoding='utf-8') as f:
+            first = json.loads(f.readline())
+        with open(os.path.join(comments_dir, 'comments_vid00000000.jsonl'), 'a', encoding='utf-8') as f:
+            for index in range(args.comments // 100):
+                f.write(json.dumps(dict(first, CommentID=f"new{index}")) + '\n')
+        stats, recompaction = timed(compact, comments_dir, store_dir)
+        print(f"Compaction after 1% new comments in one video: {recompaction:.1f}s "
+              f"({stats['partitions_written']} partition written)")
+
+        rhetoric = ['CommentID', 'CommentText']
+        in_p1_left = ['Period=P1', 'ChannelLeaning=left']
+        scans = [
+            ('every field', lambda: jsonl_scan(comments_dir), lambda: store_scan(store_dir)),
+            ('CommentID, CommentText', lambda: jsonl_scan(comments_dir, rhetoric),
+             lambda: store_scan(store_dir, rhetoric)),
+            ('same, Period=P1 & left', lambda: jsonl_scan(comments_dir, rhetoric, lambda comment: comment['Period'] == 'P1' and comment['ChannelLeaning'] == 'left'),
+             lambda: store_scan(store_dir, rhetoric, in_p1_left)),
+            ('same, NumberOfLikes>=10', lambda: jsonl_scan(comments_dir, rhetoric, lambda comment: comment['NumberOfLikes'] >= 10),
+             lambda: store_scan(store_dir, rhetoric, ['NumberOfLikes>=10'])),
+        ]
+        print(f"\n{'scan (dict per comment)':<26} {'rows':>9} {'JSONL s':>8} {'store s':>8} {'speed-up':>9}")
+        for name, jsonl, store in scans:
+            (jsonl_rows, jsonl_seconds), (store_rows, store_seconds) = timed(jsonl), timed(store)
+            assert jsonl_rows == store_rows, (name, jsonl_rows, store_rows)
+            print(f"{name:<26} {store_rows:>9} {jsonl_seconds:>8.2f} {store_seconds:>8.2f} "
+                  f"{jsonl_seconds / store_seconds:>8.1f}x")
+        rows, seconds = timed(arrow_scan, store_dir, rhetoric)
+        print(f"{'CommentID, CommentText':<26} {rows:>9} {'':>8} {seconds:>8.2f}   as Arrow columns, no dicts")
+
+
+if __name__ == '__main__':
+    main()
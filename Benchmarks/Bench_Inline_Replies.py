@@ -0,0 +1,77 @@
+import os
+import sys
+import io
+import json
+import argparse
+import tempfile
+import contextlib
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scraping_Scripts'))
+import Comment_Scraper
+from Quota_Ledger import QuotaLedger
+from Fake_YouTube_API import (FakeYouTubeServer, FakeYouTubeData, RecordingYouTubeData, ReplayYouTubeData,
+                              UpstreamYouTubeData)
+from Bench_Comment_Scraper import make_video_list, count_lines
+
+
+def run_crawl(data, videos_df, use_inline):
+    """Crawl videos_df from data; returns comments written, requests per endpoint and quota units spent"""
+    with FakeYouTubeServer(data=data, latency=0) as server, tempfile.TemporaryDirectory() as output_path:
+        ledger_path = os.path.join(output_path, 'quota_ledger.sqlite')
+        with contextlib.redirect_stdout(io.StringIO()):
+            Comment_Scraper.crawl(videos_df, output_path, 'FAKE_KEY', quota_limit=10 ** 9,
+                                  api_endpoint=server.api_endpoint, ledger_path=ledger_path, use_inline=use_inline)
+        comments = count_lines(output_path)
+        with contextlib.redirect_stdout(io.StringIO()), QuotaLedger(ledger_path) as ledger:
+            units = ledger.used_today()
+        requests = dict(server.request_counts)
+    return comments, requests, units, Comment_Scraper.crawl_stats['inline_reply_threads']
+
+
+def record(data, videos_df, fixture_path):
+    # Both variants are recorded, so the baseline without inline replies can be replayed too
+    recorder = RecordingYouTubeData(data)
+    run_crawl(recorder, videos_df, use_inline=False)
+    run_crawl(recorder, videos_df, use_inline=True)
+    recorder.save(fixture_path)
+    print(f"Recorded {len(recorder.fixtures)} responses to {fixture_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixtures', default=None, help="Recorded responses (.json.gz) to replay")
+    parser.add_argument('--video-list', default=None, help="CSV of the videos in the fixtures (or to record)")
+    parser.add_argument('--record-api-key', default=None, help="Record --fixtures from the real API with this key")
+    parser.add_argument('--videos', type=int, default=5, help="Synthetic videos when no fixtures are given")
+    args = parser.parse_args()
+
+    videos_df = pd.read_csv(args.video_list) if args.video_list else make_video_list(args.videos)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fixture_path = args.fixtures
+        if args.record_api_key:
+            record(UpstreamYouTubeData(args.record_api_key), videos_df, fixture_path)
+        elif fixture_path is None:
+            fixture_path = os.path.join(tmp, 'sample_crawl.json.gz')
+            record(FakeYouTubeData(threads_per_video=400), videos_df, fixture_path)
+
+        replay = ReplayYouTubeData(fixture_path)
+        results = {}
+        for name, use_inline in [('comments.list for every thread', False), ('inline replies', True)]:
+            comments, requests, units, inline_threads = run_crawl(replay, videos_df, use_inline)
+            results[name] = (comments, sum(requests.values()), units)
+            print(f"{name:<32} comments={comments:<7} requests={json.dumps(requests)} quota={units} "
+                  f"inline_threads={inline_threads}")
+
+    (base_comments, base_requests, base_units), (comments, requests, units) = results.values()
+    print(f"Saved {base_requests - requests} requests ({100 * (base_requests - requests) / base_requests:.1f}%) "
+          f"and {base_units - units} quota units for the same {comments} comments")
+    if comments != base_comments:
+        print(f"Mismatch: {base_comments} comments without inline replies, {comments} with")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from collections import Counter
+from itertools import combinations
+
+import pandas as pd
+
+from Bench_Comment_Store import make_comments
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Analysis'))
+from Label_Analytics import LabelAnalytics, TECHNIQUES
+
+
+def make_labels(comments_dir, rhetoric_path, stance_dir, share_labelled=0.98, seed=0):
+    """Rhetoric output for share_labelled of the comments (the rest is left for later), and Label_ files
+    with both stance topics; returns the comments left out"""
+    rng = random.Random(seed)
+    later = []
+    os.makedirs(stance_dir, exist_ok=True)
+    with open(rhetoric_path, 'w', encoding='utf-8') as rhetoric:
+        for filename in sorted(os.listdir(comments_dir)):
+            video_id = filename[len('comments_'):-len('.jsonl')]
+            with open(os.path.join(comments_dir, filename), encoding='utf-8') as f, \
+                    open(os.path.join(stance_dir, f"Label_{video_id}.jsonl"), 'w', encoding='utf-8') as stance:
+                for line in f:
+                    comment = json.loads(line)
+                    techniques = rng.sample(TECHNIQUES, rng.choice([0, 0, 0, 1, 1, 2, 3]))
+                    result = {'CommentID': comment['CommentID'], 'CommentText': comment['CommentText'],
+                              'Techniques': techniques}
+                    if rng.random() < share_labelled:
+                        rhetoric.write(json.dumps(result) + '\n')
+                    else:
+                        later.append(result)
+                    comment['Stance_Labels'] = {'climate': rng.choice([0, 1, 2]), 'immigration': rng.choice([0, 1, 2])}
+                    stance.write(json.dumps(comment) + '\n')
+    return later
+
+
+def fresh_pandas_pass(comments_dir, rhetoric_path, stance_dir):
+    """Today's way: read every file, join, explode the Techniques lists and group, then count pairs in Python"""
+    metadata = pd.concat([pd.read_json(os.path.join(comments_dir, name), lines=True, dtype=False)
+                          for name in sorted(os.listdir(comments_dir))], ignore_index=True)
+    rhetoric = pd.read_json(rhetoric_path, lines=True, dtype=False)
+    stance = pd.concat([pd.read_json(os.path.join(stance_dir, name), lines=True, dtype=False)
+                        for name in sorted(os.listdir(stance_dir))], ignore_index=True)
+    joined = rhetoric.merge(metadata[['CommentID', 'ChannelLeaning', 'Period', 'VideoID']], on='CommentID')
+    exploded = joined.explode('Techniques').dropna(subset=['Techniques'])
+    by_leaning = exploded.groupby(['ChannelLeaning', 'Techniques']).size().unstack(fill_value=0)
+    exploded.groupby(['Period', 'Techniques']).size().unstack(fill_value=0)
+    exploded.groupby(['VideoID', 'Techniques']).size().unstack(fill_value=0)
+    stance['climate'] = stance['Stance_Labels'].map(lambda labels: labels.get('climate'))
+    stance.groupby(['ChannelLeaning', 'climate']).size().unstack(fill_value=0)
+    pairs = Counter()
+    for techniques in joined['Techniques']:
+        pairs.update(combinations(sorted(techniques), 2))
+    return by_leaning, pairs
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, default=500000)
+    parser.add_argument('--videos', type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        comments_dir, stance_dir = os.path.join(tmp, 'comments'), os.path.join(tmp, 'stance')
+        rhetoric_path = os.path.join(tmp, 'rhetoric.jsonl')
+        make_comments(comments_dir, args.comments, args.videos)
+        later = make_labels(comments_dir, rhetoric_path, stance_dir)
+
+        _, fresh = timed(fresh_pandas_pass, comments_dir, rhetoric_path, stance_dir)
+        print(f"Fresh pandas pass over every file (today, on every question): {fresh:.1f}s")
+
+        analytics = LabelAnalytics(os.path.join(tmp, 'analytics.sqlite'))
+        counts, first = timed(analytics.update, [comments_dir], [rhetoric_path], [stance_dir])
+        print(f"First update of the analytics database: {first:.1f}s "
+              f"({sum(counts.values())} lines: {counts['metadata']} metadata, {counts['rhetoric']} rhetoric, "
+              f"{counts['stance']} stance)")
+
+        # New labels arrive: the rest of the rhetoric output, and one stance file written again
+        with open(rhetoric_path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(result) + '\n' for result in later))
+        stance_file = os.path.join(stance_dir, sorted(os.listdir(stance_dir))[0])
+        os.utime(stance_file)
+        counts, incremental = timed(analytics.update, [comments_dir], [rhetoric_path], [stance_dir])
+        print(f"Update after {len(later)} new rhetoric labels and one rewritten stance file: {incremental:.2f}s "
+              f"({counts['rhetoric']} rhetoric, {counts['stance']} stance lines)")
+        _, unchanged = timed(analytics.update, [comments_dir], [rhetoric_path], [stance_dir])
+        print(f"Update with nothing new: {unchanged:.2f}s")
+
+        def queries():
+            analytics.technique_counts('ChannelLeaning')
+            analytics.technique_counts('Period')
+            analytics.technique_counts('VideoID')
+            analytics.stance_distribution('climate', 'ChannelLeaning')
+            return analytics.cooccurrence()
+        cooccurrence, query = timed(queries)
+        print(f"Same tables from the materialised aggregates: {query:.2f}s")
+
+        by_leaning, pairs = fresh_pandas_pass(comments_dir, rhetoric_path, stance_dir)
+        same = all(cooccurrence.loc[a, b] == count for (a, b), count in pairs.items())
+        same_counts = (analytics.technique_counts('ChannelLeaning')[by_leaning.columns] == by_leaning).all().all()
+        _, bits = timed(analytics.techniques_by_stance, 'climate')
+        print(f"Technique counts per climate stance, bitmask histogram over the comments table: {bits:.2f}s")
+        print(f"Aggregates equal to a fresh pandas pass: co-occurrence {same}, counts by ChannelLeaning {same_counts}")
+
+        # Files written again over what was read: a full rerun starts the rhetoric output over (new labels,
+        # other order, longer lines), and the scraper cuts a comments file back to its checkpoint and writes
+        # the rest again (here with another ChannelLeaning)
+        rng = random.Random(1)
+        results = [json.loads(line) for line in open(rhetoric_path, encoding='utf-8')]
+        rng.shuffle(results)
+        with open(rhetoric_path, 'w', encoding='utf-8') as f:
+            for result in results:
+                result.update(Techniques=rng.sample(TECHNIQUES, rng.choice([0, 1, 2])), Rerun=True)
+                f.write(json.dumps(result) + '\n')
+        comments_file = os.path.join(comments_dir, sorted(os.listdir(comments_dir))[0])
+        lines = open(comments_file, encoding='utf-8').readlines()
+        checkpoint = len(lines) // 2
+        with open(comments_file, 'w', encoding='utf-8') as f:
+            f.writelines(lines[:checkpoint])
+            for line in lines[checkpoint:]:
+                f.write(json.dumps(dict(json.loads(line), ChannelLeaning='rewritten')) + '\n')
+        counts = analytics.update([comments_dir], [rhetoric_path], [stance_dir])
+        by_leaning, pairs = fresh_pandas_pass(comments_dir, rhetoric_path, stance_dir)
+        cooccurrence = analytics.cooccurrence()
+        same = all(cooccurrence.loc[a, b] == count for (a, b), count in pairs.items())
+        same_counts = (analytics.technique_counts('ChannelLeaning')[by_leaning.columns] == by_leaning).all().all()
+        print(f"After rewriting the rhetoric output and cutting back a comments file ({counts['rhetoric']} rhetoric, "
+              f"{counts['metadata']} metadata lines read again): co-occurrence {same}, counts by ChannelLeaning {same_counts}")
+        analytics.close()
+        if not (same and same_counts):
+            print("FAILED: the aggregates do not match the rewritten files")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
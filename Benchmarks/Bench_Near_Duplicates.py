@@ -0,0 +1,185 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+
+from Fake_OpenAI_API import FakeOpenAIServer, FakeChatData
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCH_DIR, '..', 'Shared_Utils'))
+sys.path.append(os.path.join(BENCH_DIR, '..', 'Stance_Detection'))
+from Near_Duplicates import reduce_comments, expand_labels, ClusterMap
+from Stance_Engine import StanceEngine
+
+
+def make_vocabulary(rng, size=5000):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(2, 9))) for _ in range(size)]
+
+
+def sentence(rng, words, weights, low, high):
+    return ' '.join(rng.choices(words, weights, k=rng.randint(low, high)))
+
+
+EMOJI = ['🔥', '😂', '👏', '💯', '🙏', '🇺🇸']
+SHORT_TEXTS = ['!!!', '???', '...', '😂😂😂', '🔥', '👏👏', '💯💯💯', '🙏', '@user1 🔥🔥', '+1', 'lol', 'yes!', 'ok']
+
+
+def spam_variant(template, rng):
+    """The tiny variations copy-paste comments come with: case, punctuation, emoji, a @name"""
+    text = template
+    if rng.random() < 0.4:
+        text = text.lower()
+    if rng.random() < 0.3:
+        text = text.upper()
+    text = text.replace(',', rng.choice([',', '', ' -', '...']))
+    text += rng.choice(['', '!', '!!!', '.', ' ?!'])
+    if rng.random() < 0.5:
+        text += ' ' + ''.join(rng.choice(EMOJI) for _ in range(rng.randint(1, 4)))
+    if rng.random() < 0.3:
+        text = f"@user{rng.randint(0, 9999)} " + text
+    return text
+
+
+def make_corpus(input_dir, n_comments, n_files, spam_share, n_templates, seed=0, short_share=0.03):
+    """MAP_Precomments files where spam_share of the comments are variants of n_templates spam texts, and
+    short_share are emoji, punctuation or a word only (they say too little to share a label).
+
+    Returns the ground-truth group of every comment: the spam text it comes from, or its own id.
+    """
+    rng = random.Random(seed)
+    words = make_vocabulary(rng)
+    weights = [1 / rank for rank in range(1, len(words) + 1)]  # Zipf-like word frequencies
+    templates = [sentence(rng, words, weights, 8, 20).capitalize() + ', ' + sentence(rng, words, weights, 4, 10)
+                 for _ in range(n_templates)]
+    groups = {}
+    os.makedirs(input_dir, exist_ok=True)
+    files = [open(os.path.join(input_dir, f"MAP_Precomments_vid{index:04d}.jsonl"), 'w', encoding='utf-8')
+             for index in range(n_files)]
+    try:
+        for number in range(n_comments):
+            comment_id = f"c{number:08d}"
+            draw = rng.random()
+            if draw < short_share:
+                text, groups[comment_id] = rng.choice(SHORT_TEXTS), comment_id
+            elif draw < short_share + spam_share:
+                template = rng.randrange(n_templates)
+                text, groups[comment_id] = spam_variant(templates[template], rng), f"spam{template}"
+            else:
+                text = sentence(rng, words, weights, 3, 30)
+                groups[comment_id] = comment_id
+            index = rng.randrange(n_files)
+            files[index].write(json.dumps({'CommentID': comment_id, 'VideoID': f"vid{index:04d}",
+                                           'CommentText': text,
+                                           'ParentCommentText': f"Title of video {index}"}) + '\n')
+    finally:
+        for f in files:
+            f.close()
+    return groups
+
+
+def cluster_quality(map_path, groups):
+    """(comments put with a representative of another group, clusters per group beyond the first)"""
+    cluster_map = ClusterMap(map_path)
+    members = cluster_map.conn.execute('SELECT id, representative FROM members').fetchall()
+    cluster_map.close()
+    wrong = sum(groups[comment_id] != groups[representative] for comment_id, representative in members)
+    clusters = {representative for _, representative in members}
+    return wrong, len(clusters) - len(set(groups.values()))
+
+
+def short_grouped(map_path, short_ids):
+    """Emoji, punctuation or one-word comments put in a cluster with another comment"""
+    cluster_map = ClusterMap(map_path)
+    members = cluster_map.conn.execute('SELECT id, representative FROM members').fetchall()
+    cluster_map.close()
+    return sum((comment_id in short_ids or representative in short_ids) and comment_id != representative
+               for comment_id, representative in members)
+
+
+def comment_texts(input_dir):
+    for name in sorted(os.listdir(input_dir)):
+        with open(os.path.join(input_dir, name), encoding='utf-8') as f:
+            for line in f:
+                comment = json.loads(line)
+                yield comment['CommentID'], comment['CommentText']
+
+
+def label(server, input_dir, output_dir, cache_path, workers):
+    """Stance labels of input_dir; returns the requests it took (exact duplicates are already served by the cache)"""
+    before = sum(server.request_counts.values())
+    engine = StanceEngine(['climate'], workers=workers, cache_path=cache_path)
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        engine.process_dir(input_dir, output_dir)
+        engine.close()
+    return sum(server.request_counts.values()) - before
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, default=100000, help="Comments indexed for the throughput numbers")
+    parser.add_argument('--labelled-comments', type=int, default=5000,
+                        help="Comments labelled through the mock API, with and without the reduce step")
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--spam-share', type=float, default=0.6)
+    parser.add_argument('--templates', type=int, default=40)
+    parser.add_argument('--threshold', type=float, default=0.8)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--workers', type=int, default=32)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        input_dir = os.path.join(tmp, 'input')
+        groups = make_corpus(input_dir, args.comments, args.files, args.spam_share, args.templates)
+        short_ids = {comment_id for comment_id, text in comment_texts(input_dir) if text in SHORT_TEXTS}
+        exact = len({json.loads(line)['CommentText'] for name in os.listdir(input_dir)
+                     for line in open(os.path.join(input_dir, name), encoding='utf-8')})
+        print(f"{args.comments} comments ({100 * args.spam_share:.0f}% variants of {args.templates} spam texts), "
+              f"{exact} distinct texts, {len(set(groups.values()))} true groups")
+        print(f"{'mode':<14} {'seconds':>8} {'comments/sec':>13} {'clusters':>9} {'calls saved':>12} "
+              f"{'wrong merges':>13} {'split groups':>13} {'short grouped':>14}")
+        failed = False
+        for with_parent in (False, True):
+            map_path = os.path.join(tmp, f"clusters_{with_parent}.sqlite")
+            start = time.perf_counter()
+            stats = reduce_comments(input_dir, os.path.join(tmp, f"reduced_{with_parent}"), map_path,
+                                    args.threshold, with_parent)
+            elapsed = time.perf_counter() - start
+            wrong, split = cluster_quality(map_path, groups)
+            grouped = short_grouped(map_path, short_ids)
+            failed = failed or grouped > 0
+            saved = 1 - stats['representatives'] / stats['comments']
+            print(f"{'per parent' if with_parent else 'global':<14} {elapsed:>8.1f} {stats['comments'] / elapsed:>13.0f} "
+                  f"{stats['representatives']:>9} {100 * saved:>11.1f}% {wrong:>13} {split:>13} {grouped:>14}")
+        if failed:
+            print(f"FAILED: some of the {len(short_ids)} emoji, punctuation or one-word comments were grouped")
+            sys.exit(1)
+
+    # End to end on a smaller corpus: requests to the mock API with the response cache alone, then with reduce first
+    with FakeOpenAIServer(data=FakeChatData(), latency=args.latency) as server, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+        os.environ.setdefault('ADD_API_KEY', 'fake-key')
+        input_dir = os.path.join(tmp, 'input')
+        make_corpus(input_dir, args.labelled_comments, args.files, args.spam_share, args.templates)
+
+        full = label(server, input_dir, os.path.join(tmp, 'full'), os.path.join(tmp, 'full.sqlite'), args.workers)
+        map_path = os.path.join(tmp, 'clusters.sqlite')
+        with contextlib.redirect_stdout(io.StringIO()):
+            reduce_comments(input_dir, os.path.join(tmp, 'reduced'), map_path, args.threshold, with_parent=True)
+        reduced = label(server, os.path.join(tmp, 'reduced'), os.path.join(tmp, 'labelled'),
+                        os.path.join(tmp, 'reduced.sqlite'), args.workers)
+        stats = expand_labels(os.path.join(tmp, 'labelled'), input_dir, os.path.join(tmp, 'expanded'), map_path)
+        print(f"\nStance labelling of {args.labelled_comments} comments (per-parent clusters): {full} requests with the "
+              f"response cache alone, {reduced} with reduce first ({100 * (1 - reduced / full):.1f}% fewer); "
+              f"{stats['comments'] - stats['unlabelled']} comments labelled, {stats['propagated']} of them "
+              f"by their representative")
+
+
+if __name__ == '__main__':
+    main()
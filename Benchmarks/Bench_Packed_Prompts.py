@@ -0,0 +1,61 @@
+import os
+import json
+import random
+import argparse
+import tempfile
+
+from Fake_OpenAI_API import FakeOpenAIServer, FakeChatData
+from Bench_Rhetoric_Inference import run
+
+WORDS = ('the they border people country climate money government really never always vote left right news '
+         'fake lies truth jobs taxes kids future crisis invasion welcome refugees science hoax planet summer '
+         'lol facts exactly agree disagree shame proud freedom media experts nobody everyone wake up').split()
+
+
+def make_corpus(path, n_comments, seed=0):
+    """Fixture corpus with the length mix of YouTube comments: mostly short, some paragraphs"""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for index in range(n_comments):
+            length = rng.choice([rng.randint(1, 6)] * 5 + [rng.randint(7, 30)] * 4 + [rng.randint(31, 120)])
+            text = ' '.join(rng.choice(WORDS) for _ in range(length))
+            f.write(json.dumps({'CommentID': f"c{index:07d}", 'CommentText': text.capitalize()}) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, default=1000)
+    parser.add_argument('--corpus', default=None, help="JSONL comments file to use instead of the synthetic corpus")
+    parser.add_argument('--pack-sizes', type=int, nargs='+', default=[1, 5, 10, 20])
+    parser.add_argument('--drop-rate', type=float, default=0.03,
+                        help="Share of packed comments the mock model leaves unanswered")
+    args = parser.parse_args()
+
+    os.environ.setdefault('OPENAI_API_KEY', 'fake-key')
+    os.environ.setdefault('OPENAI_ORGANIZATION', 'fake-org')
+
+    with FakeOpenAIServer(data=FakeChatData(drop_rate=args.drop_rate), latency=0.01) as server, \
+            tempfile.TemporaryDirectory() as tmp:
+        input_path = args.corpus or os.path.join(tmp, 'corpus.jsonl')
+        if not args.corpus:
+            make_corpus(input_path, args.comments)
+
+        baseline = None
+        print(f"{'pack size':>9} {'requests/1k':>12} {'prompt tokens/1k':>17} {'completion tokens/1k':>21} "
+              f"{'labels as unpacked':>19}")
+        for pack_size in args.pack_sizes:
+            before = (sum(server.request_counts.values()), server.prompt_tokens, server.completion_tokens)
+            results, _ = run(server, input_path, os.path.join(tmp, f'out_{pack_size}.jsonl'), 16,
+                             pack_size=pack_size)
+            requests = sum(server.request_counts.values()) - before[0]
+            prompt_tokens = server.prompt_tokens - before[1]
+            completion_tokens = server.completion_tokens - before[2]
+            per_1k = 1000 / len(results)
+            baseline = baseline or results
+            same = sum(result == reference for result, reference in zip(results, baseline)) / len(baseline)
+            print(f"{pack_size:>9} {requests * per_1k:>12.0f} {prompt_tokens * per_1k:>17.0f} "
+                  f"{completion_tokens * per_1k:>21.0f} {100 * same:>18.1f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+
+SCRAPING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scraping_Scripts')
+
+
+def make_comments(comments_dir, n_comments, n_videos, reply_share=0.35, seed=0):
+    """comments_{video_id}.jsonl files in the scraper's format; replies follow their top-level comment"""
+    rng = random.Random(seed)
+    os.makedirs(comments_dir, exist_ok=True)
+    per_video = n_comments // n_videos
+    for v in range(n_videos):
+        video_id = f"vid{v:08d}"
+        with open(os.path.join(comments_dir, f"comments_{video_id}.jsonl"), 'w', encoding='utf-8') as f:
+            written, parent_id, thread = 0, None, 0
+            while written < per_video:
+                if parent_id is None or rng.random() >= reply_share:
+                    thread += 1
+                    comment_id = parent_id = f"Ug{v:06d}t{thread:07d}"
+                    is_reply, parent = 'False', ''
+                else:
+                    comment_id = f"{parent_id}.r{written:07d}"
+                    is_reply, parent = 'True', parent_id
+                f.write(json.dumps({
+                    'CommentID': comment_id, 'ThreadID': parent_id, 'VideoID': video_id,
+                    'ParentCommentID': parent, 'CommentText': f"comment {written} of {video_id} " + 'words ' * rng.randint(3, 40),
+                    'AuthorName': f"@user{rng.randint(0, 10 ** 6)}", 'NumberOfLikes': rng.randint(0, 50),
+                    'IsReply': is_reply, 'Timestamp': '2024-06-01T00:00:00Z', 'Period': 'P1',
+                    'ChannelLeaning': 'left', 'Source': 'bench'}) + '\n')
+                written += 1
+    with open(os.path.join(comments_dir, 'videos.csv'), 'w', encoding='utf-8') as f:
+        f.write('video_id,title\n' + ''.join(f"vid{v:08d},Title of video {v}\n" for v in range(n_videos)))
+
+
+def indexed_join(comments_dir, output_dir):
+    sys.path.insert(0, SCRAPING_DIR)
+    from Parent_Join import build_stance_inputs
+    build_stance_inputs(comments_dir, output_dir, [os.path.join(comments_dir, 'videos.csv')])
+
+
+def pandas_join(comments_dir, output_dir):
+    """The ad-hoc way: every comments file in one frame, merged with itself on the parent id"""
+    import glob
+    import pandas as pd
+    frames = [pd.read_json(path, lines=True, dtype=False) for path in sorted(glob.glob(os.path.join(comments_dir, 'comments_*.jsonl')))]
+    df = pd.concat(frames, ignore_index=True)
+    titles = pd.read_csv(os.path.join(comments_dir, 'videos.csv')).set_index('video_id')['title']
+    parents = df[['CommentID', 'CommentText']].rename(columns={'CommentID': 'ParentCommentID',
+                                                               'CommentText': 'ParentCommentText'})
+    df = df.merge(parents, on='ParentCommentID', how='left')
+    df['ParentCommentText'] = df['ParentCommentText'].fillna(df['VideoID'].map(titles))
+    os.makedirs(output_dir, exist_ok=True)
+    for video_id, group in df.groupby('VideoID', sort=False):
+        group.to_json(os.path.join(output_dir, f"MAP_Precomments_{video_id}.jsonl"), orient='records', lines=True)
+
+
+def child(mode, comments_dir, output_dir):
+    start = time.perf_counter()
+    (indexed_join if mode == 'indexed' else pandas_join)(comments_dir, output_dir)
+    elapsed = time.perf_counter() - start
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({'seconds': elapsed, 'peak_mb': peak_mb}))
+
+
+def measure(mode, comments_dir, output_dir):
+    # Each run in its own process, so the peak memory of one does not hide the other
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode, comments_dir, output_dir],
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def parent_texts(output_dir):
+    texts = {}
+    for filename in sorted(os.listdir(output_dir)):
+        if filename.startswith('MAP_Precomments_'):
+            with open(os.path.join(output_dir, filename), encoding='utf-8') as f:
+                for line in f:
+                    item = json.loads(line)
+                    texts[item['CommentID']] = item.get('ParentCommentText')
+    return texts
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(*sys.argv[2:5])
+        return
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, nargs='+', default=[200000, 1000000])
+    parser.add_argument('--videos', type=int, default=200)
+    parser.add_argument('--skip-pandas', action='store_true', help="Only run the indexed join (for large corpora)")
+    args = parser.parse_args()
+
+    print(f"{'comments':>9} {'method':<14} {'seconds':>8} {'comments/sec':>13} {'peak RSS MB':>12}")
+    for n_comments in args.comments:
+        with tempfile.TemporaryDirectory() as tmp:
+            comments_dir = os.path.join(tmp, 'comments')
+            make_comments(comments_dir, n_comments, args.videos)
+            modes = ['indexed'] if args.skip_pandas else ['indexed', 'pandas']
+            for mode in modes:
+                result = measure(mode, comments_dir, os.path.join(tmp, mode))
+                print(f"{n_comments:>9} {mode:<14} {result['seconds']:>8.1f} "
+                      f"{n_comments / result['seconds']:>13.0f} {result['peak_mb']:>12.0f}")
+
+            # Second run over the same folder, with 1% new comments appended: only they are indexed
+            with open(os.path.join(comments_dir, 'comments_vid00000000.jsonl'), 'a', encoding='utf-8') as f:
+                for index in range(n_comments // 100):
+                    f.write(json.dumps({'CommentID': f"new{index}", 'ThreadID': 'x', 'VideoID': 'vid00000000',
+                                        'ParentCommentID': '', 'CommentText': 'new', 'IsReply': 'False'}) + '\n')
+            result = measure('indexed', comments_dir, os.path.join(tmp, 'indexed'))
+            print(f"{n_comments:>9} {'indexed rerun':<14} {result['seconds']:>8.1f} "
+                  f"{n_comments / result['seconds']:>13.0f} {result['peak_mb']:>12.0f}")
+
+            if not args.skip_pandas:
+                indexed, merged = parent_texts(os.path.join(tmp, 'indexed')), parent_texts(os.path.join(tmp, 'pandas'))
+                same = sum(indexed.get(comment_id) == text for comment_id, text in merged.items())
+                print(f"{'':>9} same parent text as the pandas merge: {same}/{len(merged)}")
+
+
+if __name__ == '__main__':
+    main()
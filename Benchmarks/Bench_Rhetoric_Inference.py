@@ -0,0 +1,137 @@
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+
+import yaml
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Divisive_Rhetoric_Detection'))
+from Divisive_Rhetoric import YouTubePropagandaInference
+from Fake_OpenAI_API import FakeOpenAIServer, FakeChatData
+
+
+def make_comments(path, n_comments):
+    with open(path, 'w', encoding='utf-8') as f:
+        for index in range(n_comments):
+            f.write(json.dumps({'CommentID': f"c{index:07d}",
+                                'CommentText': f"Synthetic comment number {index} about the border and the economy"}) + '\n')
+
+
+class FailingChatData(FakeChatData):
+    """Fake answers, except for the requests about the comments in `failing` (a 404), while `fail` is set"""
+
+    def __init__(self, failing):
+        super().__init__()
+        self.failing = failing
+        self.fail = True
+
+    def respond(self, body):
+        user = '\n'.join(message['content'] for message in body.get('messages', []) if message['role'] != 'system')
+        if self.fail and any(text in user for text in self.failing):
+            return None
+        return super().respond(body)
+
+
+def run(server, input_path, output_path, max_in_flight, requests_per_minute=None, tokens_per_minute=None,
+        **config):
+    """Label input_path through the mock server; extra keyword arguments go to the config file"""
+    config_path = output_path + '.yaml'
+    with open(config_path, 'w') as f:
+        # No response cache, so every run pays for every comment
+        yaml.safe_dump(dict({'model_name': 'gpt-4o-mini', 'instruction': True, 'prompt_type': 'base',
+                             'input_data_path': input_path, 'output_path': output_path, 'api_base': server.base_url,
+                             'max_in_flight': max_in_flight, 'requests_per_minute': requests_per_minute,
+                             'tokens_per_minute': tokens_per_minute, 'cache': False}, **config), f)
+    server.max_in_flight = 0
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        YouTubePropagandaInference(config_path).run_all()
+    elapsed = time.perf_counter() - start
+    with open(output_path, 'r', encoding='utf-8') as f:
+        results = [json.loads(line) for line in f]
+    return results, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, default=400)
+    parser.add_argument('--latency', type=float, default=0.2, help="Seconds per chat completion")
+    parser.add_argument('--in-flight', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--requests-per-minute', type=int, default=None, help="Also run once with this limit")
+    parser.add_argument('--tokens-per-minute', type=int, default=None,
+                        help="Also label --tpm-comments comments with this limit and check the tokens/min reached")
+    parser.add_argument('--tpm-comments', type=int, default=60)
+    parser.add_argument('--failures', type=int, default=0,
+                        help="Also make the calls of this many comments fail, then check that a resumed run labels them")
+    args = parser.parse_args()
+
+    os.environ.setdefault('OPENAI_API_KEY', 'fake-key')
+    os.environ.setdefault('OPENAI_ORGANIZATION', 'fake-org')
+
+    with FakeOpenAIServer(latency=args.latency) as server, tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, 'comments.jsonl')
+        make_comments(input_path, args.comments)
+
+        baseline = None
+        for max_in_flight in args.in_flight:
+            results, elapsed = run(server, input_path, os.path.join(tmp, f'out_{max_in_flight}.jsonl'), max_in_flight)
+            baseline = baseline or results
+            print(f"in flight {max_in_flight:>3}: {len(results) / elapsed:8.1f} comments/sec "
+                  f"({elapsed:.1f}s, server saw up to {server.max_in_flight} at once), "
+                  f"same output: {results == baseline}")
+            if results != baseline:
+                sys.exit(1)
+
+        if args.requests_per_minute:
+            max_in_flight = max(args.in_flight)
+            results, elapsed = run(server, input_path, os.path.join(tmp, 'out_limited.jsonl'), max_in_flight,
+                                   requests_per_minute=args.requests_per_minute)
+            print(f"in flight {max_in_flight:>3}, {args.requests_per_minute} requests/min: "
+                  f"{60 * len(results) / elapsed:.0f} requests/min, same output: {results == baseline}")
+
+        if args.tokens_per_minute:
+            # Each request reserves its prompt and max_tokens (1000), more than the one-second bucket of a low
+            # limit; the tokens reported by the server over the run must still stay under the limit
+            input_path = os.path.join(tmp, 'comments_tpm.jsonl')
+            make_comments(input_path, args.tpm_comments)
+            tokens_before = server.tokens
+            results, elapsed = run(server, input_path, os.path.join(tmp, 'out_tpm.jsonl'), max(args.in_flight),
+                                   tokens_per_minute=args.tokens_per_minute)
+            used = server.tokens - tokens_before
+            # The bucket starts full and a request is sent once the bucket is full again: one second of budget
+            # and one request come on top of the limit
+            allowed = args.tokens_per_minute * (elapsed + 1) / 60 + used / max(len(results), 1)
+            print(f"{args.tokens_per_minute} tokens/min: {60 * used / elapsed:.0f} tokens/min reached "
+                  f"({used} tokens in {elapsed:.1f}s, {len(results)} comments), within the limit: {used <= allowed}")
+            if used > allowed:
+                sys.exit(1)
+
+    if args.failures:
+        # Every attempt of a few comments fails: they must be left out of the output (not labelled "no
+        # propaganda"), and the next run, resuming the same output, must label them and only them
+        failing = [f"number {index} about" for index in range(0, args.comments, max(args.comments // args.failures, 1))]
+        data = FailingChatData(failing[:args.failures])
+        with FakeOpenAIServer(data=data, latency=args.latency) as server, tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, 'comments.jsonl')
+            make_comments(input_path, args.comments)
+            output_path = os.path.join(tmp, 'out_failures.jsonl')
+            first, _ = run(server, input_path, output_path, max(args.in_flight))
+            data.fail = False
+            before = server.request_counts.get('chat/completions', 0)
+            second, _ = run(server, input_path, output_path, max(args.in_flight))
+            retried = server.request_counts.get('chat/completions', 0) - before
+            ids = [result['CommentID'] for result in second]
+            ok = (len(first) == args.comments - len(data.failing) and retried == len(data.failing)
+                  and len(ids) == len(set(ids)) == args.comments)
+            print(f"{len(data.failing)} comments with failed calls: {len(first)} labelled on the first run, "
+                  f"{retried} requests on the resumed run, {len(set(ids))}/{args.comments} labelled after it: {ok}")
+            if not ok:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+
+from Fake_OpenAI_API import FakeOpenAIServer, FakeChatData
+from Bench_Stance_Workers import make_pairs
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Stance_Detection'))
+from Stance_Engine import StanceEngine
+
+
+def write_inputs(input_dir, data, n_files):
+    os.makedirs(input_dir, exist_ok=True)
+    for index in range(n_files):
+        with open(os.path.join(input_dir, f"MAP_Precomments_{index:03d}.jsonl"), 'w') as f:
+            for item in data[index::n_files]:
+                f.write(json.dumps(item) + '\n')
+
+
+def read_labels(output_dir, topics):
+    """{CommentID: {topic: label}} from the Label_ files of one run"""
+    labels = {}
+    for filename in sorted(os.listdir(output_dir)):
+        if not filename.startswith('Label_'):
+            continue
+        with open(os.path.join(output_dir, filename)) as f:
+            for line in f:
+                item = json.loads(line)
+                found = item['Stance_Labels'] if 'Stance_Labels' in item else {topics[0]: item['Stance_Label']}
+                labels.setdefault(item['CommentID'], {}).update(found)
+    return labels
+
+
+def run(server, passes, input_dir, tmp, name, workers):
+    """Run the engine once per (topics, combined) pass; returns requests, prompt tokens, seconds and labels"""
+    before = (sum(server.request_counts.values()), server.prompt_tokens)
+    labels = {}
+    start = time.perf_counter()
+    for index, (topics, combined) in enumerate(passes):
+        output_dir = os.path.join(tmp, f"{name}_{index}")
+        # Empty response cache for every pass, so every pass pays for its own requests
+        engine = StanceEngine(topics, combined=combined, workers=workers,
+                              cache_path=os.path.join(tmp, f"{name}_{index}.sqlite"))
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            engine.process_dir(input_dir, output_dir)
+        engine.cache.close()
+        for comment_id, found in read_labels(output_dir, topics).items():
+            labels.setdefault(comment_id, {}).update(found)
+    elapsed = time.perf_counter() - start
+    requests = sum(server.request_counts.values()) - before[0]
+    return requests, server.prompt_tokens - before[1], elapsed, labels
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, default=1000)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--topics', nargs='+', default=['climate', 'immigration'])
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds per chat completion")
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--drop-rate', type=float, default=0.02,
+                        help="Share of topics the mock model leaves out of a combined answer")
+    args = parser.parse_args()
+
+    with FakeOpenAIServer(data=FakeChatData(drop_rate=args.drop_rate), latency=args.latency) as server, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+        os.environ.setdefault('ADD_API_KEY', 'fake-key')
+        input_dir = os.path.join(tmp, 'input')
+        write_inputs(input_dir, make_pairs(args.comments), args.files)
+
+        modes = [
+            ('one script per topic', [([topic], False) for topic in args.topics]),
+            ('one pass, per-topic requests', [(args.topics, False)]),
+            ('one pass, combined requests', [(args.topics, True)]),
+        ]
+        baseline = None
+        print(f"{'mode':<30} {'requests/1k':>12} {'prompt tokens/1k':>17} {'seconds':>8} {'same labels':>12}")
+        for index, (name, passes) in enumerate(modes):
+            requests, prompt_tokens, elapsed, labels = run(server, passes, input_dir, tmp, f"mode{index}",
+                                                           args.workers)
+            baseline = baseline or labels
+            same = sum(labels.get(comment_id) == found for comment_id, found in baseline.items()) / len(baseline)
+            per_1k = 1000 / args.comments
+            print(f"{name:<30} {requests * per_1k:>12.0f} {prompt_tokens * per_1k:>17.0f} {elapsed:>8.1f} "
+                  f"{100 * same:>11.1f}%")
+
+
+if __name__ == '__main__':
+    main()
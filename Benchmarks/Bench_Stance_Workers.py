@@ -0,0 +1,66 @@
+import os
+import sys
+import io
+import random
+import argparse
+import tempfile
+import contextlib
+
+from Fake_OpenAI_API import FakeOpenAIServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Stance_Detection'))
+import Stance_Engine
+from Stance_Engine import StanceEngine
+
+
+def make_pairs(n_comments, seed=0):
+    rng = random.Random(seed)
+    return [{'CommentID': f"c{index:07d}", 'VideoID': f"v{rng.randint(0, 20):03d}",
+             'ParentCommentText': f"Parent comment {rng.randint(0, n_comments)} about the weather this summer",
+             'CommentText': f"Reply number {index} about the planet and the summer heat"}
+            for index in range(n_comments)]
+
+
+def run(data, topics, workers, cache_path, combined=False):
+    """Label data with an empty response cache; returns the labels and the run statistics"""
+    engine = StanceEngine(topics, combined=combined, workers=workers, cache_path=cache_path)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            labeled = engine.label_comments(data)
+    finally:
+        engine.cache.close()
+    labels = [item['Stance_Label'] if len(topics) == 1 else item['Stance_Labels'] for item in labeled]
+    return labels, dict(engine.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, default=400)
+    parser.add_argument('--latency', type=float, default=0.2, help="Seconds per chat completion")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--error-rate', type=float, default=0.05, help="Share of requests answered with a 429")
+    parser.add_argument('--topic', default='climate')
+    args = parser.parse_args()
+
+    with FakeOpenAIServer(latency=args.latency, error_rate=args.error_rate) as server, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+        os.environ.setdefault('ADD_API_KEY', 'fake-key')
+        Stance_Engine.RETRY_DELAY = 0.05
+        data = make_pairs(args.comments)
+
+        baseline = None
+        print(f"{'workers':>7} {'comments/sec':>13} {'requests':>9} {'retries':>8} {'failed':>7} "
+              f"{'prompt cache':>13} {'same labels':>12}")
+        for workers in args.workers:
+            server.max_in_flight = 0
+            labels, stats = run(data, [args.topic], workers, os.path.join(tmp, f'cache_{workers}.sqlite'))
+            baseline = baseline or labels
+            prompt_cache = stats.get('cached_tokens', 0) / max(stats.get('prompt_tokens', 0), 1)
+            print(f"{workers:>7} {stats['comments'] / stats['seconds']:>13.1f} {stats.get('requests', 0):>9} "
+                  f"{stats.get('retries', 0):>8} {stats.get('failed', 0):>7} {100 * prompt_cache:>12.1f}% "
+                  f"{str(labels == baseline):>12}")
+
+
+if __name__ == '__main__':
+    main()
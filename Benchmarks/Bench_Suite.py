@@ -0,0 +1,332 @@
+import os
+import sys
+import io
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import contextlib
+import subprocess
+from datetime import datetime, timezone
+
+from Fake_YouTube_API import (FakeYouTubeServer, FakeYouTubeData, RecordingYouTubeData, ReplayYouTubeData,
+                              UpstreamYouTubeData)
+from Fake_OpenAI_API import FakeOpenAIServer, FakeChatData, RecordingChatData, ReplayChatData, UpstreamChatData
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCH_DIR, '..')
+DEFAULT_RESULTS_PATH = os.path.join(BENCH_DIR, 'bench_results.jsonl')
+
+# Scenario: (API it talks to, what its throughput counts)
+SCENARIOS = {
+    'discovery': ('youtube', 'videos'),
+    'scraper': ('youtube', 'comments'),
+    'rhetoric': ('openai', 'comments'),
+    'stance': ('openai', 'comments'),
+}
+
+
+def time_requests(owner, name, samples):
+    """Wrap owner.name so the duration of every HTTP request (retries included) is appended to samples"""
+    original = getattr(owner, name)
+
+    if asyncio.iscoroutinefunction(original):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+    else:
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+    setattr(owner, name, timed)
+
+
+def run_discovery(spec, tmp):
+    sys.path.append(os.path.join(REPO_DIR, 'Scraping_Scripts'))
+    from Video_Identification import youtube_search
+    from Quota_Ledger import QuotaLedger
+    from Request_Executor import RequestExecutor
+    from Response_Cache import ResponseCache
+
+    # Fresh cache and ledger, so every run pays for every request
+    ledger = QuotaLedger(os.path.join(tmp, 'quota_ledger.sqlite'), 10 ** 9)
+    topics = {'bench': [f"bench query {index}" for index in range(spec['queries'])]}
+    _, processed = youtube_search(topics, max_results=spec['max_results'], executor=RequestExecutor(ledger),
+                                  cache=ResponseCache(os.path.join(tmp, 'search_cache')), api_key='FAKE_KEY',
+                                  workers=spec['query_workers'], api_endpoint=spec['api_endpoint'])
+    ledger.close()
+    return processed
+
+
+def run_scraper(spec, tmp):
+    import pandas as pd
+    sys.path.append(os.path.join(REPO_DIR, 'Scraping_Scripts'))
+    from Comment_Scraper import crawl
+    from Bench_Comment_Scraper import make_video_list, count_lines
+
+    videos_df = pd.read_csv(spec['video_list']) if spec['video_list'] else make_video_list(spec['videos'])
+    output_path = os.path.join(tmp, 'comments')
+    crawl(videos_df, output_path, 'FAKE_KEY', quota_limit=10 ** 9, video_workers=spec['video_workers'],
+          reply_workers=spec['workers'], api_endpoint=spec['api_endpoint'],
+          ledger_path=os.path.join(tmp, 'quota_ledger.sqlite'))
+    return count_lines(output_path)
+
+
+def count_file_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return sum(1 for _ in f)
+
+
+def run_rhetoric(spec, tmp):
+    import yaml
+    sys.path.append(os.path.join(REPO_DIR, 'Divisive_Rhetoric_Detection'))
+    from Divisive_Rhetoric import YouTubePropagandaInference
+    from Bench_Packed_Prompts import make_corpus
+
+    input_path = spec['corpus']
+    if not input_path:
+        input_path = os.path.join(tmp, 'corpus.jsonl')
+        make_corpus(input_path, spec['comments'])
+    output_path = os.path.join(tmp, 'rhetoric.jsonl')
+    config_path = os.path.join(tmp, 'config.yaml')
+    with open(config_path, 'w') as f:
+        # No response cache, so every run pays for every comment
+        yaml.safe_dump({'model_name': 'gpt-4o-mini', 'instruction': True, 'prompt_type': 'base',
+                        'input_data_path': input_path, 'output_path': output_path, 'api_base': spec['base_url'],
+                        'max_in_flight': spec['workers'], 'pack_size': spec['pack_size'], 'cache': False}, f)
+    os.environ.setdefault('OPENAI_API_KEY', 'fake-key')
+    os.environ.setdefault('OPENAI_ORGANIZATION', 'fake-org')
+    YouTubePropagandaInference(config_path).run_all()
+    return count_file_lines(output_path)
+
+
+def run_stance(spec, tmp):
+    sys.path.append(os.path.join(REPO_DIR, 'Stance_Detection'))
+    from Stance_Engine import StanceEngine
+    from Bench_Stance_Workers import make_pairs
+
+    input_path = spec['stance_corpus']
+    if not input_path:
+        input_path = os.path.join(tmp, 'pairs.jsonl')
+        with open(input_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(pair) + '\n' for pair in make_pairs(spec['comments'])))
+    output_path = os.path.join(tmp, 'Label_bench.jsonl')
+    os.environ['OPENAI_BASE_URL'] = spec['base_url']
+    os.environ.setdefault('ADD_API_KEY', 'fake-key')
+    StanceEngine(spec['topics'], workers=spec['workers'], cache_path=None).process_file(input_path, output_path)
+    return count_file_lines(output_path)
+
+
+RUNNERS = {'discovery': run_discovery, 'scraper': run_scraper, 'rhetoric': run_rhetoric, 'stance': run_stance}
+
+
+def child(scenario, spec_json):
+    """Run one scenario in this process and print its measures as the last line"""
+    import httplib2
+    import httpx
+    import numpy as np
+
+    spec = json.loads(spec_json)
+    samples = []
+    time_requests(httplib2.Http, 'request', samples)
+    time_requests(httpx.AsyncClient, 'send', samples)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()) as log:
+            items = RUNNERS[scenario](spec, tmp)
+        elapsed = time.perf_counter() - start
+
+    latencies = np.array(samples) * 1000 if samples else np.zeros(1)
+    print(json.dumps({
+        'items': items, 'seconds': elapsed, 'requests': len(samples),
+        'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'log_tail': log.getvalue().strip().splitlines()[-3:]
+    }))
+
+
+def measure(scenario, spec):
+    # Each scenario in its own process, so its peak memory and imports are its own
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', scenario, json.dumps(spec)],
+                            capture_output=True, text=True, cwd=BENCH_DIR)
+    if result.returncode != 0:
+        print(f"{scenario} failed:\n{result.stderr.strip()[-2000:]}")
+        return None
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    def git(*args):
+        return subprocess.run(['git', *args], capture_output=True, text=True, cwd=REPO_DIR).stdout.strip()
+    return git('rev-parse', '--short', 'HEAD') or 'unknown', bool(git('status', '--porcelain', '--untracked-files=no'))
+
+
+def youtube_data(args):
+    """Data source of the YouTube server; a missing fixture file is recorded first (from the real API with a key)"""
+    synthetic = FakeYouTubeData(threads_per_video=args.threads_per_video)
+    if not args.youtube_fixtures:
+        return synthetic
+    if not os.path.exists(args.youtube_fixtures):
+        recorder = RecordingYouTubeData(UpstreamYouTubeData(args.record_youtube_key) if args.record_youtube_key
+                                        else synthetic)
+        with FakeYouTubeServer(data=recorder, latency=0) as server:
+            for scenario in args.scenarios:
+                if SCENARIOS[scenario][0] == 'youtube':
+                    measure(scenario, scenario_spec(args, scenario, server))
+        recorder.save(args.youtube_fixtures)
+        print(f"Recorded {len(recorder.fixtures)} YouTube responses to {args.youtube_fixtures}")
+    return ReplayYouTubeData(args.youtube_fixtures)
+
+
+def openai_data(args):
+    """Data source of the chat completions server; a missing fixture file is recorded first"""
+    synthetic = FakeChatData(drop_rate=args.drop_rate)
+    if not args.openai_fixtures:
+        return synthetic
+    if not os.path.exists(args.openai_fixtures):
+        recorder = RecordingChatData(UpstreamChatData(args.record_openai_key) if args.record_openai_key
+                                     else synthetic)
+        with FakeOpenAIServer(data=recorder, latency=0) as server:
+            for scenario in args.scenarios:
+                if SCENARIOS[scenario][0] == 'openai':
+                    measure(scenario, scenario_spec(args, scenario, server))
+        recorder.save(args.openai_fixtures)
+        print(f"Recorded {len(recorder.responses)} chat completions to {args.openai_fixtures}")
+    return ReplayChatData(args.openai_fixtures)
+
+
+def scenario_spec(args, scenario, server):
+    spec = {'workers': args.workers, 'comments': args.comments, 'corpus': args.corpus,
+            'stance_corpus': args.stance_corpus, 'topics': args.topics, 'pack_size': args.pack_size,
+            'videos': args.videos, 'video_list': args.video_list, 'video_workers': args.video_workers,
+            'queries': args.queries, 'max_results': args.max_results, 'query_workers': args.query_workers}
+    if SCENARIOS[scenario][0] == 'youtube':
+        spec['api_endpoint'] = server.api_endpoint
+    else:
+        spec['base_url'] = server.base_url
+    return spec
+
+
+def run_suite(args):
+    commit, dirty = git_commit()
+    settings = {name: value for name, value in vars(args).items()
+                if name not in ('compare', 'results', 'label', 'record_youtube_key', 'record_openai_key')}
+    youtube = FakeYouTubeServer(data=youtube_data(args), latency=args.youtube_latency, latency_jitter=args.jitter,
+                                error_rate=args.server_error_rate, rate_limit_rate=args.rate_limit_rate,
+                                forbidden_rate=args.forbidden_rate, forbidden_reason=args.forbidden_reason)
+    openai = FakeOpenAIServer(data=openai_data(args), latency=args.openai_latency, latency_jitter=args.jitter,
+                              error_rate=args.rate_limit_rate, server_error_rate=args.server_error_rate,
+                              forbidden_rate=args.forbidden_rate)
+
+    print(f"commit {commit}{' (uncommitted changes)' if dirty else ''}")
+    print(f"{'scenario':<10} {'items':>7} {'seconds':>8} {'items/sec':>10} {'requests':>9} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'peak RSS MB':>12}  server answers")
+    with youtube, openai:
+        for scenario in args.scenarios:
+            api, unit = SCENARIOS[scenario]
+            server = youtube if api == 'youtube' else openai
+            server.status_counts.clear()
+            result = measure(scenario, scenario_spec(args, scenario, server))
+            if result is None:
+                continue
+            statuses = {str(status): count for status, count in sorted(server.status_counts.items())}
+            throughput = result['items'] / result['seconds']
+            print(f"{scenario:<10} {result['items']:>7} {result['seconds']:>8.2f} {throughput:>10.1f} "
+                  f"{result['requests']:>9} {result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} "
+                  f"{result['peak_rss_mb']:>12.0f}  {json.dumps(statuses)}")
+            record = {'commit': commit, 'dirty': dirty, 'label': args.label,
+                      'time': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'), 'scenario': scenario,
+                      'unit': unit, 'items': result['items'], 'seconds': round(result['seconds'], 3),
+                      'throughput': round(throughput, 2), 'requests': result['requests'],
+                      'p50_ms': round(result['p50_ms'], 2), 'p99_ms': round(result['p99_ms'], 2),
+                      'peak_rss_mb': round(result['peak_rss_mb'], 1), 'status_counts': statuses,
+                      'settings': settings}
+            with open(args.results, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+    print(f"Results appended to {args.results}")
+
+
+def compare(results_path):
+    """Latest result of every scenario for each commit, in the order the commits were first measured"""
+    if not os.path.exists(results_path):
+        print(f"No results in {results_path}")
+        return
+    latest = {}
+    with open(results_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            name = record['commit'] + ('+' if record['dirty'] else '')
+            if record.get('label'):
+                name += f" ({record['label']})"
+            latest.setdefault(record['scenario'], {})[name] = record
+
+    for scenario, by_commit in latest.items():
+        print(f"\n{scenario} ({next(iter(by_commit.values()))['unit']}/sec)")
+        print(f"{'commit':<28} {'items/sec':>10} {'change':>8} {'p50 ms':>8} {'p99 ms':>8} {'peak RSS MB':>12}")
+        previous = None
+        for name, record in by_commit.items():
+            change = f"{100 * (record['throughput'] / previous - 1):+.1f}%" if previous else ''
+            print(f"{name:<28} {record['throughput']:>10.1f} {change:>8} {record['p50_ms']:>8.1f} "
+                  f"{record['p99_ms']:>8.1f} {record['peak_rss_mb']:>12.0f}")
+            previous = record['throughput']
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(*sys.argv[2:4])
+        return
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--results', default=DEFAULT_RESULTS_PATH, help="JSONL file the results are appended to")
+    parser.add_argument('--label', default='', help="Note stored with the results, e.g. the machine")
+    parser.add_argument('--compare', action='store_true', help="Only print the stored results, commit by commit")
+    # Fake servers
+    parser.add_argument('--youtube-latency', type=float, default=0.05, help="Seconds per YouTube API response")
+    parser.add_argument('--openai-latency', type=float, default=0.2, help="Seconds per chat completion")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Mean of an extra exponential delay per response")
+    parser.add_argument('--server-error-rate', type=float, default=0.0, help="Share of requests answered with a 503")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument('--forbidden-rate', type=float, default=0.0, help="Share of requests answered with a 403")
+    parser.add_argument('--forbidden-reason', default='userRateLimitExceeded',
+                        help="Reason of the YouTube 403 errors (quotaExceeded stops the scripts)")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Share of packed comments the mock model leaves out")
+    # Fixtures
+    parser.add_argument('--youtube-fixtures', default=None, help="Recorded YouTube responses (.json.gz) to replay")
+    parser.add_argument('--record-youtube-key', default=None, help="Record --youtube-fixtures from the real API")
+    parser.add_argument('--openai-fixtures', default=None, help="Recorded chat completions (.json.gz) to replay")
+    parser.add_argument('--record-openai-key', default=None, help="Record --openai-fixtures from the real API")
+    # Workload
+    parser.add_argument('--queries', type=int, default=6, help="Search queries of the discovery scenario")
+    parser.add_argument('--max-results', type=int, default=200, help="Videos kept per query")
+    parser.add_argument('--query-workers', type=int, default=6)
+    parser.add_argument('--videos', type=int, default=8, help="Synthetic videos of the scraper scenario")
+    parser.add_argument('--video-list', default=None, help="CSV of real videos for the scraper (with fixtures)")
+    parser.add_argument('--threads-per-video', type=int, default=300)
+    parser.add_argument('--video-workers', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=16,
+                        help="Reply workers of the scraper, requests in flight of the rhetoric and stance scripts")
+    parser.add_argument('--comments', type=int, default=400, help="Synthetic comments of the rhetoric and stance runs")
+    parser.add_argument('--corpus', default=None, help="JSONL comments file for the rhetoric scenario")
+    parser.add_argument('--stance-corpus', default=None, help="JSONL stance input file (with ParentCommentText)")
+    parser.add_argument('--topics', nargs='+', default=['climate'])
+    parser.add_argument('--pack-size', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.results)
+    else:
+        run_suite(args)
+
+
+if __name__ == '__main__':
+    main()
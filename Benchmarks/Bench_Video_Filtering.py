@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+import random
+import argparse
+import contextlib
+
+import isodate
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scraping_Scripts'))
+import pandas as pd
+from Video_Identification import VIDEO_COLUMNS, duration_seconds, filter_videos, remove_duplicates
+
+
+def make_records(n_videos, duplicate_share=0.3, seed=0):
+    """Synthetic search results; duplicate_share of them repeat a video already found by another query"""
+    rng = random.Random(seed)
+    distinct = max(1, int(n_videos * (1 - duplicate_share)))
+    records = []
+    for index in range(n_videos):
+        video = index if index < distinct else rng.randrange(distinct)
+        video_rng = random.Random(video)
+        records.append({
+            'title': f"Video {video}",
+            'url': f"https://www.youtube.com/watch?v=vid{video:08d}",
+            'views': video_rng.randint(100, 10 ** 7),
+            'comments': video_rng.randint(0, 20000),
+            'duration': f"PT{video_rng.randint(0, 2)}H{video_rng.randint(0, 59)}M{video_rng.randint(0, 59)}S",
+            'channel': f"Channel {video_rng.randint(1, 500)}",
+            'category_id': '25',
+            'topic': 'bench',
+            'query': f"query {index % 1000}"
+        })
+    return records
+
+
+# The list-based dedup and filter used before the candidates were kept in a frame
+def legacy_filter_videos(videos, min_views=1, min_comments=1000, max_duration='PT20M'):
+    filtered_videos = []
+    max_duration_seconds = isodate.parse_duration(max_duration).total_seconds()
+    for video in videos:
+        duration = isodate.parse_duration(video['duration']).total_seconds()
+        view_count = video['views']
+        comment_count = video['comments']
+        print(f"Checking video: {video['title']}")
+        print(f"Duration (seconds): {duration}, Views: {view_count}, Comments: {comment_count}")
+        if view_count >= min_views and comment_count >= min_comments and duration <= max_duration_seconds:
+            filtered_videos.append(video)
+        else:
+            print(f"Excluded video: {video['title']}")
+    filtered_videos.sort(key=lambda x: x['views'], reverse=True)
+    return filtered_videos
+
+
+def legacy_remove_duplicates(videos):
+    seen_urls = set()
+    unique_videos = []
+    for video in videos:
+        if video['url'] not in seen_urls:
+            unique_videos.append(video)
+            seen_urls.add(video['url'])
+    unique_videos.sort(key=lambda x: x['views'], reverse=True)
+    return unique_videos
+
+
+def legacy_run(records, thresholds):
+    videos = sorted(records, key=lambda x: x['views'], reverse=True)
+    unique_videos = legacy_remove_duplicates(videos)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return [legacy_filter_videos(unique_videos, min_comments=min_comments, max_duration=max_duration)
+                for min_comments, max_duration in thresholds]
+
+
+def frame_run(records, thresholds):
+    # Durations are parsed at ingestion, as search_query does, starting from an empty parse cache
+    duration_seconds.cache_clear()
+    rows = [dict(record, duration_seconds=duration_seconds(record['duration'])) for record in records]
+    videos = pd.DataFrame(rows, columns=VIDEO_COLUMNS).sort_values('views', ascending=False, kind='stable',
+                                                                   ignore_index=True)
+    unique_videos = remove_duplicates(videos)
+    return [filter_videos(unique_videos, min_comments=min_comments, max_duration=max_duration)
+            for min_comments, max_duration in thresholds]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--videos', type=int, default=100000, help="Synthetic video records")
+    parser.add_argument('--duplicates', type=float, default=0.3, help="Share of records repeating another video")
+    args = parser.parse_args()
+
+    records = make_records(args.videos, args.duplicates)
+    # One threshold set, then five, as when tuning the filters on the same candidates
+    for thresholds in ([(500, 'PT15M')], [(100, 'PT10M'), (500, 'PT15M'), (1000, 'PT15M'), (1000, 'PT20M'),
+                                           (5000, 'PT30M')]):
+        legacy, legacy_time = timed(legacy_run, records, thresholds)
+        frame, frame_time = timed(frame_run, records, thresholds)
+        same = all(list(old_video['url'] for old_video in old) == new['url'].tolist()
+                   for old, new in zip(legacy, frame))
+        print(f"{len(records)} records, {len(thresholds)} threshold set(s): "
+              f"lists {legacy_time:.2f}s, frame {frame_time:.2f}s ({legacy_time / frame_time:.1f}x), "
+              f"kept {[len(new) for new in frame]}, same videos: {same}")
+        if not same:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
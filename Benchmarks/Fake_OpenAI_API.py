@@ -0,0 +1,256 @@
+import re
+import gzip
+import json
+import random
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+TECHNIQUES = [
+    'Loaded_Language', 'Name_Calling,Labeling', 'Repetition', 'Exaggeration,Minimisation',
+    'Appeal_to_fear-prejudice', 'Flag-Waving', 'Causal_Oversimplification', 'Appeal_to_Authority',
+    'Slogans/Thought-terminating_Cliches', 'Whataboutism,Straw_Men', 'Black-and-White_Fallacy',
+    'Bandwagon,Reductio_ad_hitlerum', 'Doubt', 'Appeal_to_Time'
+]
+
+
+PACKED_LINE = re.compile(r'^\[(\d+)\] <(.*)>$')
+TOPIC_LINE = re.compile(r'^Topic: (\S+)\n', re.MULTILINE)
+
+
+def count_tokens(text):
+    return len(text) // 4 + 1
+
+
+class FakeChatData:
+    """Deterministic answers to chat completions: the same messages always get the same answer.
+
+    A comment gets the same techniques whether it is sent alone or packed with others, and the same stance
+    whether a topic is asked alone or with other topics; drop_rate is the share of packed comments (or
+    topics) left out of the answer, as a model sometimes does.
+    """
+
+    def __init__(self, drop_rate=0.0):
+        self.drop_rate = drop_rate
+
+    def techniques(self, text):
+        rng = random.Random(hashlib.sha256(text.encode('utf-8')).hexdigest())
+        techniques = [technique for technique in TECHNIQUES if rng.random() < 0.12]
+        return '\n'.join(techniques) if techniques else 'no propaganda detected'
+
+    def answer(self, system, user):
+        if 'propaganda' in system and 'several texts' in system:
+            blocks = []
+            for line in user.split('\n'):
+                match = PACKED_LINE.match(line)
+                if match and random.Random(match.group(2)).random() >= self.drop_rate:
+                    blocks.append(f"[{match.group(1)}]\n{self.techniques(match.group(2))}")
+            return '\n'.join(blocks)
+        if 'propaganda' in system:
+            return self.techniques(user[1:-1] if user.startswith('<') and user.endswith('>') else user)
+        if 'JSON object' in system and TOPIC_LINE.search(system):
+            # Several topics in one request: each topic gets the answer it would get on its own
+            sections = TOPIC_LINE.split(system.split('\nAnswer ONLY with a JSON object')[0])[1:]
+            stances = {}
+            for topic, prompt in zip(sections[::2], sections[1::2]):
+                if random.Random(topic + user).random() >= self.drop_rate:
+                    stances[topic] = self.stance(prompt, user)
+            return json.dumps(stances)
+        if 'stance' in system.lower():
+            return str(self.stance(system, user))
+        return 'ok'
+
+    def stance(self, prompt, user):
+        return random.Random(hashlib.sha256((prompt.strip() + '\n' + user).encode('utf-8')).hexdigest()).randint(0, 2)
+
+    def respond(self, body):
+        messages = body.get('messages', [])
+        system = '\n'.join(message['content'] for message in messages if message['role'] == 'system')
+        user = '\n'.join(message['content'] for message in messages if message['role'] != 'system')
+        content = self.answer(system, user)
+        prompt_tokens = count_tokens(system) + count_tokens(user)
+        completion_tokens = count_tokens(content)
+        return {
+            'id': 'chatcmpl-' + hashlib.sha256(user.encode('utf-8')).hexdigest()[:24],
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens,
+                      # Like the real API, a long shared system prompt is served from the prompt cache
+                      'prompt_tokens_details': {'cached_tokens': count_tokens(system) // 128 * 128}}
+        }
+
+
+def chat_key(body):
+    """Replay key of a chat completion request: the fields that change the answer"""
+    fields = {name: body.get(name) for name in ('model', 'messages', 'max_tokens', 'temperature')}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class UpstreamChatData:
+    """Forwards every request to a real OpenAI-compatible endpoint (to record fixtures)"""
+
+    def __init__(self, api_key, base_url='https://api.openai.com/v1'):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+
+    def respond(self, body):
+        request = Request(self.base_url + '/chat/completions', data=json.dumps(body).encode('utf-8'),
+                          headers={'Content-Type': 'application/json', 'Authorization': f"Bearer {self.api_key}"})
+        try:
+            with urlopen(request) as response:
+                return json.loads(response.read())
+        except HTTPError as error:
+            print(f"Upstream error {error.code} while recording: {error.read()[:200]}")
+            return None
+
+
+class RecordingChatData:
+    """Wraps another data source and keeps every answer, to be saved and replayed later"""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    def respond(self, body):
+        response = self.inner.respond(body)
+        if response is not None:
+            with self.lock:
+                self.responses[chat_key(body)] = response
+        return response
+
+    def save(self, path):
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump(self.responses, f)
+
+
+class ReplayChatData:
+    """Answers from recorded responses only; a request that was not recorded gets a 404"""
+
+    def __init__(self, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            self.responses = json.load(f)
+
+    def respond(self, body):
+        return self.responses.get(chat_key(body))
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # room for many concurrent connections
+
+
+class FakeOpenAIServer:
+    """Local stand-in for the OpenAI chat completions endpoint, with a fixed latency per request.
+
+    latency_jitter adds an exponentially distributed delay of that mean to every request. error_rate is
+    the share of requests answered with a 429 rate limit error, server_error_rate with a 503 and
+    forbidden_rate with a 403; data can also be a RecordingChatData or a ReplayChatData.
+    """
+
+    def __init__(self, data=None, latency=0.2, host='127.0.0.1', port=0, error_rate=0.0, seed=0,
+                 server_error_rate=0.0, forbidden_rate=0.0, latency_jitter=0.0):
+        self.data = data or FakeChatData()
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.server_error_rate = server_error_rate
+        self.forbidden_rate = forbidden_rate
+        self.random = random.Random(seed)
+        self.request_counts = {}
+        self.status_counts = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.tokens = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.lock = threading.Lock()
+        self.httpd = _HTTPServer((host, port), self._handler())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                endpoint = self.path.split('?', 1)[0].rstrip('/').split('/v1/', 1)[-1]
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+                with server.lock:
+                    server.request_counts[endpoint] = server.request_counts.get(endpoint, 0) + 1
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                    draw = server.random.random()
+                    delay = server.latency
+                    if server.latency_jitter:
+                        delay += server.random.expovariate(1 / server.latency_jitter)
+                try:
+                    time.sleep(delay)
+                finally:
+                    with server.lock:
+                        server.in_flight -= 1
+
+                if draw < server.error_rate:
+                    status, response = 429, {'error': {'message': 'Rate limit reached', 'type': 'requests',
+                                                       'code': 'rate_limit_exceeded'}}
+                elif draw < server.error_rate + server.server_error_rate:
+                    status, response = 503, {'error': {'message': 'The server is overloaded', 'type': 'server_error'}}
+                elif draw < server.error_rate + server.server_error_rate + server.forbidden_rate:
+                    status, response = 403, {'error': {'message': 'Request not allowed', 'type': 'invalid_request_error',
+                                                       'code': 'unsupported_country_region_territory'}}
+                elif endpoint == 'chat/completions':
+                    response = server.data.respond(body)
+                    if response is None:
+                        status, response = 404, {'error': {'message': 'No recorded response for this request'}}
+                    else:
+                        status = 200
+                        with server.lock:
+                            server.tokens += response['usage']['total_tokens']
+                            server.prompt_tokens += response['usage']['prompt_tokens']
+                            server.completion_tokens += response['usage']['completion_tokens']
+                else:
+                    status, response = 404, {'error': {'message': f"Unknown endpoint {endpoint}"}}
+                with server.lock:
+                    server.status_counts[status] = server.status_counts.get(status, 0) + 1
+
+                payload = json.dumps(response).encode('utf-8')
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client went away (cancelled or killed) while waiting
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,293 @@
+import gzip
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+from urllib.request import urlopen
+
+# Query parameters that do not change the response, left out of the replay keys
+IGNORED_PARAMS = {'key', 'alt', 'prettyPrint'}
+
+
+class FakeApiError(Exception):
+    """Raised by a data source to answer with a YouTube-style error body"""
+
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+def request_key(endpoint, params):
+    return endpoint + '?' + urlencode(sorted((k, v) for k, v in params.items() if k not in IGNORED_PARAMS))
+
+
+class FakeYouTubeData:
+    """Deterministic synthetic comment sections, generated from the video id"""
+
+    def __init__(self, threads_per_video=300, max_replies=12, reply_share=0.3, disabled_videos=(),
+                 results_per_query=200):
+        self.threads_per_video = threads_per_video
+        self.results_per_query = results_per_query
+        self.max_replies = max_replies
+        self.reply_share = reply_share
+        self.disabled_videos = set(disabled_videos)
+
+    def reply_count(self, video_id, thread_index):
+        rng = random.Random(f"{video_id}-{thread_index}")
+        if rng.random() >= self.reply_share:
+            return 0
+        return rng.randint(1, self.max_replies)
+
+    def published_at(self, index):
+        # Comment i is posted i minutes after the video, so order='time' is just the reverse index order
+        moment = datetime(2023, 5, 1, 12, 0, tzinfo=timezone.utc) + timedelta(minutes=index)
+        return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def comment(self, comment_id, text, published_at='2023-05-01T12:00:00Z'):
+        return {
+            'kind': 'youtube#comment',
+            'id': comment_id,
+            'snippet': {
+                'textDisplay': text,
+                'authorDisplayName': f"@user_{comment_id[-6:]}",
+                'likeCount': len(comment_id) % 7,
+                'publishedAt': published_at
+            }
+        }
+
+    def reply(self, parent_id, index):
+        return self.comment(f"{parent_id}.r{index:04d}", f"Reply {index} to {parent_id}")
+
+    def comment_threads(self, video_id, page_token, max_results, order='relevance', part='snippet'):
+        start = int(page_token or 0)
+        end = min(start + max_results, self.threads_per_video)
+        items = []
+        for position in range(start, end):
+            index = self.threads_per_video - 1 - position if order == 'time' else position
+            comment_id = f"{video_id}.t{index:06d}"
+            items.append({
+                'kind': 'youtube#commentThread',
+                'id': comment_id,
+                'snippet': {
+                    'videoId': video_id,
+                    'topLevelComment': self.comment(comment_id, f"Top level comment {index} on {video_id}",
+                                                    self.published_at(index)),
+                    'totalReplyCount': self.reply_count(video_id, index)
+                }
+            })
+            # Like the real API, part=replies brings along at most 5 replies of each thread
+            total_replies = items[-1]['snippet']['totalReplyCount']
+            if 'replies' in part.split(',') and total_replies:
+                items[-1]['replies'] = {'comments': [self.reply(comment_id, i) for i in range(min(5, total_replies))]}
+        response = {'kind': 'youtube#commentThreadListResponse', 'items': items}
+        if end < self.threads_per_video:
+            response['nextPageToken'] = str(end)
+        return response
+
+    def comments(self, parent_id, page_token, max_results):
+        video_id, thread = parent_id.rsplit('.t', 1)
+        total = self.reply_count(video_id, int(thread))
+        start = int(page_token or 0)
+        end = min(start + max_results, total)
+        items = [self.reply(parent_id, index) for index in range(start, end)]
+        response = {'kind': 'youtube#commentListResponse', 'items': items}
+        if end < total:
+            response['nextPageToken'] = str(end)
+        return response
+
+    def search(self, query, page_token, max_results):
+        # Queries overlap: the same video can be found by several of them
+        start = int(page_token or 0)
+        end = min(start + max_results, self.results_per_query)
+        seed = sum(query.encode('utf-8')) % 50
+        items = [{'kind': 'youtube#searchResult', 'id': {'kind': 'youtube#video', 'videoId': f"vid{seed + i:07d}"}}
+                 for i in range(start, end)]
+        response = {'kind': 'youtube#searchListResponse', 'items': items}
+        if end < self.results_per_query:
+            response['nextPageToken'] = str(end)
+        return response
+
+    def video(self, video_id):
+        rng = random.Random(video_id)
+        return {
+            'kind': 'youtube#video',
+            'id': video_id,
+            'snippet': {'title': f"Video {video_id}", 'channelTitle': f"Channel {rng.randint(1, 40)}",
+                        'categoryId': '25' if rng.random() < 0.8 else '22'},
+            'statistics': {'viewCount': str(rng.randint(100, 10 ** 7)), 'commentCount': str(rng.randint(0, 20000))},
+            'contentDetails': {'duration': f"PT{rng.randint(1, 59)}M{rng.randint(0, 59)}S"}
+        }
+
+    def respond(self, endpoint, params):
+        max_results = int(params.get('maxResults', 20))
+        if endpoint == 'search':
+            return self.search(params.get('q', ''), params.get('pageToken'), max_results)
+        if endpoint == 'videos':
+            return {'kind': 'youtube#videoListResponse',
+                    'items': [self.video(video_id) for video_id in params['id'].split(',')]}
+        if endpoint == 'commentThreads':
+            if params['videoId'] in self.disabled_videos:
+                raise FakeApiError(403, 'commentsDisabled')
+            return self.comment_threads(params['videoId'], params.get('pageToken'), max_results,
+                                        params.get('order', 'relevance'), params.get('part', 'snippet'))
+        if endpoint == 'comments':
+            return self.comments(params['parentId'], params.get('pageToken'), max_results)
+        return None
+
+
+class UpstreamYouTubeData:
+    """Forwards requests to the real API, to record fixtures from it"""
+
+    def __init__(self, api_key, api_root='https://youtube.googleapis.com/youtube/v3/'):
+        self.api_key = api_key
+        self.api_root = api_root
+
+    def respond(self, endpoint, params):
+        query = dict(params, key=self.api_key)
+        with urlopen(f"{self.api_root}{endpoint}?{urlencode(query)}") as response:
+            return json.loads(response.read())
+
+
+class RecordingYouTubeData:
+    """Wraps another data source and keeps every response, to be saved as a replay fixture"""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.fixtures = {}
+        self.lock = threading.Lock()
+
+    def respond(self, endpoint, params):
+        body = self.inner.respond(endpoint, params)
+        if body is not None:
+            with self.lock:
+                self.fixtures[request_key(endpoint, params)] = body
+        return body
+
+    def save(self, path):
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump(self.fixtures, f)
+
+
+class ReplayYouTubeData:
+    """Serves recorded responses; requests that were never recorded get a 404.
+
+    videos.list batches depend on which search finished first, so a batch that was not recorded as such
+    is answered from the videos recorded in other batches (unknown ids are left out, as the real API does).
+    """
+
+    def __init__(self, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            self.fixtures = json.load(f)
+        self.videos = {}
+        for key, body in self.fixtures.items():
+            if key.startswith('videos?'):
+                part = parse_qs(key.split('?', 1)[1]).get('part', [''])[0]
+                for item in body.get('items', []):
+                    self.videos[part, item['id']] = item
+
+    def respond(self, endpoint, params):
+        body = self.fixtures.get(request_key(endpoint, params))
+        if body is None and endpoint == 'videos':
+            items = [self.videos[params.get('part', ''), video_id] for video_id in params['id'].split(',')
+                     if (params.get('part', ''), video_id) in self.videos]
+            body = {'kind': 'youtube#videoListResponse', 'items': items} if items else None
+        return body
+
+
+class FakeYouTubeServer:
+    """Local stand-in for the YouTube Data API v3, served over HTTP with a fixed latency per request.
+
+    latency_jitter adds an exponentially distributed delay of that mean to every request (the long tail
+    of a real API). Before reaching the data source, error_rate of the requests are answered with a
+    transient 503, rate_limit_rate with a 429 rateLimitExceeded and forbidden_rate with a 403 of
+    forbidden_reason (userRateLimitExceeded is retried by the scripts, quotaExceeded stops them).
+    """
+
+    def __init__(self, data=None, latency=0.05, host='127.0.0.1', port=0, error_rate=0.0, seed=0,
+                 rate_limit_rate=0.0, forbidden_rate=0.0, forbidden_reason='userRateLimitExceeded',
+                 latency_jitter=0.0):
+        self.data = data or FakeYouTubeData()
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.forbidden_rate = forbidden_rate
+        self.forbidden_reason = forbidden_reason
+        self.random = random.Random(seed)
+        self.request_counts = {}
+        self.status_counts = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def api_endpoint(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                endpoint = url.path.rstrip('/').rsplit('/', 1)[-1]
+
+                with server.lock:
+                    server.request_counts[endpoint] = server.request_counts.get(endpoint, 0) + 1
+                    draw = server.random.random()
+                    delay = server.latency
+                    if server.latency_jitter:
+                        delay += server.random.expovariate(1 / server.latency_jitter)
+                time.sleep(delay)
+
+                status = 200
+                try:
+                    if draw < server.error_rate:
+                        raise FakeApiError(503, 'backendError')
+                    if draw < server.error_rate + server.rate_limit_rate:
+                        raise FakeApiError(429, 'rateLimitExceeded')
+                    if draw < server.error_rate + server.rate_limit_rate + server.forbidden_rate:
+                        raise FakeApiError(403, server.forbidden_reason)
+                    body = server.data.respond(endpoint, params)
+                    if body is None:
+                        raise FakeApiError(404, 'notFound')
+                except FakeApiError as e:
+                    status = e.status
+                    body = {'error': {'code': e.status, 'message': e.reason,
+                                      'errors': [{'reason': e.reason, 'message': e.reason}]}}
+
+                with server.lock:
+                    server.status_counts[status] = server.status_counts.get(status, 0) + 1
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
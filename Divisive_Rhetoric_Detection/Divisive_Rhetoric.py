@@ -1,29 +1,94 @@
-import openai
 import os
+import re
+import sys
 import json
+import time
+import asyncio
 import argparse
 import yaml
+from openai import AsyncOpenAI
 from tqdm import tqdm
-import time
-from typing import Dict, List, Optional
+from collections import Counter
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Shared_Utils'))
+from Inference_Engine import RateLimiter, estimate_tokens, run_ordered
+from LLM_Cache import LLMCache, DEFAULT_CACHE_PATH, cache_key
+from Prefilter import Prefilter
+from Metrics import get_metrics, error_outcome
+from Comment_Store import is_store, scan_comments, count_comments
+from Batch_Jobs import (batch_request, batch_parts, completion_text, read_batch_results, results_path_for,
+                        write_batch_files)
+
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Prompts')
+
+# Start of one text's answer in a packed response: "[3]", "3:", "ID 3", optionally followed by the answer
+PACKED_ID = re.compile(r'^\s*\[?\s*(?:ID\s*)?(\d+)\s*\]?\s*[:.)-]?\s*(.*)$', re.IGNORECASE)
+
+
+def load_prompt(name: str) -> str:
+    # newline='' keeps the prompt byte for byte, so the response cache keys do not change
+    with open(os.path.join(PROMPTS_DIR, f"{name}.txt"), 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+def chunks(items: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 class YouTubePropagandaInference:
+    # The prompt is in Prompts/: the technique definitions, and the request for one comment or for a pack
+    PROMPT_INSTRUCTION = load_prompt('definitions')
+    PROMPT_SINGLE = load_prompt('single')
+    PROMPT_PACKED = load_prompt('packed')
+
     def __init__(self, config_path: str):
         self.config_path = config_path
         self.load_config()
         self.setup_openai()
         self.error_count = 0
+        self.metrics = get_metrics()
         self.max_retries = 3
         self.retry_delay = 2  # seconds
+        self.max_tokens = 1000
+        self.temperature = 0.3
+        self.flush_every = self.model_config.get('flush_every', 50)  # results written between flushes
+        # Requests sent at the same time, and client-side limits matching the account's rate limits
+        self.max_in_flight = self.model_config.get('max_in_flight', 16)
+        self.rate_limiter = RateLimiter(self.model_config.get('requests_per_minute'),
+                                        self.model_config.get('tokens_per_minute'))
+        # Answers already paid for (by this script or the stance scripts) are reused from the shared cache
+        self.cache = None
+        if self.model_config.get('cache', True):
+            self.cache = LLMCache(self.model_config.get('cache_path', DEFAULT_CACHE_PATH),
+                                  max_bytes=self.model_config.get('cache_max_mb', 512) * 1024 * 1024)
+        self.in_flight = {}
+        self.shared_answers = 0
+        self.unlabelled = 0  # comments left out of the output after their API calls failed
+        # Comments labelled per request; above 1 the definitions are sent once for the whole pack
+        self.pack_size = self.model_config.get('pack_size', 1)
+        self.pack_stats = Counter()
+        # Emoji-only, timestamp, very short and non-English comments are labelled locally, without a request
+        self.prefilter = None
+        if self.model_config.get('prefilter', False):
+            self.prefilter = Prefilter(self.model_config.get('prefilter_rules'))
 
     def setup_openai(self) -> None:
         """Setup OpenAI credentials with error checking"""
         try:
-            openai.organization = os.environ["OPENAI_ORGANIZATION"]
-            openai.api_key = os.getenv("OPENAI_API_KEY")
-            if not openai.api_key:
+            organization = os.environ["OPENAI_ORGANIZATION"]
+            api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
                 raise ValueError("OpenAI API key not found in environment variables")
+            # Retries are handled by inference(), so the client itself does not retry
+            self.client = AsyncOpenAI(api_key=api_key, organization=organization,
+                                      base_url=self.model_config.get('api_base'), max_retries=0)
         except Exception as e:
             print(f"Error setting up OpenAI credentials: {str(e)}")
             raise
@@ -44,65 +109,263 @@ class YouTubePropagandaInference:
 
     def prompt_gen(self, input_text: str) -> str:
         """Generate prompt with the same propaganda techniques definitions"""
-      
-        prompt_instruction = """You are a multi-label text classifier identifying propaganda techniques within text. These are the propaganda techniques you classify with definitions and examples:
-                                Loaded_Language - Emotional words and phrases intended to influence audience feelings and reactions.
-                                Name_Calling,Labeling - Attaching labels or names to discredit or praise without substantive argument.
-                                Repetition - Multiple restatements of the same message (or word) to reinforce acceptance.
-                                Exaggeration,Minimisation - Presenting issues as either much worse or much less significant than reality.
-                                Appeal_to_fear-prejudice - Creating anxiety or panic about potential consequences to gain support.
-                                Flag-Waving - Exploiting group identity (national, racial, gender, political or religious) to promote a position.
-                                Causal_Oversimplification - Reducing complex issues to a single cause when multiple factors exist.
-                                Appeal_to_Authority - Using expert or authority claims to support an argument without additional evidence.
-                                Slogans/Thought-terminating_Cliches - Striking ready-made phrases that use simplification and common-sense stereotypes to discourage critical thinking.
-                                Whataboutism,Straw_Men - Deflecting criticism by pointing to opponent's alleged hypocrisy.
-                                Black-and-White_Fallacy - Presenting complex issues as having only two possible outcomes, or one solution as the only possible one.
-                                Bandwagon,Reductio_ad_hitlerum - Promoting ideas based on popularity or rejecting them by negative association.
-                                Doubt - Undermining credibility through questioning motives or expertise.
-                                Appeal_to_Time - Using deadlines or temporal arguments to create urgency or dismiss current concerns."""
-      
-        prompt_base = """For the given text please state which of the propaganda techniques are present. If no propaganda technique was identified return "no propaganda detected". An example output would list the propaganda techniques with each technique in a new line, e.g.:
-                      Loaded_Language
-                      Thought-terminating_Cliches
-                      Repetition
-                      Here is the text:"""
-
-        return f'{prompt_instruction} {prompt_base} <{input_text}>'
-
-    def inference(self, prompt: str) -> str:
-        """Make API call with robust error handling and retries"""
+        return f'{self.PROMPT_INSTRUCTION} {self.PROMPT_SINGLE} <{input_text}>'
+
+    def packed_prompt_gen(self, input_texts: List[str]) -> Tuple[str, str]:
+        """System and user messages labelling several texts at once, each tagged with its position as ID"""
+        # Line breaks inside a comment would be taken for the end of its text
+        user_text = '\n'.join(f"[{index}] <{' '.join(text.split())}>" for index, text in enumerate(input_texts, 1))
+        return f'{self.PROMPT_INSTRUCTION} {self.PROMPT_PACKED}', user_text
+
+    def parse_packed_output(self, output: str, n_texts: int) -> Dict[int, str]:
+        """Split a packed answer into the answer of each ID; IDs missing or without a valid answer are left out"""
+        blocks = {}
+        current = None
+        for line in output.split('\n'):
+            match = PACKED_ID.match(line)
+            if match and 1 <= int(match.group(1)) <= n_texts:
+                current = int(match.group(1))
+                blocks[current] = [match.group(2)]
+            elif current is not None:
+                blocks[current].append(line)
+
+        answers = {}
+        for index, lines in blocks.items():
+            answer = '\n'.join(line.strip() for line in lines if line.strip())
+            # Same validation as single answers: at least one known technique, or an explicit "no propaganda"
+            if self.process_output(answer) or answer.lower() == 'no propaganda detected':
+                answers[index] = answer
+        return answers
+
+    async def request_completion(self, system_message: str, user_text: str) -> Optional[str]:
+        """Make API call with robust error handling and retries; None when no usable answer came back"""
         for attempt in range(self.max_retries):
+            sent = None
             try:
-                # Split the prompt into system and user messages
-                prompt_parts = prompt.split("Here is the text:")
-                system_message = prompt_parts[0].strip()
-                user_text = prompt_parts[1].strip()
-
-                completion = openai.ChatCompletion.create(
+                # Prompt and max_tokens both count against the tokens per minute limit
+                reserved = estimate_tokens(system_message) + estimate_tokens(user_text) + self.max_tokens
+                await self.rate_limiter.acquire(reserved)
+                sent = time.perf_counter()
+                completion = await self.client.chat.completions.create(
                     model=self.model_config['model_name'],
                     messages=[
                         {"role": "system", "content": system_message},
                         {"role": "user", "content": user_text}
                     ],
-                    max_tokens=1000,
-                    temperature=0.3,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
                 )
+                self.metrics.request('chat.completions', time.perf_counter() - sent)
+                self.metrics.completion(self.model_config['model_name'], completion.usage)
+                if completion.usage is not None:
+                    self.rate_limiter.settle(reserved, completion.usage.total_tokens)
 
-                if hasattr(completion.choices[0], 'message') and 'content' in completion.choices[0].message:
-                    return completion.choices[0].message['content']
+                if completion.choices and completion.choices[0].message.content is not None:
+                    return completion.choices[0].message.content
                 else:
                     print(f"Unexpected response format: {completion}")
-                    return "no propaganda detected"
+                    return None
 
             except Exception as e:
+                if sent is not None:
+                    self.metrics.request('chat.completions', time.perf_counter() - sent, error_outcome(e))
                 print(f"Attempt {attempt + 1} failed with error: {str(e)}")
                 if attempt < self.max_retries - 1:
                     print(f"Retrying in {self.retry_delay} seconds...")
-                    time.sleep(self.retry_delay)
+                    self.metrics.retry('chat.completions', error_outcome(e), self.retry_delay)
+                    await asyncio.sleep(self.retry_delay)
                 else:
                     self.error_count += 1
                     print(f"All retries failed. Total errors: {self.error_count}")
-                    return "no propaganda detected"
+                    self.metrics.log('request_failed', endpoint='chat.completions', error=str(e)[:200])
+                    return None
+
+    def split_prompt(self, prompt: str) -> Tuple[str, str]:
+        """Split the prompt into system and user messages"""
+        prompt_parts = prompt.split("Here is the text:")
+        return prompt_parts[0].strip(), prompt_parts[1].strip()
+
+    def prefilter_reason(self, comment: Dict) -> Optional[str]:
+        """Rule of the prefilter that labels the comment "no propaganda detected" without an API call, or None"""
+        return self.prefilter.check(comment['CommentText']) if self.prefilter is not None else None
+
+    @staticmethod
+    def result(comment: Dict, techniques: List[str], prefilter: Optional[str] = None) -> Dict:
+        """Output record of a comment; labels given by the prefilter are marked with its rule, so they are
+        not taken for the model's (e.g. by Prefilter_Eval.py)"""
+        record = {'CommentID': comment['CommentID'], 'CommentText': comment['CommentText'], 'Techniques': techniques}
+        if prefilter is not None:
+            record['Prefilter'] = prefilter
+        return record
+
+    def prompt_key(self, system_message: str, user_text: str) -> str:
+        return cache_key(self.model_config['model_name'], system_message, user_text,
+                         max_tokens=self.max_tokens, temperature=self.temperature)
+
+    async def inference(self, prompt: str) -> Optional[str]:
+        """Answer from the response cache, or from the API (then cached); None when the API call failed"""
+        system_message, user_text = self.split_prompt(prompt)
+        key = self.prompt_key(system_message, user_text)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        # An identical comment already waiting for its answer is not sent a second time
+        if key in self.in_flight:
+            self.shared_answers += 1
+            return await asyncio.shield(self.in_flight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        output = None
+        try:
+            output = await self.request_completion(system_message, user_text)
+            if output is not None and self.cache is not None:
+                self.cache.put(key, output, model=self.model_config['model_name'])
+        finally:
+            del self.in_flight[key]
+            future.set_result(output)
+        return output
+
+    async def process_comment(self, comment: Dict) -> Optional[Dict]:
+        """Label one comment; None when it cannot be processed"""
+        try:
+            reason = self.prefilter_reason(comment)
+            if reason is not None:
+                return self.result(comment, [], reason)
+            prompt = self.prompt_gen(comment['CommentText'])
+            output = await self.inference(prompt)
+            if output is None:
+                # Nothing is written for a failed call, so a resumed run (or --batch merge) labels it again
+                self.unlabelled += 1
+                return None
+            return self.result(comment, self.process_output(output))
+        except Exception as e:
+            print(f"Error processing comment {comment.get('CommentID', 'unknown')}: {str(e)}")
+            return None
+
+    async def process_pack(self, comments: List[Dict]) -> List[Optional[Dict]]:
+        """Label several comments with one request; comments whose answer cannot be parsed get a request of their own"""
+        model = self.model_config['model_name']
+        outputs = {}
+        keys = {}
+        reasons = {}
+        pending = []
+        for position, comment in enumerate(comments):
+            try:
+                reasons[position] = self.prefilter_reason(comment)
+                if reasons[position] is not None:
+                    keys[position] = None
+                    outputs[position] = "no propaganda detected"
+                    continue
+                system_message, user_text = self.packed_prompt_gen([comment['CommentText']])
+                keys[position] = cache_key(model, system_message, user_text, max_tokens=self.max_tokens,
+                                           temperature=self.temperature)
+                cached = self.cache.get(keys[position]) if self.cache is not None else None
+                if cached is not None:
+                    outputs[position] = cached
+                else:
+                    pending.append(position)
+            except Exception as e:
+                print(f"Error processing comment {comment.get('CommentID', 'unknown')}: {str(e)}")
+
+        if len(pending) > 1:
+            system_message, user_text = self.packed_prompt_gen([comments[position]['CommentText']
+                                                                for position in pending])
+            output = await self.request_completion(system_message, user_text)
+            self.pack_stats['packed_requests'] += 1
+            answers = self.parse_packed_output(output, len(pending)) if output is not None else {}
+            for index, position in enumerate(pending, 1):
+                if index in answers:
+                    outputs[position] = answers[index]
+                    if self.cache is not None:
+                        self.cache.put(keys[position], answers[index], model=model)
+            self.pack_stats['packed_comments'] += len(answers)
+
+        results = []
+        for position, comment in enumerate(comments):
+            if position not in keys:
+                results.append(None)
+            elif position in outputs:
+                results.append(self.result(comment, self.process_output(outputs[position]), reasons[position]))
+            else:
+                # Left out of the packed answer (or its answer could not be read): label it on its own. A comment
+                # alone in its pack was never packed, so it is not a fallback
+                if len(pending) > 1:
+                    self.pack_stats['single_fallbacks'] += 1
+                results.append(await self.process_comment(comment))
+        return results
+
+    async def process_comments(self, comments: Iterable[Dict], output_file, total: Optional[int] = None) -> int:
+        """Label comments with up to max_in_flight requests at once, appending each result in input order"""
+        written = 0
+        if self.pack_size > 1:
+            work, worker = chunks(comments, self.pack_size), self.process_pack
+        else:
+            work, worker = comments, self.process_comment
+        with tqdm(total=total) as progress:
+            async for _, output in run_ordered(work, worker, self.max_in_flight):
+                for result in (output if self.pack_size > 1 else [output]):
+                    if result is not None:
+                        json.dump(result, output_file)
+                        output_file.write('\n')
+                        written += 1
+                        if written % self.flush_every == 0:
+                            output_file.flush()
+                    progress.update(1)
+        output_file.flush()
+        await self.client.close()
+        return written
+
+    def input_files(self) -> List[str]:
+        """The input file, or every .jsonl file of the input folder (e.g. the scraper's comments_*.jsonl)"""
+        input_path = self.model_config['input_data_path']
+        if os.path.isdir(input_path):
+            return [os.path.join(input_path, name) for name in sorted(os.listdir(input_path)) if name.endswith('.jsonl')]
+        return [input_path]
+
+    def input_comments(self) -> Iterator[Dict]:
+        input_path = self.model_config['input_data_path']
+        if is_store(input_path):
+            # Only the two columns used, and only the partitions and row groups input_filter can match
+            yield from scan_comments(input_path, columns=['CommentID', 'CommentText'],
+                                     where=self.model_config.get('input_filter'))
+            return
+        for path in self.input_files():
+            with open(path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def read_comments(self, done_ids: Set[str]) -> Iterator[Dict]:
+        """Read the input file (or comment store) lazily, skipping the comments already in the output"""
+        for comment in self.input_comments():
+            if comment.get('CommentID') in done_ids:
+                continue
+            yield comment
+
+    def load_done_ids(self) -> Set[str]:
+        """CommentIDs already saved by a previous run; a line cut short by a crash is removed"""
+        done_ids = set()
+        output_path = self.model_config['output_path']
+        if not os.path.exists(output_path):
+            return done_ids
+
+        complete_size = 0
+        with open(output_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    done_ids.add(json.loads(line)['CommentID'])
+                except (ValueError, KeyError):
+                    break
+                complete_size += len(line)
+        if complete_size < os.path.getsize(output_path):
+            print(f"Removing an incomplete last result from {output_path}")
+            with open(output_path, 'r+b') as f:
+                f.truncate(complete_size)
+        return done_ids
 
     def process_output(self, output: str) -> List[str]:
         """Process model output with validation"""
@@ -132,50 +395,150 @@ class YouTubePropagandaInference:
             # Ensure output directory exists
             os.makedirs(os.path.dirname(self.model_config['output_path']), exist_ok=True)
 
-            # Read and validate input data
+            # Results of a previous (interrupted) run are kept and their comments skipped
+            done_ids = set()
+            if self.model_config.get('resume', True):
+                done_ids = self.load_done_ids()
+                if done_ids:
+                    print(f"Resuming: {len(done_ids)} comments already labelled in {self.model_config['output_path']}")
+
+            # A store counts its comments from the Parquet metadata; JSONL files are not read twice just to count
+            # their lines, so the progress bar then shows the comments done and the rate without a total
             try:
-                with open(self.model_config['input_data_path'], 'r') as f:
-                    comments = [json.loads(line) for line in f]
+                input_path = self.model_config['input_data_path']
+                if is_store(input_path):
+                    total = count_comments(input_path, self.model_config.get('input_filter'))
+                    description = f"{total} comments"
+                    total = max(0, total - len(done_ids))
+                else:
+                    total = None
+                    size = sum(os.path.getsize(path) for path in self.input_files())
+                    description = f"{size / 1e6:.1f} MB of comments"
             except Exception as e:
                 print(f"Error reading input file: {str(e)}")
                 raise
 
-            results = []
-            print(f"Processing {len(comments)} comments...")
-
-            for comment in tqdm(comments):
-                try:
-                    prompt = self.prompt_gen(comment['CommentText'])
-                    output = self.inference(prompt)
-                    techniques = self.process_output(output)
-
-                    results.append({
-                        'CommentID': comment['CommentID'],
-                        'CommentText': comment['CommentText'],
-                        'Techniques': techniques
-                    })
-                except Exception as e:
-                    print(f"Error processing comment {comment.get('CommentID', 'unknown')}: {str(e)}")
-                    continue
-
-            # Save results
+            # Comments are read lazily and each result is appended as soon as it is ready
+            print(f"Processing {description} ({self.max_in_flight} requests in flight)...")
             try:
-                with open(self.model_config['output_path'], 'w') as f:
-                    for result in results:
-                        json.dump(result, f)
-                        f.write('\n')
+                with open(self.model_config['output_path'], 'a' if done_ids else 'w') as output_file:
+                    written = asyncio.run(self.process_comments(self.read_comments(done_ids), output_file,
+                                                                total=total))
             except Exception as e:
                 print(f"Error saving results: {str(e)}")
                 raise
 
+            print(f"{written} new results")
             print(f"Results saved to {self.model_config['output_path']}")
+            if self.cache is not None:
+                print(f"Response cache: {self.cache}")
+                self.cache.close()
+            if self.pack_size > 1:
+                print(f"Packed requests: {self.pack_stats['packed_requests']} answering "
+                      f"{self.pack_stats['packed_comments']} comments, "
+                      f"{self.pack_stats['single_fallbacks']} comments labelled on their own")
+            if self.shared_answers:
+                print(f"{self.shared_answers} duplicate comments shared an answer already in flight")
+            if self.prefilter is not None:
+                print(f"Prefilter: {self.prefilter}, no API call made for them")
             if self.error_count > 0:
                 print(f"Total API errors encountered: {self.error_count}")
+            if self.unlabelled:
+                print(f"{self.unlabelled} comments were not labelled (failed API calls); launch the script again "
+                      f"to label them, the comments already labelled are skipped")
 
         except Exception as e:
             print(f"Critical error in save_results: {str(e)}")
             raise
 
+    def batch_path(self) -> str:
+        default_path = os.path.splitext(self.model_config['output_path'])[0] + '_batch.jsonl'
+        return self.model_config.get('batch_path') or default_path
+
+    def build_batch(self) -> None:
+        """Write the comments still to label as a Batch API request file (custom_id = CommentID)"""
+        done_ids = self.load_done_ids() if self.model_config.get('resume', True) else set()
+        skipped = Counter()
+        seen_keys = set()
+
+        def requests():
+            for comment in self.read_comments(done_ids):
+                if self.prefilter_reason(comment) is not None:
+                    skipped['prefilter'] += 1
+                    continue
+                system_message, user_text = self.split_prompt(self.prompt_gen(comment['CommentText']))
+                key = self.prompt_key(system_message, user_text)
+                # Answers already cached, or requested for an identical comment, are filled in at merge time
+                if key in seen_keys or (self.cache is not None and self.cache.get(key) is not None):
+                    skipped['cached_or_duplicate'] += 1
+                    continue
+                seen_keys.add(key)
+                yield batch_request(comment['CommentID'], {
+                    'model': self.model_config['model_name'],
+                    'messages': [
+                        {"role": "system", "content": system_message},
+                        {"role": "user", "content": user_text}
+                    ],
+                    'max_tokens': self.max_tokens,
+                    'temperature': self.temperature,
+                })
+                skipped['requests'] += 1
+
+        os.makedirs(os.path.dirname(self.batch_path()) or '.', exist_ok=True)
+        parts = write_batch_files(requests(), self.batch_path())
+        if self.cache is not None:
+            self.cache.close()
+        if not parts:
+            print("Nothing to submit: every comment is already labelled or cached, run --batch merge")
+            return
+        print(f"{skipped['requests']} requests written to {', '.join(parts)} "
+              f"({skipped['cached_or_duplicate']} comments answered from the cache or by an identical comment, "
+              f"{skipped['prefilter']} labelled locally by the prefilter)")
+        print(f"Next: python ../Shared_Utils/Batch_Jobs.py {self.batch_path()}, then this script with --batch merge")
+
+    def merge_batch(self) -> None:
+        """Append the answers of the batch results files to output_path, in input order and in the usual schema"""
+        results_paths = [results_path_for(path) for path in batch_parts(self.batch_path())]
+        answers = {}
+        for custom_id, body in read_batch_results(results_paths):
+            answers[custom_id] = completion_text(body)
+            if answers[custom_id] is not None:
+                self.metrics.completion(self.model_config['model_name'], body.get('usage'), batch=True)
+        done_ids = self.load_done_ids() if self.model_config.get('resume', True) else set()
+
+        # Identical comments were requested once: the others get the answer of the first one (or of the cache)
+        by_key = {}
+        written = missing = 0
+        with open(self.model_config['output_path'], 'a' if done_ids else 'w') as output_file:
+            for comment in self.read_comments(done_ids):
+                system_message, user_text = self.split_prompt(self.prompt_gen(comment['CommentText']))
+                key = self.prompt_key(system_message, user_text)
+                output = answers.get(comment['CommentID'])
+                reason = self.prefilter_reason(comment)
+                if reason is not None:
+                    output = "no propaganda detected"
+                elif output is not None:
+                    by_key[key] = output
+                    if self.cache is not None:
+                        self.cache.put(key, output, model=self.model_config['model_name'])
+                else:
+                    output = by_key.get(key)
+                    if output is None and self.cache is not None:
+                        output = self.cache.get(key)
+                if output is None:
+                    missing += 1
+                    continue
+                json.dump(self.result(comment, self.process_output(output), reason), output_file)
+                output_file.write('\n')
+                written += 1
+
+        print(f"{written} results merged into {self.model_config['output_path']}")
+        if missing:
+            print(f"{missing} comments have no answer (failed or missing from the batch); "
+                  f"run the script without --batch to label them")
+        if self.cache is not None:
+            self.cache.close()
+
     def run_all(self) -> None:
         """Main execution method with error handling"""
         try:
@@ -188,11 +551,18 @@ class YouTubePropagandaInference:
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config_path', help="Specify the path to model config yaml file", required=True)
+    parser.add_argument('--batch', choices=['build', 'merge'], default=None,
+                        help="Write a Batch API request file, or merge its results, instead of calling the API")
     args = parser.parse_args()
 
     try:
         inference = YouTubePropagandaInference(args.config_path)
-        inference.run_all()
+        if args.batch == 'build':
+            inference.build_batch()
+        elif args.batch == 'merge':
+            inference.merge_batch()
+        else:
+            inference.run_all()
     except Exception as e:
         print(f"Program failed: {str(e)}")
         exit(1)
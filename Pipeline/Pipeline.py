@@ -0,0 +1,588 @@
+import os
+import csv
+import sys
+import json
+import time
+import shutil
+import hashlib
+import sqlite3
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRAPING_DIR = os.path.join(ROOT, 'Scraping_Scripts')
+RHETORIC_DIR = os.path.join(ROOT, 'Divisive_Rhetoric_Detection')
+STANCE_DIR = os.path.join(ROOT, 'Stance_Detection')
+ANALYSIS_DIR = os.path.join(ROOT, 'Analysis')
+
+sys.path.append(SCRAPING_DIR)
+from Checkpoint_Store import VideoCheckpoint
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline.yaml')
+STATE_DIR_NAME = '.pipeline'
+HASH_CHUNK = 1 << 20
+
+# Stages in the order of the workflow; each one starts once the stages it depends on are done
+STAGE_NAMES = ['discovery', 'scrape', 'parent_join', 'rhetoric', 'stance', 'analytics']
+
+# Settings that change how fast a stage runs, not what it writes: left out of the fingerprints
+RUNTIME_KEYS = {'max_in_flight', 'requests_per_minute', 'tokens_per_minute', 'flush_every', 'cache', 'cache_max_mb',
+                'cache_path', 'workers', 'video_workers', 'reply_workers', 'quota_limit', 'api_base',
+                'api_endpoint', 'verbose', 'resume', 'batch_path'}
+
+
+def fingerprint(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def folder_files(folder: str, prefix: str = '', suffix: str = '.jsonl') -> Dict[str, str]:
+    """{filename: path} of the files of folder with that prefix and suffix (none if the folder does not exist)"""
+    if not os.path.isdir(folder):
+        return {}
+    return {name: os.path.join(folder, name) for name in sorted(os.listdir(folder))
+            if name.startswith(prefix) and name.endswith(suffix)}
+
+
+def runtime_free(settings: Dict) -> Dict:
+    return {key: value for key, value in settings.items() if key not in RUNTIME_KEYS}
+
+
+class PipelineState:
+    """Fingerprints of the last successful run of every stage and partition, kept in work_dir/.pipeline.
+
+    File digests are remembered with the size and mtime of the file, so a file is only read again
+    (and hashed) after it changed.
+    """
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS file_digests (
+                                 path TEXT PRIMARY KEY,
+                                 size INTEGER NOT NULL,
+                                 mtime_ns INTEGER NOT NULL,
+                                 digest TEXT NOT NULL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS stages (
+                                 stage TEXT PRIMARY KEY,
+                                 fingerprint TEXT NOT NULL,
+                                 finished REAL NOT NULL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS partitions (
+                                 stage TEXT NOT NULL,
+                                 name TEXT NOT NULL,
+                                 fingerprint TEXT NOT NULL,
+                                 PRIMARY KEY (stage, name)) WITHOUT ROWID''')
+
+    def digest(self, path: str) -> str:
+        """Content hash of a file ('' for a file that does not exist)"""
+        if not os.path.isfile(path):
+            return ''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime_ns, digest FROM file_digests WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        content = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_CHUNK), b''):
+                content.update(block)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO file_digests (path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)',
+                              (path, stat.st_size, stat.st_mtime_ns, content.hexdigest()))
+        return content.hexdigest()
+
+    def stage_fingerprint(self, stage: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute('SELECT fingerprint FROM stages WHERE stage = ?', (stage,)).fetchone()
+        return row[0] if row else None
+
+    def partitions(self, stage: str) -> Dict[str, str]:
+        with self.lock:
+            return dict(self.conn.execute('SELECT name, fingerprint FROM partitions WHERE stage = ?', (stage,)))
+
+    def save(self, stage: str, stage_fingerprint: str, partitions: Optional[Dict[str, str]] = None,
+             removed: Sequence[str] = (), replace: bool = False) -> None:
+        """Record a successful run: its fingerprint and those of the partitions it ran on, in one transaction"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute('INSERT OR REPLACE INTO stages (stage, fingerprint, finished) VALUES (?, ?, ?)',
+                                  (stage, stage_fingerprint, time.time()))
+                if replace:
+                    self.conn.execute('DELETE FROM partitions WHERE stage = ?', (stage,))
+                self.conn.executemany('DELETE FROM partitions WHERE stage = ? AND name = ?',
+                                      [(stage, name) for name in removed])
+                self.conn.executemany('INSERT OR REPLACE INTO partitions (stage, name, fingerprint) VALUES (?, ?, ?)',
+                                      [(stage, name, value) for name, value in (partitions or {}).items()])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class Stage:
+    """One script of the workflow, launched once the stages in deps are done.
+
+    The fingerprint of a stage covers its settings, its prompt (and prompt-bearing code) files and the
+    content of its inputs. A partitioned stage (one input file per video) is fingerprinted per file, and
+    only the files that changed are given to the script, through a folder of links; a change of settings
+    or prompt runs it again on every file.
+    """
+
+    def __init__(self, name: str, deps: List[str], script: str, command: Callable[[Optional[str], bool], List[str]],
+                 settings: Optional[Dict] = None, inputs: Sequence[Tuple[str, str]] = (),
+                 prompt_files: Sequence[str] = (), partitions: Optional[Tuple[str, str]] = None,
+                 partition_output: Optional[Callable[[str], str]] = None,
+                 check: Optional[Callable[[], Optional[str]]] = None,
+                 unfinished: Optional[Callable[[], Optional[str]]] = None):
+        self.name = name
+        self.deps = deps
+        self.script = script
+        self.command = command                    # (partition folder or None, full run) -> script arguments
+        self.settings = settings or {}
+        self.inputs = inputs                      # (file or folder, filename prefix) of unpartitioned stages
+        self.prompt_files = prompt_files
+        self.partitions = partitions              # (folder, filename prefix) of the per-video input files
+        self.partition_output = partition_output  # output file of a partition, removed with it; None: run again in full
+        self.check = check                        # reason the stage cannot run, if any
+        self.unfinished = unfinished              # reason to run again although nothing changed, if any
+
+    def settings_fingerprint(self, state: PipelineState) -> str:
+        return fingerprint(self.name, runtime_free(self.settings),
+                           [(os.path.basename(path), state.digest(path)) for path in self.prompt_files])
+
+    def input_fingerprint(self, state: PipelineState) -> str:
+        contents = []
+        for path, prefix in self.inputs:
+            files = folder_files(path, prefix) if os.path.isdir(path) else {os.path.basename(path): path}
+            contents.append([(name, state.digest(file_path)) for name, file_path in files.items()])
+        return fingerprint(contents)
+
+
+class PipelineRunner:
+    """Runs the stages of a pipeline as a DAG: every stage whose dependencies are done is started, up to
+    `jobs` at the same time, and skipped when its fingerprint matches its last successful run"""
+
+    def __init__(self, stages: List[Stage], work_dir: str, jobs: int = 2, force: Sequence[str] = (),
+                 dry_run: bool = False):
+        self.stages = stages
+        self.state_dir = os.path.join(work_dir, STATE_DIR_NAME)
+        self.state = PipelineState(os.path.join(self.state_dir, 'state.sqlite'))
+        self.jobs = max(1, jobs)
+        self.force = set(force)
+        self.dry_run = dry_run
+        self.print_lock = threading.Lock()
+
+    def say(self, stage: str, message: str) -> None:
+        with self.print_lock:
+            print(f"[{stage}] {message}", flush=True)
+
+    def launch(self, stage: Stage, arguments: List[str]) -> int:
+        """Run the script, its output prefixed with the stage name and saved in .pipeline/logs/<stage>.log"""
+        log_dir = os.path.join(self.state_dir, 'logs')
+        os.makedirs(log_dir, exist_ok=True)
+        # Progress bars of stages running side by side are refreshed every 10 s instead of several times a second
+        env = dict(os.environ, PYTHONUNBUFFERED='1', TQDM_MININTERVAL='10')
+        # Each stage writes its own metrics (see Shared_Utils/Metrics.py), to watch a long stage while it runs
+        env.update(METRICS_SCRIPT=stage.name, METRICS_LOG=os.path.join(log_dir, f"{stage.name}.metrics.jsonl"),
+                   METRICS_FILE=os.path.join(self.state_dir, 'metrics', f"{stage.name}.prom"))
+        with open(os.path.join(log_dir, f"{stage.name}.log"), 'a', encoding='utf-8') as log:
+            log.write(f"\n=== {time.strftime('%Y-%m-%d %H:%M:%S')} {os.path.basename(stage.script)} "
+                      f"{' '.join(arguments)}\n")
+            process = subprocess.Popen([sys.executable, stage.script] + arguments, cwd=os.path.dirname(stage.script),
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env,
+                                       encoding='utf-8', errors='replace')
+            for line in process.stdout:
+                log.write(line)
+                if line.strip():
+                    self.say(stage.name, line.rstrip())
+            return process.wait()
+
+    def link_partitions(self, stage: Stage, files: Dict[str, str]) -> str:
+        """Folder with a link to each changed input file, given to the script instead of the whole folder"""
+        folder = os.path.join(self.state_dir, stage.name, 'changed')
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        for name, path in files.items():
+            try:
+                os.symlink(os.path.abspath(path), os.path.join(folder, name))
+            except OSError:  # no symlinks (e.g. Windows without the privilege): copy the file
+                shutil.copyfile(path, os.path.join(folder, name))
+        return folder
+
+    def run_stage(self, stage: Stage) -> Tuple[str, str]:
+        """('ran' | 'skipped' | 'failed', detail) of one stage"""
+        problem = stage.check() if stage.check else None
+        if problem:
+            return 'failed', problem
+        forced = stage.name in self.force or 'all' in self.force
+        settings = stage.settings_fingerprint(self.state)
+
+        if stage.partitions is None:
+            current = fingerprint(settings, stage.input_fingerprint(self.state))
+            reason = stage.unfinished() if stage.unfinished else None
+            if not forced and reason is None and self.state.stage_fingerprint(stage.name) == current:
+                return 'skipped', 'up to date'
+            detail = 'forced' if forced else reason or 'inputs or settings changed'
+            if self.dry_run:
+                return 'would run', detail
+            self.say(stage.name, f"running ({detail})")
+            if self.launch(stage, stage.command(None, True)) != 0:
+                return 'failed', 'the script stopped with an error (see its log)'
+            self.state.save(stage.name, current)
+            return 'ran', detail
+
+        folder, prefix = stage.partitions
+        files = folder_files(folder, prefix)
+        partitions = {name: fingerprint(settings, self.state.digest(path)) for name, path in files.items()}
+        known = self.state.partitions(stage.name)
+        removed = sorted(set(known) - set(partitions))
+        full = forced or self.state.stage_fingerprint(stage.name) != settings
+        if removed and stage.partition_output is None:
+            full = True
+        changed = sorted(partitions) if full else [name for name in sorted(partitions) if known.get(name) != partitions[name]]
+        if not changed and not removed:
+            return 'skipped', 'up to date' if partitions else f"no {prefix}*.jsonl files in {folder}"
+        if full:
+            detail = 'forced' if forced else ('settings or prompts changed' if known else 'first run')
+            detail += f", all {len(partitions)} files"
+        else:
+            detail = f"{len(changed)} of {len(partitions)} files new or changed, {len(removed)} removed"
+        if self.dry_run:
+            return 'would run', detail
+
+        self.say(stage.name, f"running ({detail})")
+        if changed:
+            source = None if full else self.link_partitions(stage, {name: files[name] for name in changed})
+            if self.launch(stage, stage.command(source, full)) != 0:
+                return 'failed', 'the script stopped with an error (see its log)'
+        for name in removed:
+            output = stage.partition_output(name) if stage.partition_output else None
+            if output and os.path.exists(output):
+                os.remove(output)
+        self.state.save(stage.name, settings, {name: partitions[name] for name in changed}, removed, replace=full)
+        return 'ran', detail
+
+    def run(self) -> Dict[str, Tuple[str, str, float]]:
+        """Run every stage once its dependencies are done; a stage after a failed one is blocked"""
+        names = {stage.name for stage in self.stages}
+        results = {}
+        pending = list(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                for stage in list(pending):
+                    # Dependencies not in this run are taken as done: their files are used as they are
+                    deps = [dep for dep in stage.deps if dep in names]
+                    if any(results[dep][0] in ('failed', 'blocked') for dep in deps if dep in results):
+                        pending.remove(stage)
+                        results[stage.name] = ('blocked', 'an earlier stage failed', 0.0)
+                        self.say(stage.name, 'blocked: an earlier stage failed')
+                    elif all(dep in results for dep in deps):
+                        pending.remove(stage)
+                        running[pool.submit(self.timed_stage, stage)] = stage
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    results[stage.name] = future.result()
+                    status, detail, seconds = results[stage.name]
+                    self.say(stage.name, f"{status} ({detail}, {seconds:.1f}s)")
+        return results
+
+    def timed_stage(self, stage: Stage) -> Tuple[str, str, float]:
+        start = time.perf_counter()
+        try:
+            status, detail = self.run_stage(stage)
+        except Exception as e:
+            status, detail = 'failed', f"{type(e).__name__}: {e}"
+        return status, detail, time.perf_counter() - start
+
+    def close(self) -> None:
+        self.state.close()
+
+
+def load_config(config_path: str) -> Dict:
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f) or {}
+    if not config.get('work_dir'):
+        raise ValueError(f"No work_dir in {config_path}")
+    return config
+
+
+def resolve(path: Optional[str], base_dir: str) -> Optional[str]:
+    """Paths of the pipeline config are relative to the folder of the config file"""
+    if not path:
+        return path
+    return os.path.normpath(os.path.join(base_dir, os.path.expanduser(path)))
+
+
+def write_yaml(path: str, content: Dict) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(content, f, sort_keys=False)
+    return path
+
+
+def missing_file(path: Optional[str], what: str) -> Optional[str]:
+    if not path or not os.path.exists(path):
+        return f"{what} not found: {path}"
+    return None
+
+
+def unfinished_videos(video_list: str, comments_dir: str, plan_day: Optional[int] = None) -> Optional[str]:
+    """Videos of the list the scraper has not finished (quota reached, crash), read from their checkpoints"""
+    with open(video_list, 'r', encoding='utf-8', newline='') as f:
+        rows = list(csv.DictReader(f))
+    if plan_day is not None:
+        rows = [row for row in rows if int(row.get('day') or 0) <= plan_day]
+    unfinished = 0
+    for row in rows:
+        checkpoint = VideoCheckpoint.load(comments_dir, row['video_id'])
+        if checkpoint is None:
+            # Without a checkpoint, a comments file was written before checkpoints existed and is complete
+            unfinished += not os.path.exists(os.path.join(comments_dir, f"comments_{row['video_id']}.jsonl"))
+        elif not checkpoint.completed:
+            unfinished += 1
+    return f"{unfinished} of {len(rows)} videos not finished" if unfinished else None
+
+
+def layout(config: Dict, base_dir: str) -> Dict[str, str]:
+    """Files of the pipeline under work_dir"""
+    work_dir = resolve(config['work_dir'], base_dir)
+    return {
+        'work_dir': work_dir,
+        'state_dir': os.path.join(work_dir, STATE_DIR_NAME),
+        'videos': os.path.join(work_dir, 'videos'),
+        'comments': os.path.join(work_dir, 'comments'),
+        'stance_inputs': os.path.join(work_dir, 'stance_inputs'),
+        'rhetoric_output': os.path.join(work_dir, 'rhetoric', 'rhetoric_labels.jsonl'),
+        'stance': os.path.join(work_dir, 'stance'),
+        'search_cache': os.path.join(work_dir, 'search_cache'),
+    }
+
+
+def youtube_key(config: Dict) -> Tuple[Optional[str], Optional[str]]:
+    """(API key, reason it cannot be used)"""
+    key = os.environ.get('YOUTUBE_API_KEY') or config.get('youtube_api_key')
+    if not key or key.startswith('ADD_'):
+        return None, "No YouTube API key: set youtube_api_key in the pipeline config or YOUTUBE_API_KEY"
+    return key, None
+
+
+def discovery_stage(config: Dict, section: Dict, paths: Dict[str, str], base_dir: str) -> Stage:
+    api_key, no_key = youtube_key(config)
+    topics_path = resolve(section.get('config'), base_dir) or os.path.join(SCRAPING_DIR, 'topics.yaml')
+    topics_config = {}
+    if os.path.exists(topics_path):
+        with open(topics_path, 'r', encoding='utf-8') as f:
+            topics_config = yaml.safe_load(f) or {}
+    topics_config['output_path'] = paths['videos']
+
+    def command(source, full):
+        os.makedirs(paths['videos'], exist_ok=True)
+        arguments = ['-c', write_yaml(os.path.join(paths['state_dir'], 'discovery', 'topics.yaml'), topics_config),
+                     '--api-key', api_key, '--cache-dir', paths['search_cache']]
+        if section.get('topics'):
+            arguments += ['--topics'] + list(section['topics'])
+        if section.get('api_endpoint'):
+            arguments += ['--api-endpoint', section['api_endpoint']]
+        if config.get('quota_ledger'):
+            arguments += ['--quota-ledger', resolve(config['quota_ledger'], base_dir)]
+        return arguments
+
+    return Stage('discovery', [], os.path.join(SCRAPING_DIR, 'Video_Identification.py'), command,
+                 settings={'topics': section.get('topics'),
+                           'search': {key: value for key, value in topics_config.items() if key != 'output_path'}},
+                 check=lambda: no_key or missing_file(topics_path, 'Topics file'))
+
+
+def scrape_stage(config: Dict, section: Dict, paths: Dict[str, str], base_dir: str) -> Stage:
+    api_key, no_key = youtube_key(config)
+    video_list = resolve(section.get('video_list'), base_dir)
+
+    def command(source, full):
+        arguments = ['--video-list', video_list, '--output', paths['comments'], '--api-key', api_key,
+                     '--quota-limit', str(section.get('quota_limit', 10000)),
+                     '--video-workers', str(section.get('video_workers', 1)),
+                     '--reply-workers', str(section.get('reply_workers', 1))]
+        if config.get('quota_ledger'):
+            arguments += ['--quota-ledger', resolve(config['quota_ledger'], base_dir)]
+        if section.get('api_endpoint'):
+            arguments += ['--api-endpoint', section['api_endpoint']]
+        if section.get('plan_day') is not None:
+            arguments += ['--plan-day', str(section['plan_day'])]
+        if section.get('delta'):
+            arguments.append('--delta')
+        return arguments
+
+    # The lists of discovery are annotated by hand (video_id, period, channel_leaning, Source) before scraping
+    return Stage('scrape', ['discovery'], os.path.join(SCRAPING_DIR, 'Comment_Scraper.py'), command,
+                 settings={key: value for key, value in section.items() if key != 'video_list'},
+                 inputs=[(video_list, '')],
+                 check=lambda: no_key or missing_file(video_list, 'Annotated video list (scrape: video_list)'),
+                 unfinished=lambda: unfinished_videos(video_list, paths['comments'], section.get('plan_day')))
+
+
+def parent_join_stage(config: Dict, section: Dict, paths: Dict[str, str], base_dir: str) -> Stage:
+    # Video titles for the top-level comments: the annotated list, then the lists of discovery
+    video_lists = [path for path in [resolve((config.get('scrape') or {}).get('video_list'), base_dir)] if path]
+
+    def command(source, full):
+        titles = video_lists + list(folder_files(paths['videos'], 'videos_', '.csv').values())
+        arguments = ['--comments', paths['comments'], '--output', paths['stance_inputs']]
+        return arguments + (['--video-list'] + titles if titles else [])
+
+    return Stage('parent_join', ['scrape'], os.path.join(SCRAPING_DIR, 'Parent_Join.py'), command,
+                 inputs=[(paths['comments'], 'comments_'), (paths['videos'], 'videos_')]
+                        + [(path, '') for path in video_lists],
+                 check=lambda: missing_file(paths['comments'], 'Comments folder'))
+
+
+def rhetoric_stage(config: Dict, section: Dict, paths: Dict[str, str], base_dir: str) -> Stage:
+    section = dict(section)
+    config_path = resolve(section.pop('config', None), base_dir) or os.path.join(RHETORIC_DIR, 'config.yaml')
+    settings = {}
+    if os.path.exists(config_path):
+        with open(config_path, 'r', encoding='utf-8') as f:
+            settings = yaml.safe_load(f) or {}
+    # Any key of the rhetoric config can be changed in the pipeline config; the paths are the pipeline's
+    settings.update(section)
+    for key in ['input_data_path', 'output_path', 'batch_path']:
+        settings.pop(key, None)
+
+    def command(source, full):
+        # A full run (first run, new settings or prompt) starts the output over; otherwise only the
+        # changed files are read, and the comments already labelled in them are skipped
+        run_config = dict(settings, input_data_path=source or paths['comments'],
+                          output_path=paths['rhetoric_output'], resume=not full)
+        return ['-c', write_yaml(os.path.join(paths['state_dir'], 'rhetoric', 'config.yaml'), run_config)]
+
+    # The prompt files only: a change to the rest of the script does not label every comment again
+    prompts_dir = os.path.join(RHETORIC_DIR, 'Prompts')
+    return Stage('rhetoric', ['scrape'], os.path.join(RHETORIC_DIR, 'Divisive_Rhetoric.py'), command,
+                 settings=settings, partitions=(paths['comments'], 'comments_'),
+                 prompt_files=[os.path.join(prompts_dir, name)
+                               for name in ('definitions.txt', 'single.txt', 'packed.txt')],
+                 check=lambda: missing_file(config_path, 'Rhetoric config'))
+
+
+def stance_stage(config: Dict, section: Dict, paths: Dict[str, str], base_dir: str) -> Stage:
+    topics = list(section.get('topics') or [])
+    prompts_dir = resolve(section.get('prompts_dir'), base_dir) or os.path.join(STANCE_DIR, 'Topic_Prompts')
+    prefilter_rules = resolve(section.get('prefilter_rules'), base_dir)
+
+    def command(source, full):
+        arguments = ['--topics'] + topics + ['-i', source or paths['stance_inputs'], '-o', paths['stance'],
+                                             '--prompts-dir', prompts_dir]
+        for key in ['workers', 'requests_per_minute', 'tokens_per_minute']:
+            if section.get(key) is not None:
+                arguments += ['--' + key.replace('_', '-'), str(section[key])]
+        if section.get('combined'):
+            arguments.append('--combined')
+        if section.get('prefilter'):
+            arguments.append('--prefilter')
+        if prefilter_rules:
+            arguments += ['--prefilter-rules', prefilter_rules]
+        return arguments
+
+    # What changes the answers only: the topic prompts, the model and decoding settings and the wording of
+    # combined requests (a change to the rest of the script does not label every comment again)
+    prompt_files = [os.path.join(prompts_dir, f"{topic}.txt") for topic in topics]
+    prompt_files += [os.path.join(STANCE_DIR, 'model.yaml')]
+    if section.get('combined'):
+        prompt_files += [os.path.join(STANCE_DIR, 'Combined_Prompt', name) for name in ('header.txt', 'footer.txt')]
+    prompt_files += [prefilter_rules] if prefilter_rules else []
+    return Stage('stance', ['parent_join'], os.path.join(STANCE_DIR, 'Stance_Engine.py'), command,
+                 settings={key: value for key, value in section.items() if key not in ('prompts_dir', 'prefilter_rules')},
+                 partitions=(paths['stance_inputs'], 'MAP_Precomments_'),
+                 partition_output=lambda name: os.path.join(paths['stance'], name.replace('MAP_Precomments_', 'Label_')),
+                 prompt_files=prompt_files,
+                 check=lambda: None if topics else "No topics in the stance section")
+
+
+def analytics_stage(config: Dict, section: Dict, paths: Dict[str, str], base_dir: str) -> Stage:
+    db_path = resolve(section.get('db'), base_dir) or os.path.join(paths['work_dir'], 'label_analytics.sqlite')
+
+    def command(source, full):
+        arguments = ['--db', db_path, 'update', '--metadata', paths['comments']]
+        if os.path.exists(paths['rhetoric_output']):
+            arguments += ['--rhetoric', paths['rhetoric_output']]
+        if os.path.isdir(paths['stance']):
+            arguments += ['--stance', paths['stance']]
+        return arguments
+
+    return Stage('analytics', ['scrape', 'rhetoric', 'stance'], os.path.join(ANALYSIS_DIR, 'Label_Analytics.py'),
+                 command, inputs=[(paths['comments'], 'comments_'), (paths['rhetoric_output'], ''),
+                                  (paths['stance'], 'Label_')],
+                 check=lambda: missing_file(paths['comments'], 'Comments folder'))
+
+
+STAGE_BUILDERS = {'discovery': discovery_stage, 'scrape': scrape_stage, 'parent_join': parent_join_stage,
+                  'rhetoric': rhetoric_stage, 'stance': stance_stage, 'analytics': analytics_stage}
+
+
+def build_stages(config: Dict, base_dir: str) -> List[Stage]:
+    """The stages that have a section in the pipeline config, in workflow order"""
+    paths = layout(config, base_dir)
+    return [STAGE_BUILDERS[name](config, config[name] or {}, paths, base_dir) for name in STAGE_NAMES if name in config]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the workflow from video discovery to the label analytics, "
+                                                 "running again only the stages (and files) that changed")
+    parser.add_argument('-c', '--config', default=DEFAULT_CONFIG_PATH, help="Pipeline YAML file")
+    parser.add_argument('--stages', nargs='+', default=None, choices=STAGE_NAMES,
+                        help="Only run these stages (the others' files are used as they are)")
+    parser.add_argument('--force', nargs='+', default=(), choices=STAGE_NAMES + ['all'],
+                        help="Run these stages again even if nothing changed")
+    parser.add_argument('--jobs', type=int, default=None, help="Stages run at the same time (default: jobs in the config)")
+    parser.add_argument('--dry-run', action='store_true', help="Only print which stages would run, and why")
+    args = parser.parse_args()
+
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    base_dir = os.path.dirname(os.path.abspath(args.config))
+    stages = build_stages(config, base_dir)
+    if args.stages:
+        stages = [stage for stage in stages if stage.name in args.stages]
+    if not stages:
+        print("No stage to run: add their sections to the pipeline config")
+        sys.exit(1)
+
+    runner = PipelineRunner(stages, resolve(config['work_dir'], base_dir), jobs=args.jobs or config.get('jobs', 2),
+                            force=args.force, dry_run=args.dry_run)
+    start = time.perf_counter()
+    try:
+        results = runner.run()
+    finally:
+        runner.close()
+
+    print(f"\nPipeline finished in {time.perf_counter() - start:.1f}s")
+    for stage in stages:
+        status, detail, seconds = results[stage.name]
+        print(f"  {stage.name:<12} {status:<10} {seconds:>8.1f}s  {detail}")
+    if any(status in ('failed', 'blocked') for status, _, _ in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
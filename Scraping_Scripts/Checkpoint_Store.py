@@ -0,0 +1,48 @@
+import os
+import json
+
+
+class VideoCheckpoint:
+    """Crawl progress of one video, kept next to its comments file so a restart resumes at the exact page"""
+
+    def __init__(self, path, state=None):
+        self.path = path
+        self.state = state or {
+            'page_token': None,       # next commentThreads page to request
+            'top_level_done': False,  # True once the last commentThreads page has been written
+            'reply_cursors': {},      # parent comment id -> {'thread_id', 'page_token'} of unfinished reply threads
+            'file_offset': 0,         # size of the comments file when this checkpoint was saved
+            'completed': False
+        }
+
+    @staticmethod
+    def path_for(output_path, video_id):
+        return os.path.join(output_path, f'comments_{video_id}.checkpoint.json')
+
+    @classmethod
+    def load(cls, output_path, video_id):
+        path = cls.path_for(output_path, video_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return cls(path, json.load(f))
+
+    @classmethod
+    def create(cls, output_path, video_id):
+        return cls(cls.path_for(output_path, video_id))
+
+    @property
+    def completed(self):
+        return self.state['completed']
+
+    @property
+    def finished(self):
+        # Every page has been written: nothing left at the top level and no reply thread half-done
+        return self.state['top_level_done'] and not self.state['reply_cursors']
+
+    def save(self):
+        # Write to a temporary file and swap it in, so a crash never leaves a truncated checkpoint
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
@@ -1,75 +1,284 @@
 import pandas as pd
 import os
 import json
-from googleapiclient.discovery import build
-import time
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-file_path = 'ADD_CSV_FILE_PATH_VIDEO_LIST'
-videos_df = pd.read_csv(file_path)
+from Checkpoint_Store import VideoCheckpoint
+from Quota_Ledger import QuotaLedger, DEFAULT_LEDGER_PATH
+from Request_Executor import RequestExecutor, QuotaExhausted, PermanentRequestError, get_youtube
 
+file_path = 'ADD_CSV_FILE_PATH_VIDEO_LIST'
 api_key = 'ADD_YOUTUBE_API_KEY'
-youtube = build('youtube', 'v3', developerKey=api_key)
-
 output_path = 'ADD_FOLDER_PATH_FOR_PROCESSED_FILES'
-os.makedirs(output_path, exist_ok=True)
+quota_limit = 10000
+
+# Counters of the current crawl, e.g. reply threads that did not need a comments.list call
+crawl_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def comment_row(comment, thread_id, video_id, parent_id, is_reply, video_metadata):
+    return {
+        'CommentID': comment['id'],
+        'ThreadID': thread_id,
+        'VideoID': video_id,
+        'ParentCommentID': parent_id,
+        'CommentText': comment['snippet']['textDisplay'],
+        'AuthorName': comment['snippet']['authorDisplayName'],
+        'NumberOfLikes': comment['snippet']['likeCount'],
+        'IsReply': 'True' if is_reply else 'False',
+        'Timestamp': comment['snippet']['publishedAt'],
+        'Period': video_metadata['period'],
+        'ChannelLeaning': video_metadata['channel_leaning'],
+        'Source': video_metadata['Source']
+    }
+
+
+def inline_replies(item, use_inline=True):
+    """Replies returned inside a commentThreads item, or None when comments.list is still needed for them"""
+    inline = item.get('replies', {}).get('comments', [])
+    if use_inline and len(inline) >= item['snippet']['totalReplyCount']:
+        with _stats_lock:
+            crawl_stats['inline_reply_threads'] += 1
+        return inline
+    return None
+
+
+class VideoWriter:
+    """Appends rows to a video's comments file and saves the matching checkpoint under the same lock"""
+
+    def __init__(self, json_file, checkpoint):
+        self.json_file = json_file
+        self.checkpoint = checkpoint
+        self.lock = threading.Lock()
 
+    def write(self, rows, update=None):
+        # One write call per page, so lines from concurrent reply threads never interleave
+        with self.lock:
+            if rows:
+                self.json_file.write(''.join(json.dumps(row) + '\n' for row in rows))
+                self.json_file.flush()
+            if update is not None:
+                update(self.checkpoint.state)
+            self.checkpoint.state['file_offset'] = self.json_file.tell()
+            self.checkpoint.save()
 
-def fetch_replies(youtube, json_file, parent_id, thread_id, video_id, video_metadata):
-    page_token = None
+
+def fetch_replies(youtube, writer, parent_id, thread_id, video_id, video_metadata, executor, page_token=None,
+                  known_ids=None):
+    written = 0
     while True:
         try:
-            replies_response = youtube.comments().list(
+            replies_response = executor.execute(youtube.comments().list(
                 part='snippet',
                 parentId=parent_id,
                 maxResults=100,
                 pageToken=page_token,
                 textFormat='plainText'
-            ).execute()
-
-            for reply in replies_response.get('items', []):
-                json_file.write(json.dumps({
-                    'CommentID': reply['id'],
-                    'ThreadID': thread_id,
-                    'VideoID': video_id,
-                    'ParentCommentID': parent_id,
-                    'CommentText': reply['snippet']['textDisplay'],
-                    'AuthorName': reply['snippet']['authorDisplayName'],
-                    'NumberOfLikes': reply['snippet']['likeCount'],
-                    'IsReply': 'True',
-                    'Timestamp': reply['snippet']['publishedAt'],
-                    'Period': video_metadata['period'],
-                    'ChannelLeaning': video_metadata['channel_leaning'],
-                    'Source': video_metadata['Source']
-                }) + '\n')
-
-            page_token = replies_response.get('nextPageToken')
-            if not page_token:
-                break
-
+            ), 'comments.list')
+        except QuotaExhausted as e:
+            print(f"Quota exhausted ({e}). Stopping replies for {parent_id}.")
+            break
+        except PermanentRequestError as e:
+            # The parent comment is gone: there is nothing left to fetch in this thread
+            print(f"Skipping replies for parent comment {parent_id}: {e.reason}")
+            writer.write([], lambda state: state['reply_cursors'].pop(parent_id, None))
+            break
         except Exception as e:
+            # Retries did not help; the cursor stays in the checkpoint and the next run tries this thread again
             print(f"Error fetching replies for parent comment {parent_id}: {e}")
-            time.sleep(10)  # Wait if we hit an error (like quota limit)
             break
 
+        rows = [comment_row(reply, thread_id, video_id, parent_id, True, video_metadata)
+                for reply in replies_response.get('items', [])
+                if known_ids is None or reply['id'] not in known_ids]
+        page_token = replies_response.get('nextPageToken')
 
-# Track quota usage
-quota_used = 0
-quota_limit = 10000
-quota_file = os.path.join(output_path, 'quota_usage.txt')
+        def advance_cursor(state):
+            # Delta passes do not register cursors: their resume point is the index of known comments
+            if parent_id not in state['reply_cursors']:
+                return
+            if page_token:
+                state['reply_cursors'][parent_id]['page_token'] = page_token
+            else:
+                del state['reply_cursors'][parent_id]
+
+        writer.write(rows, advance_cursor)
+        written += len(rows)
+        if known_ids is not None:
+            known_ids.update(row['CommentID'] for row in rows)
+
+        if not page_token:
+            break
+
+    return written
+
+
+def _fetch_replies_task(api_key, api_endpoint, *args):
+    return fetch_replies(get_youtube(api_key, api_endpoint), *args)
 
-# Load previous quota if file exists
-if os.path.exists(quota_file):
-    with open(quota_file, 'r') as f:
-        quota_used = int(f.read().strip())
-    print(f"Resuming with quota usage: {quota_used}/{quota_limit}")
 
-for index, row in videos_df.iterrows():
+def run_reply_jobs(youtube, writer, reply_jobs, video_id, video_metadata, executor, api_key, api_endpoint,
+                   reply_pool, known_ids=None):
+    reply_args = [(writer, parent_id, thread_id, video_id, video_metadata, executor, page_token, known_ids)
+                  for parent_id, thread_id, page_token in reply_jobs]
+    if reply_pool is None:
+        return sum(fetch_replies(youtube, *args) for args in reply_args)
+    futures = [reply_pool.submit(_fetch_replies_task, api_key, api_endpoint, *args) for args in reply_args]
+    return sum(future.result() for future in futures)
+
+
+def open_video(output_path, video_id):
+    """Return the comments file and checkpoint for a video, or (None, None) if it is already done"""
+    comments_file_path = os.path.join(output_path, f'comments_{video_id}.jsonl')
+    checkpoint = VideoCheckpoint.load(output_path, video_id)
+
+    if checkpoint is None:
+        if os.path.exists(comments_file_path) and os.path.getsize(comments_file_path) > 0:
+            # Files written before checkpoints existed carry no progress information
+            print(f"Skipping already processed video (no checkpoint): {video_id}")
+            return None, None
+        checkpoint = VideoCheckpoint.create(output_path, video_id)
+        checkpoint.save()
+        return open(comments_file_path, 'w', encoding='utf-8'), checkpoint
+
+    if checkpoint.completed:
+        print(f"Skipping already processed video: {video_id}")
+        return None, None
+
+    # Drop anything written after the last checkpoint, then continue appending from there
+    with open(comments_file_path, 'a', encoding='utf-8') as f:
+        f.truncate(checkpoint.state['file_offset'])
+    print(f"Resuming video {video_id} from its checkpoint "
+          f"({len(checkpoint.state['reply_cursors'])} unfinished reply threads)")
+    return open(comments_file_path, 'a', encoding='utf-8'), checkpoint
+
+
+def scrape_video(row, position, total, output_path, executor, api_key, api_endpoint=None, reply_pool=None,
+                 use_inline=True):
     video_id = row['video_id']
 
     # Skip if we're close to quota limit
-    if quota_used >= quota_limit - 10:
-        print(f"Daily quota limit approaching: {quota_used}/{quota_limit}. Stopping.")
-        break
+    if executor.exhausted():
+        return 0
+
+    video_metadata = {
+        'period': row['period'],
+        'channel_leaning': row['channel_leaning'],
+        'Source': row['Source']
+    }
+
+    comments_file, checkpoint = open_video(output_path, video_id)
+    if comments_file is None:
+        return 0
+
+    print(f"Processing video {video_id} ({position}/{total})")
+
+    youtube = get_youtube(api_key, api_endpoint)
+    writer = VideoWriter(comments_file, checkpoint)
+    written = 0
+
+    with comments_file:
+        # Finish the reply threads that were interrupted last time before asking for new pages
+        pending = [(parent_id, cursor['thread_id'], cursor['page_token'])
+                   for parent_id, cursor in checkpoint.state['reply_cursors'].items()]
+        written += run_reply_jobs(youtube, writer, pending, video_id, video_metadata, executor,
+                                  api_key, api_endpoint, reply_pool)
+
+        page_token = checkpoint.state['page_token']
+        while not checkpoint.state['top_level_done']:
+            try:
+                # Asking for the replies part costs nothing extra and returns up to 5 replies per thread
+                top_level_comments_response = executor.execute(youtube.commentThreads().list(
+                    part='snippet,replies' if use_inline else 'snippet',
+                    videoId=video_id,
+                    maxResults=100,
+                    pageToken=page_token,
+                    order='relevance',
+                    textFormat='plainText'
+                ), 'commentThreads.list')
+            except QuotaExhausted as e:
+                print(f"Quota exhausted ({e}). Stopping.")
+                break
+            except PermanentRequestError as e:
+                # Comments disabled, video deleted or private: the video is done with whatever it has
+                print(f"Video {video_id} cannot be crawled: {e.reason}")
+                writer.write([], lambda state: state.update(top_level_done=True))
+                break
+            except Exception as e:
+                # Retries did not help; the checkpoint keeps this page for the next run
+                print(f"Error fetching comments for video {video_id}: {e}")
+                break
+
+            rows = []
+            reply_jobs = []
+            for item in top_level_comments_response.get('items', []):
+                thread_id = item['id']
+                top_level_comment = item['snippet']['topLevelComment']
+                rows.append(comment_row(top_level_comment, thread_id, video_id, '', False, video_metadata))
+
+                # Check if there are replies, and whether they all came inline
+                if item['snippet']['totalReplyCount'] > 0:
+                    replies = inline_replies(item, use_inline)
+                    if replies is None:
+                        reply_jobs.append((top_level_comment['id'], thread_id, None))
+                    else:
+                        rows.extend(comment_row(reply, thread_id, video_id, top_level_comment['id'], True,
+                                                video_metadata) for reply in replies)
+
+            page_token = top_level_comments_response.get('nextPageToken')
+
+            def advance_page(state):
+                state['page_token'] = page_token
+                state['top_level_done'] = not page_token
+                for parent_id, thread_id, _ in reply_jobs:
+                    state['reply_cursors'][parent_id] = {'thread_id': thread_id, 'page_token': None}
+
+            writer.write(rows, advance_page)
+            written += len(rows)
+
+            written += run_reply_jobs(youtube, writer, reply_jobs, video_id, video_metadata, executor,
+                                      api_key, api_endpoint, reply_pool)
+
+            # Check if we need to stop due to quota
+            if executor.exhausted():
+                print(f"Daily quota limit approaching: {executor.ledger}. Stopping.")
+                break
+
+        if checkpoint.finished:
+            writer.write([], lambda state: state.update(completed=True))
+
+    status = 'complete' if checkpoint.completed else 'partial, will resume from checkpoint'
+    print(f"Comments collected for video {video_id}: {written}, {status} (Quota used: {executor.ledger})")
+    return written
+
+
+def load_index(comments_file_path):
+    """Known CommentIDs, replies already stored per thread and newest Timestamp of a comments file"""
+    known_ids = set()
+    thread_replies = {}
+    newest = ''
+    with open(comments_file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            comment = json.loads(line)
+            known_ids.add(comment['CommentID'])
+            replies = thread_replies.setdefault(comment['ThreadID'], 0)
+            if comment['IsReply'] == 'True':
+                thread_replies[comment['ThreadID']] = replies + 1
+            newest = max(newest, comment['Timestamp'])
+    return known_ids, thread_replies, newest
+
+
+def delta_video(row, position, total, output_path, executor, api_key, api_endpoint=None, reply_pool=None,
+                use_inline=True):
+    """Append the comments posted since a video was scraped, newest first, stopping at the first known page"""
+    video_id = row['video_id']
+
+    if executor.exhausted():
+        return 0
 
     video_metadata = {
         'period': row['period'],
@@ -78,74 +287,162 @@ for index, row in videos_df.iterrows():
     }
 
     comments_file_path = os.path.join(output_path, f'comments_{video_id}.jsonl')
+    if not os.path.exists(comments_file_path):
+        print(f"Skipping video never scraped: {video_id}")
+        return 0
 
+    checkpoint = VideoCheckpoint.load(output_path, video_id)
+    if checkpoint is None:
+        # Scraped before checkpoints existed: treat the file as a complete crawl
+        checkpoint = VideoCheckpoint.create(output_path, video_id)
+        checkpoint.state.update(top_level_done=True, completed=True,
+                                file_offset=os.path.getsize(comments_file_path))
+        checkpoint.save()
+    elif not checkpoint.completed:
+        print(f"Skipping partially scraped video {video_id}: run without --delta to resume it first")
+        return 0
 
-    if os.path.exists(comments_file_path) and os.path.getsize(comments_file_path) > 0:
-        print(f"Skipping already processed video: {video_id}")
-        continue
+    known_ids, thread_replies, newest = load_index(comments_file_path)
+    print(f"Refreshing video {video_id} ({position}/{total}): {len(known_ids)} known comments, newest {newest}")
 
-    print(f"Processing video {video_id} ({index + 1}/{len(videos_df)})")
+    youtube = get_youtube(api_key, api_endpoint)
+    written = 0
 
-    with open(comments_file_path, 'w', encoding='utf-8') as comments_file:
+    with open(comments_file_path, 'a', encoding='utf-8') as comments_file:
+        writer = VideoWriter(comments_file, checkpoint)
         page_token = None
         while True:
             try:
-                # Update quota tracking (commentThreads.list = 1 unit)
-                quota_used += 1
-                with open(quota_file, 'w') as f:
-                    f.write(str(quota_used))
-
-                top_level_comments_response = youtube.commentThreads().list(
-                    part='snippet',
+                top_level_comments_response = executor.execute(youtube.commentThreads().list(
+                    part='snippet,replies' if use_inline else 'snippet',
                     videoId=video_id,
                     maxResults=100,
                     pageToken=page_token,
-                    order='relevance',
+                    order='time',
                     textFormat='plainText'
-                ).execute()
-
-                for item in top_level_comments_response.get('items', []):
-                    thread_id = item['id']
-                    top_level_comment = item['snippet']['topLevelComment']
-                    comment_id = top_level_comment['id']
-                    comments_file.write(json.dumps({
-                        'CommentID': comment_id,
-                        'ThreadID': thread_id,
-                        'VideoID': video_id,
-                        'ParentCommentID': '',
-                        'CommentText': top_level_comment['snippet']['textDisplay'],
-                        'AuthorName': top_level_comment['snippet']['authorDisplayName'],
-                        'NumberOfLikes': top_level_comment['snippet']['likeCount'],
-                        'IsReply': 'False',
-                        'Timestamp': top_level_comment['snippet']['publishedAt'],
-                        'Period': video_metadata['period'],
-                        'ChannelLeaning': video_metadata['channel_leaning'],
-                        'Source': video_metadata['Source']
-                    }) + '\n')
-
-                    # Check if there are replies
-                    if item['snippet']['totalReplyCount'] > 0:
-                        # Update quota tracking (comments.list = 1 unit)
-                        quota_used += 1
-                        with open(quota_file, 'w') as f:
-                            f.write(str(quota_used))
-
-                        fetch_replies(youtube, comments_file, comment_id, thread_id, video_id, video_metadata)
-
-                # Check if we need to stop due to quota
-                if quota_used >= quota_limit - 10:
-                    print(f"Daily quota limit approaching: {quota_used}/{quota_limit}. Stopping.")
-                    break
-
-                page_token = top_level_comments_response.get('nextPageToken')
-                if not page_token:
-                    break
-
+                ), 'commentThreads.list')
+            except QuotaExhausted as e:
+                print(f"Quota exhausted ({e}). Stopping.")
+                break
+            except PermanentRequestError as e:
+                print(f"Video {video_id} cannot be refreshed: {e.reason}")
+                break
             except Exception as e:
-                print(f"Error fetching comments for video {video_id}: {e}")
-                time.sleep(10)  # Wait if we hit an error (like quota limit)
+                print(f"Error refreshing comments for video {video_id}: {e}")
+                break
+
+            rows = []
+            reply_jobs = []
+            page_has_news = False
+            for item in top_level_comments_response.get('items', []):
+                thread_id = item['id']
+                top_level_comment = item['snippet']['topLevelComment']
+                comment_id = top_level_comment['id']
+
+                if comment_id not in known_ids:
+                    rows.append(comment_row(top_level_comment, thread_id, video_id, '', False, video_metadata))
+                    # Older comments we never saw (e.g. released from review) are stored, but do not keep us paging
+                    if top_level_comment['snippet']['publishedAt'] >= newest:
+                        page_has_news = True
+
+                # Only threads that gained replies since the last pass, and did not bring them all inline,
+                # need a comments.list call
+                if item['snippet']['totalReplyCount'] > thread_replies.get(thread_id, 0):
+                    replies = inline_replies(item, use_inline)
+                    if replies is None:
+                        reply_jobs.append((comment_id, thread_id, None))
+                    else:
+                        rows.extend(comment_row(reply, thread_id, video_id, comment_id, True, video_metadata)
+                                    for reply in replies if reply['id'] not in known_ids)
+                    page_has_news = True
+
+            writer.write(rows)
+            known_ids.update(row['CommentID'] for row in rows)
+            written += len(rows)
+
+            written += run_reply_jobs(youtube, writer, reply_jobs, video_id, video_metadata, executor,
+                                      api_key, api_endpoint, reply_pool, known_ids)
+
+            # Pages come newest first: once a page has nothing new, the rest is already stored
+            page_token = top_level_comments_response.get('nextPageToken')
+            if not page_has_news or not page_token:
                 break
 
-    print(f"Comments collected for video {video_id} (Quota used: {quota_used}/{quota_limit})")
+    print(f"New comments for video {video_id}: {written} (Quota used: {executor.ledger})")
+    return written
+
+
+def crawl(videos_df, output_path, api_key, quota_limit=10000, video_workers=1, reply_workers=1, api_endpoint=None,
+          ledger_path=DEFAULT_LEDGER_PATH, delta=False, use_inline=True):
+    """Scrape every video in videos_df; with more than one worker, videos and reply threads are fetched concurrently.
+
+    With delta=True, videos already scraped are refreshed with the comments posted since, instead.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    process_video = delta_video if delta else scrape_video
+    crawl_stats.clear()
+    quota = QuotaLedger(ledger_path, quota_limit)
+    executor = RequestExecutor(quota)
+
+    rows = [row for _, row in videos_df.iterrows()]
+    total = len(rows)
+
+    # Reply fetches get their own pool so a video worker waiting on its replies can never starve them
+    reply_pool = ThreadPoolExecutor(max_workers=reply_workers) if reply_workers > 1 else None
+    try:
+        if video_workers > 1:
+            with ThreadPoolExecutor(max_workers=video_workers) as video_pool:
+                futures = [video_pool.submit(process_video, row, position, total, output_path, executor,
+                                             api_key, api_endpoint, reply_pool, use_inline)
+                           for position, row in enumerate(rows, start=1)]
+                collected = sum(future.result() for future in futures)
+        else:
+            collected = sum(process_video(row, position, total, output_path, executor, api_key, api_endpoint,
+                                          reply_pool, use_inline)
+                            for position, row in enumerate(rows, start=1))
+
+        if executor.exhausted():
+            print(f"Daily quota limit reached: {quota}. Stopped before the end of the list.")
+        print("Requests by outcome: " + ', '.join(f"{key}={value}" for key, value in sorted(executor.summary().items())))
+        for endpoint, usage in quota.summary().items():
+            print(f"Quota spent today on {endpoint}: {usage['units']} units in {usage['calls']} calls")
+        # Every thread whose replies all came inline is one comments.list request (1 unit) not made
+        saved = crawl_stats['inline_reply_threads']
+        print(f"Reply threads complete inline: {saved} (saved {saved} requests and {saved} quota units)")
+    finally:
+        if reply_pool is not None:
+            reply_pool.shutdown()
+        quota.close()
+
+    return collected
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video-list', default=file_path, help="CSV file with the list of videos to crawl")
+    parser.add_argument('--output', default=output_path, help="Folder where the comments files are saved")
+    parser.add_argument('--api-key', default=api_key, help="YouTube Data API key")
+    parser.add_argument('--quota-limit', type=int, default=quota_limit, help="Daily quota units available")
+    parser.add_argument('--quota-ledger', default=DEFAULT_LEDGER_PATH, help="Quota ledger shared with Video_Identification.py")
+    parser.add_argument('--video-workers', type=int, default=1, help="Videos crawled at the same time")
+    parser.add_argument('--reply-workers', type=int, default=1, help="Reply threads fetched at the same time")
+    parser.add_argument('--api-endpoint', default=None, help="Alternative API root, e.g. a local fake server")
+    parser.add_argument('--plan-day', type=int, default=None,
+                        help="Treat --video-list as a Crawl_Scheduler.py plan and crawl it up to this day")
+    parser.add_argument('--delta', action='store_true',
+                        help="Refresh videos already scraped with the comments posted since, instead of new videos")
+    args = parser.parse_args()
+
+    videos_df = pd.read_csv(args.video_list)
+    if args.plan_day is not None:
+        # Earlier days first, so videos left unfinished on a previous day are picked up again
+        videos_df = videos_df[videos_df['day'] <= args.plan_day].sort_values('order')
+    crawl(videos_df, args.output, args.api_key, quota_limit=args.quota_limit,
+          video_workers=args.video_workers, reply_workers=args.reply_workers, api_endpoint=args.api_endpoint,
+          ledger_path=args.quota_ledger, delta=args.delta)
+
+    print("Data collection complete.")
+
 
-print("Data collection complete.")
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+import os
+import re
+import json
+import math
+import argparse
+import pandas as pd
+
+from Checkpoint_Store import VideoCheckpoint
+from Quota_Ledger import QuotaLedger
+
+# Used until some videos have been scraped and real reply statistics are available
+DEFAULT_STATS = {
+    'reply_share': 0.35,             # replies / all comments
+    'threads_with_replies': 0.15,    # share of top-level comments that have at least one reply
+    'reply_calls_per_thread': 0.4,   # comments.list calls per thread with replies (most come inline)
+    'capture_ratio': 0.9,            # comments actually returned by the API / commentCount
+}
+
+
+def video_id_from_url(url):
+    match = re.search(r'v=([\w-]{11})', str(url))
+    return match.group(1) if match else None
+
+
+# Replies that commentThreads returns inline with part='snippet,replies'
+INLINE_REPLIES = 5
+
+
+def reply_calls(reply_count):
+    # comments.list pages of 100 needed to collect the replies of one thread, none if they all came inline
+    if reply_count <= INLINE_REPLIES:
+        return 0
+    return math.ceil(reply_count / 100)
+
+
+def scraped_counts(output_path):
+    """Comment and reply-thread counts of every completed video in output_path"""
+    counts = {}
+    for filename in os.listdir(output_path):
+        if not (filename.startswith('comments_') and filename.endswith('.jsonl')):
+            continue
+        video_id = filename[len('comments_'):-len('.jsonl')]
+        checkpoint = VideoCheckpoint.load(output_path, video_id)
+        if checkpoint is not None and not checkpoint.completed:
+            continue  # partial videos would bias the averages
+
+        thread_replies = {}
+        with open(os.path.join(output_path, filename), 'r', encoding='utf-8') as f:
+            for line in f:
+                comment = json.loads(line)
+                replies = thread_replies.setdefault(comment['ThreadID'], 0)
+                if comment['IsReply'] == 'True':
+                    thread_replies[comment['ThreadID']] = replies + 1
+
+        reply_counts = [count for count in thread_replies.values() if count]
+        counts[video_id] = {
+            'top_level': len(thread_replies),
+            'replies': sum(reply_counts),
+            'threads_with_replies': len(reply_counts),
+            'reply_calls': sum(reply_calls(count) for count in reply_counts)
+        }
+    return counts
+
+
+def reply_stats(video_counts, advertised=None):
+    """Reply-density statistics pooled over a list of scraped videos, DEFAULT_STATS where there is no data.
+
+    advertised maps video ids to the commentCount the API reported for them, to measure the capture ratio.
+    """
+    stats = dict(DEFAULT_STATS)
+    top_level = sum(c['top_level'] for _, c in video_counts)
+    replies = sum(c['replies'] for _, c in video_counts)
+    threads_with_replies = sum(c['threads_with_replies'] for _, c in video_counts)
+    if top_level == 0:
+        return stats
+
+    stats['reply_share'] = replies / (top_level + replies)
+    stats['threads_with_replies'] = threads_with_replies / top_level
+    if threads_with_replies:
+        stats['reply_calls_per_thread'] = sum(c['reply_calls'] for _, c in video_counts) / threads_with_replies
+
+    # How many of the advertised comments the API really returned, for videos we know both numbers of
+    known = [(c['top_level'] + c['replies'], advertised[video_id]) for video_id, c in video_counts
+             if advertised and advertised.get(video_id, 0) > 0]
+    if known:
+        stats['capture_ratio'] = min(1.0, sum(s for s, _ in known) / sum(a for _, a in known))
+    return stats
+
+
+def group_stats(videos_df, counts, group_column, min_videos=2):
+    """Statistics per group (channel, Source...), falling back to the pooled ones for groups seen too little"""
+    advertised = {}
+    if 'comments' in videos_df.columns:
+        advertised = pd.to_numeric(videos_df.set_index('video_id')['comments'], errors='coerce').fillna(0).to_dict()
+
+    overall = reply_stats(list(counts.items()), advertised)
+    per_group = {}
+    if group_column in videos_df.columns:
+        groups = videos_df.set_index('video_id')[group_column].to_dict()
+        members = {}
+        for video_id, c in counts.items():
+            if video_id in groups:
+                members.setdefault(groups[video_id], []).append((video_id, c))
+        per_group = {group: reply_stats(video_counts, advertised)
+                     for group, video_counts in members.items() if len(video_counts) >= min_videos}
+    return overall, per_group
+
+
+def estimate(videos_df, overall, per_group=None, group_column=None):
+    """Add expected comments, quota units and comments per unit to every video"""
+    df = videos_df.copy()
+    if 'comments' not in df.columns:
+        df['comments'] = float('nan')
+    comments = pd.to_numeric(df['comments'], errors='coerce')
+
+    # Videos without a comment count get one from their views, at the list's median comments/views rate
+    if 'views' in df.columns:
+        views = pd.to_numeric(df['views'], errors='coerce')
+        known = (comments > 0) & (views > 0)
+        if known.any():
+            rate = (comments[known] / views[known]).median()
+            comments = comments.fillna(views * rate)
+    comments = comments.fillna(0)
+
+    if per_group and group_column in df.columns:
+        rows = [per_group.get(group, overall) for group in df[group_column]]
+    else:
+        rows = [overall] * len(df)
+    stats = pd.DataFrame(rows, index=df.index, columns=list(overall))
+
+    threads = comments * (1 - stats['reply_share'])
+    thread_calls = (threads / 100).apply(math.ceil).clip(lower=1)
+    reply_call_count = threads * stats['threads_with_replies'] * stats['reply_calls_per_thread']
+
+    df['est_comments'] = (comments * stats['capture_ratio']).round().astype(int)
+    df['est_units'] = (thread_calls + reply_call_count).apply(math.ceil).astype(int)
+    df['comments_per_unit'] = df['est_comments'] / df['est_units']
+    return df
+
+
+def plan_days(df, daily_quota=10000, margin=10, first_day_budget=None, max_days=None):
+    """Order videos by comments per unit and fill each day's quota, spilling large videos into the next day.
+
+    Because the yield of a video grows linearly with the pages fetched (and the scraper resumes mid-video
+    from its checkpoint), filling days greedily by comments per unit is the best split for a fixed quota.
+    """
+    day_budget = daily_quota - margin
+    df = df.sort_values(['comments_per_unit', 'est_comments'], ascending=False).reset_index(drop=True)
+
+    plan = []
+    day = 1
+    remaining = day_budget if first_day_budget is None else max(0, first_day_budget - margin)
+    for _, row in df.iterrows():
+        units_left = row['est_units']
+        first = True
+        while units_left > 0:
+            if remaining <= 0:
+                day += 1
+                remaining = day_budget
+            if max_days is not None and day > max_days:
+                break
+            units_today = min(units_left, remaining)
+            if first:
+                entry = row.to_dict()
+                entry['day'] = day
+                entry['est_units_day'] = units_today
+                plan.append(entry)
+                first = False
+            units_left -= units_today
+            remaining -= units_today
+        if max_days is not None and day > max_days:
+            break
+
+    plan_df = pd.DataFrame(plan)
+    if not plan_df.empty:
+        plan_df['order'] = range(1, len(plan_df) + 1)
+    return plan_df
+
+
+def pending_videos(videos_df, output_path):
+    """Videos that still have pages to fetch (no comments file yet, or a checkpoint that is not complete)"""
+    def is_done(video_id):
+        checkpoint = VideoCheckpoint.load(output_path, video_id)
+        if checkpoint is not None:
+            return checkpoint.completed
+        path = os.path.join(output_path, f'comments_{video_id}.jsonl')
+        return os.path.exists(path) and os.path.getsize(path) > 0
+
+    return videos_df[~videos_df['video_id'].apply(is_done)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video-list', required=True, help="CSV with the videos (comments and views columns used if present)")
+    parser.add_argument('--output', required=True, help="Folder of the comments files already scraped")
+    parser.add_argument('--plan', default='crawl_plan.csv', help="Where to write the multi-day crawl plan")
+    parser.add_argument('--daily-quota', type=int, default=10000)
+    parser.add_argument('--max-days', type=int, default=None)
+    parser.add_argument('--quota-ledger', default=None, help="Start day 1 with what is left of today's quota")
+    parser.add_argument('--group-by', default='channel', help="Column whose videos share reply statistics")
+    args = parser.parse_args()
+
+    videos_df = pd.read_csv(args.video_list)
+    if 'video_id' not in videos_df.columns:
+        videos_df['video_id'] = videos_df['url'].apply(video_id_from_url)
+
+    os.makedirs(args.output, exist_ok=True)
+    counts = scraped_counts(args.output)
+    overall, per_group = group_stats(videos_df, counts, args.group_by)
+    print(f"Reply statistics from {len(counts)} scraped videos: " +
+          ', '.join(f"{key}={value:.3f}" for key, value in overall.items()))
+    if per_group:
+        print(f"Separate statistics for {len(per_group)} groups of '{args.group_by}'")
+
+    first_day_budget = None
+    if args.quota_ledger:
+        with QuotaLedger(args.quota_ledger, args.daily_quota) as ledger:
+            first_day_budget = args.daily_quota - ledger.used_today()
+
+    todo = pending_videos(videos_df, args.output)
+    plan_df = plan_days(estimate(todo, overall, per_group, args.group_by), daily_quota=args.daily_quota,
+                        first_day_budget=first_day_budget, max_days=args.max_days)
+    plan_df.to_csv(args.plan, index=False)
+
+    if plan_df.empty:
+        print("Nothing left to crawl.")
+        return
+    for day, day_df in plan_df.groupby('day'):
+        print(f"Day {day}: {len(day_df)} videos, ~{day_df['est_units_day'].sum()} units, "
+              f"~{day_df['est_comments'].sum()} comments (started that day)")
+    print(f"Plan for {len(plan_df)} videos written to {args.plan}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import os
+import json
+import sqlite3
+import hashlib
+import argparse
+from collections import Counter
+from itertools import islice
+
+import pandas as pd
+
+from Crawl_Scheduler import video_id_from_url
+
+comments_path = 'ADD_FOLDER_PATH_OF_COMMENTS_FILES'
+output_path = 'ADD_FOLDER_PATH_FOR_STANCE_INPUTS'
+DEFAULT_INDEX_NAME = 'parent_index.sqlite'
+
+INSERT_BATCH = 10000   # comments written to the index per executemany
+LOOKUP_BATCH = 500     # parent ids looked up per query (under SQLite's limit of bound parameters)
+TAIL_BYTES = 4096      # bytes before the saved offset kept as a fingerprint of the indexed part of a file
+
+
+def comment_files(comments_dir):
+    return sorted(filename for filename in os.listdir(comments_dir)
+                  if filename.startswith('comments_') and filename.endswith('.jsonl'))
+
+
+def complete_lines(f, offset):
+    """(line, offset after it) for every complete line from offset; a line cut by a crash is left for later"""
+    f.seek(offset)
+    for line in f:
+        if not line.endswith(b'\n'):
+            break
+        offset += len(line)
+        yield line, offset
+
+
+def tail_at(path, offset):
+    with open(path, 'rb') as f:
+        return prefix_tail(f, offset)
+
+
+def prefix_tail(f, offset):
+    """Fingerprint of the TAIL_BYTES bytes before offset: changes when the indexed part of the
+    file is rewritten"""
+    start = max(0, offset - TAIL_BYTES)
+    f.seek(start)
+    return hashlib.sha256(f.read(offset - start)).hexdigest()
+
+
+class ParentIndex:
+    """On-disk CommentID -> CommentText index over every comments_*.jsonl file of a folder.
+
+    Files are indexed from the offset where the last update stopped, so comments appended by a
+    resumed or delta crawl are the only ones read again. The bytes before that offset are checked
+    against a fingerprint first: a file cut back to a checkpoint and written again by the scraper
+    is indexed again. Memory stays flat whatever the corpus size: comments go to SQLite in
+    batches and parents are looked up by batches of ids.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS comments (
+                                 id TEXT PRIMARY KEY,
+                                 text TEXT) WITHOUT ROWID''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS indexed_files (
+                                 filename TEXT PRIMARY KEY,
+                                 offset INTEGER NOT NULL,
+                                 tail TEXT)''')
+        # Indexes written before the fingerprint was kept
+        if 'tail' not in [row[1] for row in self.conn.execute('PRAGMA table_info(indexed_files)')]:
+            self.conn.execute('ALTER TABLE indexed_files ADD COLUMN tail TEXT')
+        # Size of each comments file when its stance input was last written
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS joined_files (
+                                 filename TEXT PRIMARY KEY,
+                                 size INTEGER NOT NULL)''')
+
+    def update(self, comments_dir):
+        """Add the comments written since the last update; returns the number of comments added"""
+        indexed = {filename: (offset, tail) for filename, offset, tail
+                   in self.conn.execute('SELECT filename, offset, tail FROM indexed_files')}
+        added = 0
+        for filename in comment_files(comments_dir):
+            path = os.path.join(comments_dir, filename)
+            offset, tail = indexed.get(filename, (0, None))
+            size = os.path.getsize(path)
+            with open(path, 'rb') as f:
+                if offset and not self.prefix_unchanged(f, offset, size, tail):
+                    # The file was started over or rewritten from a checkpoint: index it again (existing ids
+                    # are replaced) and write its stance input again
+                    offset = 0
+                    self.conn.execute('DELETE FROM joined_files WHERE filename = ?', (filename,))
+                if size == offset:
+                    continue
+
+                lines = complete_lines(f, offset)
+                while True:
+                    batch = list(islice(lines, INSERT_BATCH))
+                    if not batch:
+                        break
+                    rows = []
+                    for line, _ in batch:
+                        comment = json.loads(line)
+                        rows.append((comment['CommentID'], comment['CommentText']))
+                    # The rows and the new offset are written together, so a crash never indexes a line twice
+                    self.conn.execute('BEGIN IMMEDIATE')
+                    try:
+                        self.conn.executemany('INSERT OR REPLACE INTO comments (id, text) VALUES (?, ?)', rows)
+                        end = batch[-1][1]
+                        self.conn.execute('INSERT OR REPLACE INTO indexed_files (filename, offset, tail) '
+                                          'VALUES (?, ?, ?)', (filename, end, tail_at(path, end)))
+                        self.conn.execute('COMMIT')
+                    except Exception:
+                        self.conn.execute('ROLLBACK')
+                        raise
+                    added += len(rows)
+        return added
+
+    @staticmethod
+    def prefix_unchanged(f, offset, size, tail):
+        """Whether the file still holds the bytes indexed up to offset (indexes without a fingerprint
+        only check that offset follows a newline)"""
+        if size < offset:
+            return False
+        if tail is None:
+            f.seek(offset - 1)
+            return f.read(1) == b'\n'
+        return prefix_tail(f, offset) == tail
+
+    def lookup(self, comment_ids):
+        """{CommentID: CommentText} of the ids found in the index"""
+        found = {}
+        ids = list(set(comment_ids))
+        for start in range(0, len(ids), LOOKUP_BATCH):
+            chunk = ids[start:start + LOOKUP_BATCH]
+            query = f"SELECT id, text FROM comments WHERE id IN ({','.join('?' * len(chunk))})"
+            found.update(self.conn.execute(query, chunk))
+        return found
+
+    def joined_size(self, filename):
+        row = self.conn.execute('SELECT size FROM joined_files WHERE filename = ?', (filename,)).fetchone()
+        return row[0] if row else None
+
+    def mark_joined(self, filename, size):
+        self.conn.execute('INSERT OR REPLACE INTO joined_files (filename, size) VALUES (?, ?)', (filename, size))
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM comments').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def load_video_titles(video_lists):
+    """{video_id: title} from the video lists of Video_Identification.py (or any CSV with a title column)"""
+    titles = {}
+    for path in video_lists or []:
+        videos_df = pd.read_csv(path)
+        if 'title' not in videos_df.columns:
+            print(f"No title column in {path}, skipped")
+            continue
+        if 'video_id' in videos_df.columns:
+            video_ids = videos_df['video_id']
+        else:
+            video_ids = videos_df['url'].map(video_id_from_url)
+        titles.update((video_id, title) for video_id, title in zip(video_ids, videos_df['title'])
+                      if isinstance(video_id, str) and isinstance(title, str))
+    return titles
+
+
+def join_file(index, comments_file, output_file, titles, stats, chunk_size=LOOKUP_BATCH):
+    """Write the comments of one file with their ParentCommentText: the parent comment for replies,
+    the video title for top-level comments"""
+    tmp_path = output_file + '.tmp'
+    with open(comments_file, 'r', encoding='utf-8') as f, open(tmp_path, 'w', encoding='utf-8') as out:
+        while True:
+            raw_lines = list(islice(f, chunk_size))
+            if not raw_lines:
+                break
+            # A last line cut by a crash of the scraper is left out, as in the index
+            chunk = [json.loads(line) for line in raw_lines if line.strip() and line.endswith('\n')]
+            parents = index.lookup(comment['ParentCommentID'] for comment in chunk
+                                   if comment.get('IsReply') == 'True' and comment.get('ParentCommentID'))
+            lines = []
+            for comment in chunk:
+                parent_text = None
+                if comment.get('IsReply') == 'True':
+                    parent_text = parents.get(comment.get('ParentCommentID'))
+                    stats['replies'] += 1
+                    if parent_text is None:
+                        stats['parent_missing'] += 1
+                else:
+                    stats['top_level'] += 1
+                if parent_text is None:
+                    parent_text = titles.get(comment['VideoID'])
+                    if parent_text is None:
+                        stats['no_title'] += 1
+                if parent_text is not None:
+                    comment['ParentCommentText'] = parent_text
+                lines.append(json.dumps(comment) + '\n')
+            out.write(''.join(lines))
+    # Swapped in whole, so the stance scripts never read a half-written file
+    os.replace(tmp_path, output_file)
+
+
+def build_stance_inputs(comments_dir, output_dir, video_lists=None, index_path=None, force=False):
+    """Index every comments file of comments_dir, then write one MAP_Precomments_{video_id}.jsonl per file.
+
+    Files that have not grown since their stance input was written are skipped, unless force is set
+    (e.g. after adding video lists with more titles).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    index = ParentIndex(index_path or os.path.join(output_dir, DEFAULT_INDEX_NAME))
+    try:
+        added = index.update(comments_dir)
+        print(f"Parent index: {added} comments added, {len(index)} in total")
+
+        titles = load_video_titles(video_lists)
+        stats = Counter()
+        for filename in comment_files(comments_dir):
+            video_id = filename[len('comments_'):-len('.jsonl')]
+            comments_file = os.path.join(comments_dir, filename)
+            output_file = os.path.join(output_dir, f'MAP_Precomments_{video_id}.jsonl')
+            size = os.path.getsize(comments_file)
+            if not force and os.path.exists(output_file) and index.joined_size(filename) == size:
+                stats['unchanged'] += 1
+                continue
+            join_file(index, comments_file, output_file, titles, stats)
+            index.mark_joined(filename, size)
+            stats['files'] += 1
+    finally:
+        index.close()
+
+    print(f"{stats['files']} files written to {output_dir} ({stats['unchanged']} unchanged, skipped): "
+          f"{stats['top_level']} top-level comments, {stats['replies']} replies ({stats['parent_missing']} "
+          f"with a parent not in the index, given the video title instead); {stats['no_title']} comments "
+          f"without a parent text (video not in the video lists)")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Attach the parent comment (or video title) to every comment")
+    parser.add_argument('--comments', default=comments_path, help="Folder of the comments_{video_id}.jsonl files")
+    parser.add_argument('--output', default=output_path, help="Folder for the MAP_Precomments_*.jsonl files")
+    parser.add_argument('--video-list', nargs='+', default=None,
+                        help="Video list CSV files with the video titles, e.g. videos_climate.csv")
+    parser.add_argument('--index', default=None,
+                        help=f"Parent index file (default: {DEFAULT_INDEX_NAME} in the output folder)")
+    parser.add_argument('--force', action='store_true', help="Write every stance input again, even unchanged ones")
+    args = parser.parse_args()
+
+    build_stance_inputs(args.comments, args.output, args.video_list, args.index, args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+# YouTube Data API v3 cost in quota units of one call to each endpoint
+ENDPOINT_COSTS = {
+    'search.list': 100,
+    'videos.list': 1,
+    'channels.list': 1,
+    'commentThreads.list': 1,
+    'comments.list': 1,
+}
+
+# The daily quota resets at midnight Pacific time
+QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+
+DEFAULT_LEDGER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'quota_ledger.sqlite')
+
+
+def quota_day(now=None):
+    """Pacific-time date the quota units spent at `now` count against"""
+    now = now or datetime.now(QUOTA_TIMEZONE)
+    return now.astimezone(QUOTA_TIMEZONE).date().isoformat()
+
+
+class QuotaLedger:
+    """Append-only SQLite log of quota spending, shared by the scrapers and safe across processes.
+
+    Calls are reserved in memory and written to the database in batches. Every flush also re-reads the
+    day's total, so units spent by other processes using the same ledger are counted against the limit.
+    """
+
+    def __init__(self, db_path=DEFAULT_LEDGER_PATH, quota_limit=10000, margin=10,
+                 flush_every=50, flush_interval=5.0):
+        self.db_path = db_path
+        self.quota_limit = quota_limit
+        self.margin = margin
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+
+        self.pending = {}         # endpoint -> [calls, units] not yet written
+        self.pending_units = 0
+        self.pending_day = quota_day()
+        self.stored_units = 0     # today's total in the database at the last flush, all processes included
+        self.last_flush = time.monotonic()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        # One connection used under self.lock; the WAL journal lets other processes read while we write
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS quota_log (
+                                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                 day TEXT NOT NULL,
+                                 endpoint TEXT NOT NULL,
+                                 calls INTEGER NOT NULL,
+                                 units INTEGER NOT NULL,
+                                 recorded_at TEXT NOT NULL,
+                                 pid INTEGER NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS quota_log_day ON quota_log (day)')
+
+        with self.lock:
+            self.stored_units = self._stored_units(self.pending_day)
+        if self.stored_units:
+            print(f"Resuming with quota usage: {self}")
+
+    def _stored_units(self, day):
+        row = self.conn.execute('SELECT COALESCE(SUM(units), 0) FROM quota_log WHERE day = ?', (day,)).fetchone()
+        return row[0]
+
+    def _roll_day(self):
+        # Called with the lock held: at the Pacific midnight, write out yesterday's batch and start from zero
+        today = quota_day()
+        if today != self.pending_day:
+            self._flush()
+            self.pending_day = today
+            self.stored_units = self._stored_units(today)
+
+    def _flush(self):
+        if self.pending:
+            recorded_at = datetime.now(QUOTA_TIMEZONE).isoformat()
+            rows = [(self.pending_day, endpoint, calls, units, recorded_at, os.getpid())
+                    for endpoint, (calls, units) in self.pending.items()]
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany('INSERT INTO quota_log (day, endpoint, calls, units, recorded_at, pid) '
+                                      'VALUES (?, ?, ?, ?, ?, ?)', rows)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.pending = {}
+            self.pending_units = 0
+        self.stored_units = self._stored_units(self.pending_day)
+        self.last_flush = time.monotonic()
+
+    def used_today(self):
+        with self.lock:
+            self._roll_day()
+            return self.stored_units + self.pending_units
+
+    def exhausted(self):
+        return self.used_today() >= self.quota_limit - self.margin
+
+    def spend(self, endpoint, calls=1):
+        """Reserve the units for `calls` requests to `endpoint`; returns False once the daily limit is near"""
+        units = ENDPOINT_COSTS[endpoint] * calls
+        with self.lock:
+            self._roll_day()
+            if self.stored_units + self.pending_units + units > self.quota_limit - self.margin:
+                return False
+            entry = self.pending.setdefault(endpoint, [0, 0])
+            entry[0] += calls
+            entry[1] += units
+            self.pending_units += units
+            if (self.pending_units >= self.flush_every
+                    or time.monotonic() - self.last_flush >= self.flush_interval):
+                self._flush()
+            return True
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def summary(self, day=None):
+        """Calls and units per endpoint for one day (today by default), all processes included"""
+        day = day or quota_day()
+        with self.lock:
+            self._flush()
+            rows = self.conn.execute('SELECT endpoint, SUM(calls), SUM(units) FROM quota_log WHERE day = ? '
+                                     'GROUP BY endpoint ORDER BY endpoint', (day,)).fetchall()
+        return {endpoint: {'calls': calls, 'units': units} for endpoint, calls, units in rows}
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __str__(self):
+        return f"{self.stored_units + self.pending_units}/{self.quota_limit}"
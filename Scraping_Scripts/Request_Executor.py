@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import random
+import threading
+import time
+import http.client
+from collections import Counter
+
+import httplib2
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+from Quota_Ledger import ENDPOINT_COSTS
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Shared_Utils'))
+from Metrics import get_metrics
+
+# Error classes
+QUOTA = 'quota'                # daily quota used up: stop every worker until the reset
+RATE_LIMIT = 'rate_limit'      # too many requests right now: back off and retry
+TRANSIENT = 'transient'        # 5xx, timeouts, dropped connections: back off and retry
+PERMANENT = 'permanent'        # this item cannot be fetched (comments disabled, deleted video...): skip it
+UNKNOWN = 'unknown'
+
+QUOTA_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+
+# googleapiclient clients (httplib2 underneath) are not thread-safe, so every worker thread builds its own
+_thread_local = threading.local()
+
+
+def get_youtube(api_key, api_endpoint=None):
+    clients = getattr(_thread_local, 'clients', None)
+    if clients is None:
+        clients = _thread_local.clients = {}
+    key = (api_key, api_endpoint)
+    if key not in clients:
+        client_options = {'api_endpoint': api_endpoint} if api_endpoint else None
+        clients[key] = build('youtube', 'v3', developerKey=api_key, client_options=client_options)
+    return clients[key]
+
+
+class QuotaExhausted(Exception):
+    """The daily quota is used up (reported by the API or by the quota ledger)"""
+
+
+class PermanentRequestError(Exception):
+    """The request can never succeed, e.g. comments disabled on the video"""
+
+    def __init__(self, reason, error):
+        super().__init__(f"{reason}: {error}")
+        self.reason = reason
+
+
+class RetriesExhausted(Exception):
+    """A retryable error persisted through every attempt"""
+
+
+def error_reason(error):
+    """The 'reason' field of a YouTube API error, e.g. commentsDisabled or quotaExceeded"""
+    try:
+        details = json.loads(error.content.decode('utf-8'))['error']
+        return details['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return ''
+
+
+def classify(error):
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        reason = error_reason(error)
+        if reason in QUOTA_REASONS:
+            return QUOTA, reason
+        if status == 429 or reason in RATE_LIMIT_REASONS:
+            return RATE_LIMIT, reason or str(status)
+        if status >= 500:
+            return TRANSIENT, reason or str(status)
+        if status in (400, 401, 403, 404):
+            return PERMANENT, reason or str(status)
+        return UNKNOWN, reason or str(status)
+    # Timeouts, resets, DNS and TLS failures all surface as OSError (or httplib2/http.client errors)
+    if isinstance(error, (OSError, http.client.HTTPException, httplib2.HttpLib2Error)):
+        return TRANSIENT, type(error).__name__
+    return UNKNOWN, type(error).__name__
+
+
+class RequestExecutor:
+    """Runs API requests with quota accounting, error classification and exponential backoff with jitter.
+
+    One executor is shared by all the workers of a run: once the daily quota is reported exhausted, the
+    circuit breaker opens and every later call fails fast with QuotaExhausted instead of spending requests.
+    """
+
+    def __init__(self, ledger=None, max_attempts=6, base_delay=1.0, max_delay=64.0):
+        self.ledger = ledger
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = threading.Event()
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.metrics = get_metrics()
+
+    def _count(self, key):
+        with self.lock:
+            self.counters[key] += 1
+
+    def trip(self):
+        self.breaker.set()
+
+    @property
+    def tripped(self):
+        return self.breaker.is_set()
+
+    def exhausted(self):
+        return self.tripped or (self.ledger is not None and self.ledger.exhausted())
+
+    def backoff(self, attempt, error=None):
+        # Full jitter: a random wait up to the exponential cap, or the server's Retry-After when it sends one
+        resp = getattr(error, 'resp', None)
+        retry_after = resp.get('retry-after') if resp is not None else None
+        if retry_after and str(retry_after).isdigit():
+            return min(self.max_delay, float(retry_after))
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def execute(self, request, endpoint):
+        """Execute a googleapiclient request for `endpoint` (e.g. 'comments.list') and return its response"""
+        for attempt in range(self.max_attempts):
+            if self.tripped:
+                raise QuotaExhausted("quota circuit breaker is open")
+            if self.ledger is not None and not self.ledger.spend(endpoint):
+                raise QuotaExhausted(f"daily quota limit approaching: {self.ledger}")
+            self.metrics.inc('quota_units_total', ENDPOINT_COSTS.get(endpoint, 1), endpoint=endpoint)
+
+            start = time.perf_counter()
+            try:
+                response = request.execute()
+                self.metrics.request(endpoint, time.perf_counter() - start)
+                self._count('ok')
+                return response
+            except Exception as e:
+                error_class, reason = classify(e)
+                self.metrics.request(endpoint, time.perf_counter() - start, error_class)
+                self._count(error_class)
+
+                if error_class == QUOTA:
+                    self.trip()
+                    raise QuotaExhausted(reason) from e
+                if error_class == PERMANENT:
+                    raise PermanentRequestError(reason, e) from e
+                if error_class == UNKNOWN:
+                    raise
+                if attempt == self.max_attempts - 1:
+                    raise RetriesExhausted(f"{endpoint} failed after {attempt + 1} attempts: {e}") from e
+
+                delay = self.backoff(attempt, e)
+                self._count('retries')
+                self.metrics.retry(endpoint, error_class, delay)
+                print(f"{error_class} error on {endpoint} ({reason}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def summary(self):
+        with self.lock:
+            return dict(self.counters)
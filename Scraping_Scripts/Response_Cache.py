@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Shared_Utils'))
+from Metrics import get_metrics
+
+
+class ResponseCache:
+    """On-disk cache of API responses, keyed by endpoint and request parameters, with a time-to-live.
+
+    Each response is one JSON file named after the hash of its request, so concurrent workers (and
+    processes) can read and write the cache without any locking.
+    """
+
+    def __init__(self, cache_dir, ttl=7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(endpoint, params):
+        # The API key never changes the response, so it is left out of the cache key
+        request = json.dumps([endpoint, {k: v for k, v in sorted(params.items()) if k != 'key'}], sort_keys=True)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def get(self, endpoint, params):
+        path = self._path(self.key(endpoint, params))
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+        fresh = entry is not None and (self.ttl is None or time.time() - entry['stored_at'] <= self.ttl)
+        with self.lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        get_metrics().cache('youtube_responses', fresh)
+        return entry['response'] if fresh else None
+
+    def put(self, endpoint, params, response):
+        path = self._path(self.key(endpoint, params))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {'stored_at': time.time(), 'endpoint': endpoint, 'params': params, 'response': response}
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def cached_execute(self, executor, method, endpoint, **params):
+        """Return the cached response for this request, or run it through the executor and store it"""
+        response = self.get(endpoint, params)
+        if response is None:
+            response = executor.execute(method(**params), endpoint)
+            self.put(endpoint, params, response)
+        return response
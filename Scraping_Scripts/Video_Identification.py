@@ -1,191 +1,325 @@
-import csv
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-import time
+import os
+import argparse
+import threading
 import isodate
-
-# Initialize the YouTube API client
-youtube = build('youtube', 'v3', developerKey='ADD_YOUTUBE_API_KEY')
-
-
-def youtube_search(queries, min_views=1, max_results=50, published_after="2013-01-01T00:00:00Z",
-                   published_before="2024-05-01T00:00:00Z", sort_by='viewCount'):
-    videos = []
-    total_videos_processed = 0
-
-    for query in queries:
-        query_videos = []  # Track videos for this specific query
-        next_page_token = None
-
-        while len(query_videos) < max_results:  # Changed to use max_results directly for each query
+import yaml
+import pandas as pd
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+from Quota_Ledger import QuotaLedger, DEFAULT_LEDGER_PATH
+from Request_Executor import RequestExecutor, QuotaExhausted, get_youtube
+from Response_Cache import ResponseCache
+
+api_key = 'ADD_YOUTUBE_API_KEY'
+cache_dir = 'ADD_FOLDER_PATH_FOR_SEARCH_CACHE'
+cache_ttl = 7 * 24 * 3600  # cached search results older than a week are fetched again
+query_workers = 6
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'topics.yaml')
+
+VIDEO_PARTS = 'snippet,statistics,contentDetails'
+VIDEO_COLUMNS = ['title', 'url', 'views', 'comments', 'duration', 'duration_seconds', 'channel', 'category_id',
+                 'topic', 'query']
+
+
+@lru_cache(maxsize=65536)
+def duration_seconds(duration):
+    # Parsed once, when the video is collected (and only once per distinct duration string);
+    # unparseable durations are never within max_duration
+    try:
+        return isodate.parse_duration(duration).total_seconds()
+    except (isodate.ISO8601Error, ValueError, TypeError):
+        return float('nan')
+
+
+class VideoDetails:
+    """videos.list lookups shared by every query of every topic, so a video found several times is fetched once"""
+
+    def __init__(self, executor, cache, api_key, api_endpoint=None):
+        self.executor = executor
+        self.cache = cache
+        self.api_key = api_key
+        self.api_endpoint = api_endpoint
+        self.details = {}  # video_id -> videos.list item, or None when the API did not return the video
+        self.pending = {}  # video_id -> Event set once the worker fetching it is done
+        self.lock = threading.Lock()
+        self.requested = 0
+        self.calls = 0
+
+    def _fetch(self, video_ids):
+        # Details are cached one video at a time, so later runs reuse them whatever query found the video
+        found = {}
+        missing = []
+        for video_id in video_ids:
+            response = self.cache.get('videos.list', {'part': VIDEO_PARTS, 'id': video_id})
+            if response is None:
+                missing.append(video_id)
+            else:
+                found[video_id] = response['items'][0] if response['items'] else None
+
+        if missing:
+            youtube = get_youtube(self.api_key, self.api_endpoint)
+            response = self.executor.execute(youtube.videos().list(part=VIDEO_PARTS, id=','.join(missing)),
+                                             'videos.list')
+            with self.lock:
+                self.calls += 1
+            items = {item.get('id'): item for item in response.get('items', [])}
+            for video_id in missing:
+                found[video_id] = items.get(video_id)
+                self.cache.put('videos.list', {'part': VIDEO_PARTS, 'id': video_id},
+                               {'items': [items[video_id]] if video_id in items else []})
+        return found
+
+    def lookup(self, video_ids):
+        """Return the videos.list items of video_ids, fetching only the ones no other query has fetched"""
+        with self.lock:
+            self.requested += len(video_ids)
+            claimed = [video_id for video_id in dict.fromkeys(video_ids)
+                       if video_id not in self.details and video_id not in self.pending]
+            for video_id in claimed:
+                self.pending[video_id] = threading.Event()
+            waiting = [self.pending[video_id] for video_id in video_ids
+                       if video_id in self.pending and video_id not in claimed]
+
+        fetched = {}
+        try:
+            fetched = self._fetch(claimed) if claimed else {}
+        finally:
+            # On failure the videos are left unknown, so a later query can try them again
+            with self.lock:
+                self.details.update(fetched)
+                for video_id in claimed:
+                    self.pending.pop(video_id).set()
+
+        for event in waiting:
+            event.wait()
+        with self.lock:
+            return [self.details[video_id] for video_id in video_ids if self.details.get(video_id)]
+
+
+def search_query(topic, query, executor, cache, details, api_key, max_results=50,
+                 published_after="2013-01-01T00:00:00Z", published_before="2024-05-01T00:00:00Z",
+                 sort_by='viewCount', api_endpoint=None):
+    """Collect up to max_results News & Politics videos for one query; returns them and the videos processed"""
+    youtube = get_youtube(api_key, api_endpoint)
+    query_videos = []  # Track videos for this specific query
+    videos_processed = 0
+    next_page_token = None
+
+    while len(query_videos) < max_results:  # Changed to use max_results directly for each query
+        if executor.exhausted():
+            print(f"Quota exhausted. Stopping search for query: {query}")
+            break
+
+        try:
+            search_response = cache.cached_execute(
+                executor, youtube.search().list, 'search.list',
+                q=query,
+                part='id,snippet',
+                maxResults=50,
+                type='video',
+                order=sort_by,
+                relevanceLanguage='en',
+                regionCode='US',
+                publishedAfter=published_after,
+                publishedBefore=published_before,
+                pageToken=next_page_token
+            )
+        except QuotaExhausted as e:
+            print(f"Quota exhausted ({e}). Stopping search for query: {query}")
+            break
+        except Exception as e:
+            # Transient errors were already retried; anything left means this query cannot go on
+            print(f"Search failed for query '{query}': {e}")
+            break
+
+        video_ids = [item['id']['videoId'] for item in search_response.get('items', [])]
+
+        if video_ids:
             try:
-                search_response = youtube.search().list(
-                    q=query,
-                    part='id,snippet',
-                    maxResults=50,
-                    type='video',
-                    order=sort_by,
-                    relevanceLanguage='en',
-                    regionCode='US',
-                    publishedAfter=published_after,
-                    publishedBefore=published_before,
-                    pageToken=next_page_token
-                ).execute()
-
-                video_ids = [item['id']['videoId'] for item in search_response.get('items', [])]
-
-                if video_ids:
+                video_items = details.lookup(video_ids)
+
+                for video in video_items:
                     try:
-                        video_response = youtube.videos().list(
-                            part='snippet,statistics,contentDetails',
-                            id=','.join(video_ids)
-                        ).execute()
-
-                        for video in video_response.get('items', []):
-                            try:
-                                category_id = video.get('snippet', {}).get('categoryId', '')
-
-                                if category_id == '25':
-                                    duration = video.get('contentDetails', {}).get('duration', 'PT0M0S')
-                                    view_count = int(video.get('statistics', {}).get('viewCount', 0))
-                                    comment_count = int(video.get('statistics', {}).get('commentCount', 0))
-
-                                    video_info = {
-                                        'title': video.get('snippet', {}).get('title', 'No Title'),
-                                        'url': f"https://www.youtube.com/watch?v={video.get('id', '')}",
-                                        'views': view_count,
-                                        'comments': comment_count,
-                                        'duration': duration,
-                                        'channel': video.get('snippet', {}).get('channelTitle', 'No Channel'),
-                                        'category_id': category_id,
-                                        'query': query
-                                    }
-                                    query_videos.append(video_info)
-
-                            except Exception as e:
-                                print(f"Error processing video: {e}")
-                                print(f"Video data: {video}")
-                                continue
-
-                        total_videos_processed += len(video_response.get('items', []))
+                        category_id = video.get('snippet', {}).get('categoryId', '')
+
+                        if category_id == '25':
+                            duration = video.get('contentDetails', {}).get('duration', 'PT0M0S')
+                            view_count = int(video.get('statistics', {}).get('viewCount', 0))
+                            comment_count = int(video.get('statistics', {}).get('commentCount', 0))
+
+                            video_info = {
+                                'title': video.get('snippet', {}).get('title', 'No Title'),
+                                'url': f"https://www.youtube.com/watch?v={video.get('id', '')}",
+                                'views': view_count,
+                                'comments': comment_count,
+                                'duration': duration,
+                                'duration_seconds': duration_seconds(duration),
+                                'channel': video.get('snippet', {}).get('channelTitle', 'No Channel'),
+                                'category_id': category_id,
+                                'topic': topic,
+                                'query': query
+                            }
+                            query_videos.append(video_info)
 
                     except Exception as e:
-                        print(f"Error getting video details: {e}")
+                        print(f"Error processing video: {e}")
+                        print(f"Video data: {video}")
                         continue
 
-                next_page_token = search_response.get('nextPageToken')
-                if not next_page_token:
-                    break
+                videos_processed += len(video_items)
 
-            except HttpError as e:
-                error = e.resp.status
-                if error == 403:
-                    print("Quota exceeded. Waiting for quota reset...")
-                    time.sleep(3600)
-                else:
-                    print(f"An HTTP error {error} occurred:\n{e}")
-                    break
-
-            if len(query_videos) >= max_results:
+            except QuotaExhausted as e:
+                print(f"Quota exhausted ({e}). Stopping search for query: {query}")
                 break
+            except Exception as e:
+                print(f"Error getting video details: {e}")
+
+        next_page_token = search_response.get('nextPageToken')
+        if not next_page_token:
+            break
+
+    print(f"Collected {len(query_videos)} videos for {topic} query: {query}")
+    return query_videos, videos_processed
+
+
+def youtube_search(topics, min_views=1, max_results=50, published_after="2013-01-01T00:00:00Z",
+                   published_before="2024-05-01T00:00:00Z", sort_by='viewCount', executor=None, cache=None,
+                   api_key=api_key, workers=1, api_endpoint=None, details=None):
+    """Search every query of every topic ({topic: [queries]}) in one pass; returns {topic: videos} and the videos processed"""
+    # Without an executor from the caller, the quota is still recorded in the ledger shared with Comment_Scraper.py
+    ledger = None
+    if executor is None:
+        ledger = QuotaLedger(DEFAULT_LEDGER_PATH)
+        executor = RequestExecutor(ledger)
+    cache = cache or ResponseCache(cache_dir, ttl=cache_ttl)
+    details = details or VideoDetails(executor, cache, api_key, api_endpoint)
+    searches = [(topic, query) for topic, queries in topics.items() for query in queries]
+
+    # Each query runs in its own worker; results are gathered in query order, as in a serial run
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            results = list(pool.map(
+                lambda search: search_query(search[0], search[1], executor, cache, details, api_key, max_results,
+                                            published_after, published_before, sort_by, api_endpoint),
+                searches))
+    finally:
+        if ledger is not None:
+            ledger.close()
+
+    records = {topic: [] for topic in topics}
+    total_videos_processed = 0
+    for (topic, _), (query_videos, videos_processed) in zip(searches, results):
+        records[topic].extend(query_videos)
+        total_videos_processed += videos_processed
+
+    # One frame per topic, sorted by view count once; dedup and filters keep this order
+    videos = {}
+    for topic, topic_videos in records.items():
+        frame = pd.DataFrame(topic_videos, columns=VIDEO_COLUMNS)
+        videos[topic] = frame.sort_values('views', ascending=False, kind='stable', ignore_index=True)
+    return videos, total_videos_processed
 
-        videos.extend(query_videos)
-        print(f"Collected {len(query_videos)} videos for query: {query}")
 
-    # Sort all videos by view count before returning
-    videos.sort(key=lambda x: x['views'], reverse=True)
-    return videos, total_videos_processed
+def load_topics(config_path):
+    with open(config_path, 'r', encoding='utf-8') as stream:
+        config = yaml.safe_load(stream)
+    topics = config.get('topics') or {}
+    for topic, queries in topics.items():
+        if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+            raise ValueError(f"Topic '{topic}' in {config_path} must be a list of queries")
+    if not topics:
+        raise ValueError(f"No topics found in {config_path}")
+    return config, topics
 
 
-def filter_videos(videos, min_views=1, min_comments=1000, max_duration='PT20M'):
-    filtered_videos = []
+def filter_videos(videos, min_views=1, min_comments=1000, max_duration='PT20M', verbose=False):
+    """Keep the videos above the view and comment thresholds and not longer than max_duration"""
     max_duration_seconds = isodate.parse_duration(max_duration).total_seconds()
-    for video in videos:
-        duration = isodate.parse_duration(video['duration']).total_seconds()
-        view_count = video['views']
-        comment_count = video['comments']
-
-        # Debugging prints
-        print(f"Checking video: {video['title']}")
-        print(f"Duration (seconds): {duration}, Views: {view_count}, Comments: {comment_count}")
+    keep = ((videos['views'] >= min_views) & (videos['comments'] >= min_comments)
+            & (videos['duration_seconds'] <= max_duration_seconds))
 
-        if view_count >= min_views and comment_count >= min_comments and duration <= max_duration_seconds:
-            filtered_videos.append(video)
-        else:
-            print(f"Excluded video: {video['title']}")
+    if verbose:
+        for video, kept in zip(videos.itertuples(index=False), keep):
+            print(f"Checking video: {video.title}")
+            print(f"Duration (seconds): {video.duration_seconds}, Views: {video.views}, Comments: {video.comments}")
+            if not kept:
+                print(f"Excluded video: {video.title}")
 
-    # Sort filtered videos by view count
-    filtered_videos.sort(key=lambda x: x['views'], reverse=True)
-    return filtered_videos
+    # A boolean mask keeps the order of the input, which is already sorted by view count
+    return videos[keep]
 
 
 def remove_duplicates(videos):
-    seen_urls = set()
-    unique_videos = []
-    for video in videos:
-        if video['url'] not in seen_urls:
-            unique_videos.append(video)
-            seen_urls.add(video['url'])
-
-    # Sort unique videos by view count
-    unique_videos.sort(key=lambda x: x['views'], reverse=True)
-    return unique_videos
+    # The first occurrence of each URL is kept, and the order (by view count) is unchanged
+    return videos.drop_duplicates(subset='url', keep='first')
 
 
 def save_to_csv(videos, filename):
-    # Get all possible keys from all dictionaries
-    keys = set()
-    for video in videos:
-        keys.update(video.keys())
-
-    # Convert to sorted list for consistent column order
-    keys = sorted(list(keys))
-
-    with open(filename, 'w', newline='', encoding='utf-8') as output_file:
-        dict_writer = csv.DictWriter(output_file, fieldnames=keys)
-        dict_writer.writeheader()
-        dict_writer.writerows(videos)
-
-
-# Immigration
-queries = [
-    'immigration',
-    'migration crisis',
-    'asylum refugees seeker',
-    'border control',
-    'migrant welcoming',
-    'solidarity migrants',
-]
-
-# Climate
-#queries = [
-#    'climate change'
-#    'global warming'
-#    'climate activism'
-#    'climate policies'
-#    'climate change hoax'
-#    'eco anxiety'
-#]
-
-# Retrieve all videos (50 per query)
-all_videos, total_videos_processed = youtube_search(queries, max_results=50)
-
-# Save unfiltered videos to a CSV file
-#save_to_csv(all_videos, "ADD_PATH_FOR_CSV_FILE")
-
-# Remove duplicates from the list of all videos
-unique_videos = remove_duplicates(all_videos)
-
-# Apply filtering criteria
-filtered_videos = filter_videos(unique_videos, min_views=1, min_comments=500, max_duration='PT15M')
-
-# Save filtered videos to a CSV file
-save_to_csv(filtered_videos, "ADD_PATH_FOR_CSV_FILE")
-
-print(f"Total videos processed: {total_videos_processed}")
-print(f"Total unique videos: {len(unique_videos)}")
-print(f"Total filtered videos: {len(filtered_videos)}")
-
-for video in filtered_videos:
-    print(
-        f"{video['title']} - {video['url']} (Views: {video['views']}, Comments: {video['comments']}, Duration: {video['duration']}")
+    # Sorted columns for a consistent column order; durations in seconds are only used for filtering
+    videos = videos.drop(columns=['duration_seconds'])
+    videos[sorted(videos.columns)].to_csv(filename, index=False, encoding='utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', default=DEFAULT_CONFIG_PATH, help="YAML file with the topic query sets")
+    parser.add_argument('--topics', nargs='+', default=None, help="Only search these topics of the config")
+    parser.add_argument('--api-key', default=api_key, help="YouTube Data API key")
+    parser.add_argument('--cache-dir', default=cache_dir, help="Folder of the search response cache")
+    parser.add_argument('--api-endpoint', default=None, help="Alternative API root, e.g. a local fake server")
+    parser.add_argument('--quota-ledger', default=DEFAULT_LEDGER_PATH, help="Quota ledger shared with Comment_Scraper.py")
+    args = parser.parse_args()
+
+    config, topics = load_topics(args.config)
+    if args.topics:
+        topics = {topic: topics[topic] for topic in args.topics}
+    output_path = config.get('output_path', '.')
+
+    # Quota spending is recorded in the ledger shared with Comment_Scraper.py
+    ledger = QuotaLedger(args.quota_ledger)
+    executor = RequestExecutor(ledger)
+    # Responses are cached on disk, so re-running the queries (e.g. to tune filter_videos) costs no quota
+    cache = ResponseCache(args.cache_dir, ttl=cache_ttl)
+    details = VideoDetails(executor, cache, args.api_key, args.api_endpoint)
+
+    # Retrieve all videos of every topic (max_results per query)
+    videos_by_topic, total_videos_processed = youtube_search(
+        topics, max_results=config.get('max_results', 50),
+        published_after=config.get('published_after', "2013-01-01T00:00:00Z"),
+        published_before=config.get('published_before', "2024-05-01T00:00:00Z"),
+        sort_by=config.get('sort_by', 'viewCount'), executor=executor, cache=cache, api_key=args.api_key,
+        workers=query_workers, api_endpoint=args.api_endpoint, details=details)
+    ledger.close()
+    print("Requests by outcome: " + ', '.join(f"{key}={value}" for key, value in sorted(executor.summary().items())))
+    print(f"Response cache: {cache.hits} hits, {cache.misses} misses")
+    print(f"Video details: {details.requested} looked up, {len(details.details)} distinct, "
+          f"{details.calls} videos.list calls")
+    print(f"Total videos processed: {total_videos_processed}")
+
+    for topic, all_videos in videos_by_topic.items():
+        # Save unfiltered videos to a CSV file
+        #save_to_csv(all_videos, os.path.join(output_path, f"videos_{topic}_unfiltered.csv"))
+
+        # Remove duplicates from the list of all videos
+        unique_videos = remove_duplicates(all_videos)
+
+        # Apply filtering criteria
+        filtered_videos = filter_videos(unique_videos, min_views=config.get('min_views', 1),
+                                        min_comments=config.get('min_comments', 500),
+                                        max_duration=config.get('max_duration', 'PT15M'),
+                                        verbose=config.get('verbose', False))
+
+        # Save filtered videos to a CSV file, one per topic
+        save_to_csv(filtered_videos, os.path.join(output_path, f"videos_{topic}.csv"))
+
+        print(f"[{topic}] Total unique videos: {len(unique_videos)}")
+        print(f"[{topic}] Total filtered videos: {len(filtered_videos)}")
+
+        for video in filtered_videos.itertuples(index=False):
+            print(
+                f"{video.title} - {video.url} (Views: {video.views}, Comments: {video.comments}, Duration: {video.duration}")
+
+
+if __name__ == '__main__':
+    main()
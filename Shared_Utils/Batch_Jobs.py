@@ -0,0 +1,235 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Limits of one OpenAI batch input file
+MAX_REQUESTS_PER_FILE = 50000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+
+CHAT_COMPLETIONS_URL = '/v1/chat/completions'
+FINAL_STATES = {'completed', 'failed', 'expired', 'cancelled'}
+
+
+def batch_request(custom_id: str, body: Dict) -> Dict:
+    """One line of a batch input file: a chat completion request identified by custom_id"""
+    return {'custom_id': custom_id, 'method': 'POST', 'url': CHAT_COMPLETIONS_URL, 'body': body}
+
+
+def part_path(batch_path: str, part: int) -> str:
+    root, ext = os.path.splitext(batch_path)
+    return f"{root}.part{part:03d}{ext}"
+
+
+def results_path_for(request_path: str) -> str:
+    root, ext = os.path.splitext(request_path)
+    return f"{root}.results{ext}"
+
+
+def batch_parts(batch_path: str) -> List[str]:
+    """The request files written for batch_path: the file itself, or its numbered parts when it was split"""
+    if os.path.exists(batch_path):
+        return [batch_path]
+    root, ext = os.path.splitext(batch_path)
+    return sorted(path for path in glob.glob(f"{glob.escape(root)}.part*{ext}") if '.results' not in path)
+
+
+def remove_job_files(request_path: str) -> None:
+    """Forget the job submitted for a request file and its downloaded results"""
+    for path in (request_path + '.job.json', results_path_for(request_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def write_batch_files(requests: Iterable[Dict], batch_path: str, max_requests: int = MAX_REQUESTS_PER_FILE,
+                      max_bytes: int = MAX_BYTES_PER_FILE) -> List[str]:
+    """Write batch requests as JSONL, split into numbered parts when they do not fit in one batch file.
+
+    The job and the results of a previous request file at the same path are removed: they answer other requests.
+    """
+    previous = set(batch_parts(batch_path)) | {batch_path}
+    parts = []
+    current, count, size = None, 0, 0
+    try:
+        for request in requests:
+            line = json.dumps(request, ensure_ascii=False) + '\n'
+            if current is None or count >= max_requests or size + len(line.encode('utf-8')) > max_bytes:
+                if current is not None:
+                    current.close()
+                parts.append(part_path(batch_path, len(parts) + 1))
+                current = open(parts[-1], 'w', encoding='utf-8')
+                count, size = 0, 0
+            current.write(line)
+            count += 1
+            size += len(line.encode('utf-8'))
+    finally:
+        if current is not None:
+            current.close()
+
+    for stale in batch_parts(batch_path):
+        if stale not in parts:
+            os.remove(stale)
+    # A single part keeps the plain name
+    if len(parts) == 1:
+        os.replace(parts[0], batch_path)
+        parts = [batch_path]
+    for request_path in previous | set(parts):
+        remove_job_files(request_path)
+    return parts
+
+
+def read_batch_results(results_paths: Iterable[str]) -> Iterator[Tuple[str, Optional[Dict]]]:
+    """(custom_id, chat completion body) for every line of the results files; the body is None for failed requests"""
+    for path in results_paths:
+        if not os.path.exists(path):
+            print(f"Batch results not found: {path}")
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get('response') or {}
+                body = response.get('body') if response.get('status_code') == 200 and not result.get('error') else None
+                yield result['custom_id'], body
+
+
+def completion_text(body: Optional[Dict]) -> Optional[str]:
+    try:
+        return body['choices'][0]['message']['content']
+    except (TypeError, KeyError, IndexError):
+        return None
+
+
+class OpenAIBatchBackend:
+    """Submits batch files to the OpenAI Batch API (answers within 24h, at a lower price)"""
+
+    def __init__(self, client=None):
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI()
+        self.client = client
+
+    def submit(self, request_path: str) -> str:
+        with open(request_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=CHAT_COMPLETIONS_URL,
+                                           completion_window='24h')
+        return batch.id
+
+    def status(self, job_id: str) -> Tuple[str, Dict]:
+        batch = self.client.batches.retrieve(job_id)
+        counts = batch.request_counts.model_dump() if batch.request_counts is not None else {}
+        return batch.status, counts
+
+    def download(self, job_id: str, results_path: str) -> None:
+        batch = self.client.batches.retrieve(job_id)
+        with open(results_path, 'w', encoding='utf-8') as f:
+            # Failed requests are listed in a separate error file; both go to the results file
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    f.write(self.client.files.content(file_id).text)
+
+
+class LocalBatchBackend:
+    """Stand-in for the Batch API: answers every request at submit time with `respond(body) -> chat completion`.
+
+    By default the requests are sent one by one to an OpenAI-compatible server (e.g. a local mock), so the
+    build, submit and merge steps can be tested without the real Batch API.
+    """
+
+    def __init__(self, respond: Optional[Callable[[Dict], Dict]] = None, api_base: Optional[str] = None):
+        if respond is None:
+            from openai import OpenAI
+            client = OpenAI(base_url=api_base) if api_base else OpenAI()
+            respond = lambda body: client.chat.completions.create(**body).model_dump()
+        self.respond = respond
+        self.jobs = {}
+
+    def submit(self, request_path: str) -> str:
+        job_id = f"local-{len(self.jobs) + 1}"
+        results = []
+        counts = {'total': 0, 'completed': 0, 'failed': 0}
+        with open(request_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                request = json.loads(line)
+                counts['total'] += 1
+                try:
+                    response, error = {'status_code': 200, 'body': self.respond(request['body'])}, None
+                    counts['completed'] += 1
+                except Exception as e:
+                    response, error = None, {'message': str(e)}
+                    counts['failed'] += 1
+                results.append({'id': f"{job_id}-{counts['total']}", 'custom_id': request['custom_id'],
+                                'response': response, 'error': error})
+        self.jobs[job_id] = (results, counts)
+        return job_id
+
+    def status(self, job_id: str) -> Tuple[str, Dict]:
+        return 'completed', self.jobs[job_id][1]
+
+    def download(self, job_id: str, results_path: str) -> None:
+        with open(results_path, 'w', encoding='utf-8') as f:
+            for result in self.jobs[job_id][0]:
+                f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+
+def run_batch(backend, request_path: str, results_path: Optional[str] = None, poll_interval: float = 60) -> str:
+    """Submit one request file, wait for the job to finish and download its results; returns the results path.
+
+    The job id is saved next to the request file, so an interrupted run polls the same job instead of
+    submitting (and paying for) it again.
+    """
+    results_path = results_path or results_path_for(request_path)
+    job_path = request_path + '.job.json'
+    job_id = None
+    if os.path.exists(job_path):
+        with open(job_path, 'r') as f:
+            job = json.load(f)
+        if job.get('backend') == type(backend).__name__:
+            job_id = job['job_id']
+            print(f"Resuming batch job {job_id} for {request_path}")
+    if job_id is None:
+        job_id = backend.submit(request_path)
+        with open(job_path, 'w') as f:
+            json.dump({'job_id': job_id, 'backend': type(backend).__name__, 'submitted_at': time.time()}, f)
+        print(f"Submitted {request_path} as batch job {job_id}")
+
+    while True:
+        state, counts = backend.status(job_id)
+        if state in FINAL_STATES:
+            break
+        print(f"Batch job {job_id}: {state} {counts}")
+        time.sleep(poll_interval)
+
+    print(f"Batch job {job_id} {state}: {counts}")
+    if state != 'failed':
+        # Expired jobs still return the requests they finished
+        backend.download(job_id, results_path)
+        os.remove(job_path)
+    return results_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Submit batch request files and download their results")
+    parser.add_argument('batch_path', help="Request file written by a labelling script (its parts are found too)")
+    parser.add_argument('--backend', choices=['openai', 'local'], default='openai')
+    parser.add_argument('--api-base', default=None, help="Server answering the requests of the local backend")
+    parser.add_argument('--poll-interval', type=float, default=60, help="Seconds between two status checks")
+    args = parser.parse_args()
+
+    backend = OpenAIBatchBackend() if args.backend == 'openai' else LocalBatchBackend(api_base=args.api_base)
+    parts = batch_parts(args.batch_path)
+    if not parts:
+        print(f"No batch request file found for {args.batch_path}")
+        sys.exit(1)
+    for request_path in parts:
+        results_path = run_batch(backend, request_path, poll_interval=args.poll_interval)
+        print(f"Results of {request_path} saved to {results_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+import os
+import io
+import re
+import json
+import argparse
+from collections import Counter
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.json as pa_json
+    import pyarrow.parquet as pq
+except ImportError:  # only needed to compact or read a comment store
+    pa = None
+
+MANIFEST_NAME = '_compacted.json'   # names starting with _ or . are not read as data by pyarrow
+PART_NAME = 'part-0.parquet'
+PARTITION_KEYS = ['Source', 'Period', 'ChannelLeaning']
+ROW_GROUP_ROWS = 128 * 1024
+SCAN_BATCH_ROWS = 10000
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Field order of the scraper's JSONL rows, which readers give back
+FIELDS = ['CommentID', 'ThreadID', 'VideoID', 'ParentCommentID', 'CommentText', 'AuthorName', 'NumberOfLikes',
+          'IsReply', 'Timestamp', 'Period', 'ChannelLeaning', 'Source', 'ParentCommentText']
+
+FILTER = re.compile(r'^\s*(\w+)\s*(>=|<=|!=|=|>|<)\s*(.*?)\s*$')
+
+
+def require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError("The comment store needs pyarrow: pip install pyarrow")
+
+
+def raw_schema():
+    """Fields as the scraper writes them; ParentCommentText only exists in the outputs of Parent_Join.py.
+
+    The partition keys are left out: they are taken from the first row of the file (they can be numbers,
+    e.g. a Period of 2024) and stored in the folder names.
+    """
+    return pa.schema([(name, pa.int64() if name == 'NumberOfLikes' else pa.string()) for name in FIELDS
+                      if name not in PARTITION_KEYS])
+
+
+def store_schema():
+    return pa.schema([
+        ('CommentID', pa.string()),
+        ('ThreadID', pa.string()),
+        ('VideoID', pa.dictionary(pa.int32(), pa.string())),
+        ('ParentCommentID', pa.string()),          # null for top-level comments
+        ('CommentText', pa.string()),
+        ('AuthorName', pa.string()),
+        ('NumberOfLikes', pa.int64()),
+        ('IsReply', pa.bool_()),
+        ('Timestamp', pa.timestamp('s', tz='UTC')),
+        ('ParentCommentText', pa.string()),
+    ])
+
+
+def source_files(comments_dir: str) -> List[str]:
+    """Per-video files of the scraper (comments_*.jsonl) or of Parent_Join.py (MAP_Precomments_*.jsonl)"""
+    return sorted(filename for filename in os.listdir(comments_dir) if filename.endswith('.jsonl')
+                  and filename.startswith(('comments_', 'MAP_Precomments_')))
+
+
+def complete_bytes(path: str) -> bytes:
+    """Content of a file up to its last newline: a line cut by a crash of the scraper is left for later"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return data[:data.rfind(b'\n') + 1]
+
+
+def partition_dir(values: Dict) -> str:
+    # Hive layout (Source=.../Period=.../ChannelLeaning=...), values URI-encoded as pyarrow expects
+    return '/'.join(f"{key}={quote(str(values.get(key)), safe='')}" for key in PARTITION_KEYS)
+
+
+def first_row(path: str) -> Optional[Dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip() and line.endswith('\n'):
+                return json.loads(line)
+    return None
+
+
+def read_source_file(path: str):
+    """One per-video file as a table of the store schema, without the partition columns; a file that does
+    not fit the schema raises a ValueError naming it"""
+    data = complete_bytes(path)
+    try:
+        table = pa_json.read_json(io.BytesIO(data), parse_options=pa_json.ParseOptions(
+            explicit_schema=raw_schema(), unexpected_field_behavior='ignore'))
+        parent_ids = table['ParentCommentID']
+        columns = {
+            'VideoID': pc.dictionary_encode(table['VideoID']),
+            'ParentCommentID': pc.if_else(pc.equal(parent_ids, ''), pa.scalar(None, pa.string()), parent_ids),
+            'IsReply': pc.equal(table['IsReply'], 'True'),
+            'Timestamp': pc.cast(table['Timestamp'], pa.timestamp('s', tz='UTC')),
+        }
+    except pa.ArrowInvalid as e:
+        # e.g. a NumberOfLikes that is not a number, or a Timestamp in another format
+        raise ValueError(f"Cannot read {os.path.basename(path)}: {e}") from e
+    schema = store_schema()
+    return pa.table([columns.get(field.name, table[field.name]) for field in schema], schema=schema)
+
+
+def write_partition(comments_dir: str, filenames: List[str], path: str) -> Tuple[int, List[str]]:
+    """Write the files of one partition as a single Parquet file, swapped in whole; returns the rows written
+    and the files that could not be read (left out, with their error printed)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+    rows = 0
+    skipped = []
+    pending, pending_rows = [], 0
+    with pq.ParquetWriter(tmp_path, store_schema(), compression='zstd', use_dictionary=True) as writer:
+        for filename in filenames:
+            try:
+                table = read_source_file(os.path.join(comments_dir, filename))
+            except ValueError as e:
+                print(f"{e}: skipped")
+                skipped.append(filename)
+                continue
+            pending.append(table)
+            pending_rows += table.num_rows
+            # Small videos are gathered into row groups of ROW_GROUP_ROWS, so scans do not pay per-video overhead
+            if pending_rows >= ROW_GROUP_ROWS:
+                merged = pa.concat_tables(pending).unify_dictionaries().combine_chunks()
+                writer.write_table(merged, row_group_size=ROW_GROUP_ROWS)
+                rows += merged.num_rows
+                pending, pending_rows = [], 0
+        if pending:
+            merged = pa.concat_tables(pending).unify_dictionaries().combine_chunks()
+            writer.write_table(merged, row_group_size=ROW_GROUP_ROWS)
+            rows += merged.num_rows
+    os.replace(tmp_path, path)
+    return rows, skipped
+
+
+def compact(comments_dir: str, store_dir: str, force: bool = False) -> Counter:
+    """Bring the store up to date with the per-video JSONL files of comments_dir.
+
+    Only partitions with a new, grown or removed file are written again. The manifest records the size of
+    every file compacted, and is saved after the partitions, so a crash means some work is done twice.
+    A file that cannot be read is left out of the manifest, so it is tried again by the next run.
+    """
+    require_pyarrow()
+    os.makedirs(store_dir, exist_ok=True)
+    manifest_path = os.path.join(store_dir, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    stats = Counter()
+    current = {}
+    for filename in source_files(comments_dir):
+        size = os.path.getsize(os.path.join(comments_dir, filename))
+        known = manifest.get(filename)
+        if known is not None and known['size'] == size:
+            current[filename] = known
+            continue
+        row = first_row(os.path.join(comments_dir, filename))
+        if row is None:
+            continue
+        current[filename] = {'size': size, 'partition': partition_dir(row)}
+        stats['files_changed'] += 1
+
+    changed = {entry['partition'] for name, entry in current.items() if manifest.get(name) != entry}
+    changed |= {entry['partition'] for name, entry in manifest.items() if current.get(name) != entry}
+    for partition in sorted(changed):
+        filenames = sorted(name for name, entry in current.items() if entry['partition'] == partition)
+        path = os.path.join(store_dir, partition, PART_NAME)
+        if filenames:
+            rows, skipped = write_partition(comments_dir, filenames, path)
+            for filename in skipped:
+                del current[filename]
+            stats['rows'] += rows
+            stats['files_skipped'] += len(skipped)
+            stats['partitions_written'] += 1
+        elif os.path.exists(path):
+            os.remove(path)
+            stats['partitions_removed'] += 1
+
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(current, f)
+    os.replace(tmp_path, manifest_path)
+    stats['files'] = len(current)
+    stats['partitions'] = len({entry['partition'] for entry in current.values()})
+    return stats
+
+
+def is_store(path: Optional[str]) -> bool:
+    """Whether path is a comment store written by compact() (rather than a JSONL file or folder)"""
+    return bool(path) and os.path.isfile(os.path.join(path, MANIFEST_NAME))
+
+
+def open_store(store_dir: str):
+    require_pyarrow()
+    partitioning = ds.partitioning(pa.schema([(key, pa.string()) for key in PARTITION_KEYS]), flavor='hive')
+    return ds.dataset(store_dir, format='parquet', partitioning=partitioning)
+
+
+def filter_expression(dataset, where: Optional[List[str]]):
+    """Pushdown filter from expressions like "Source=BBC", "Period=P1,P2", "NumberOfLikes>=10",
+    "Timestamp>=2024-01-01T00:00:00Z" or "IsReply=False" (all of them must hold)"""
+    expression = None
+    for text in where or []:
+        match = FILTER.match(text)
+        if not match or match.group(1) not in dataset.schema.names:
+            raise ValueError(f"Cannot read the filter {text!r}: expected FIELD=VALUE with one of "
+                             f"{', '.join(dataset.schema.names)}")
+        name, operator, raw = match.groups()
+        field_type = dataset.schema.field(name).type
+
+        def value(text):
+            if pa.types.is_boolean(field_type):
+                return text.lower() == 'true'
+            if pa.types.is_integer(field_type):
+                return int(text)
+            if pa.types.is_timestamp(field_type):
+                return pa.scalar(text).cast(field_type)
+            return text
+
+        field = ds.field(name)
+        values = [value(part.strip()) for part in raw.split(',')]
+        if operator == '=':
+            condition = field.isin(values) if len(values) > 1 else field == values[0]
+        elif operator == '!=':
+            condition = ~field.isin(values)
+        else:
+            condition = {'>=': field >= values[0], '<=': field <= values[0],
+                         '>': field > values[0], '<': field < values[0]}[operator]
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def as_rows(batch) -> List[Dict]:
+    """Rows in the layout of the scraper's JSONL files (string IsReply and Timestamp, '' for no parent)"""
+    columns, names = [], []
+    for name in FIELDS:
+        if name not in batch.schema.names:
+            continue
+        column = batch.column(name)
+        if name == 'IsReply':
+            column = pc.if_else(column, 'True', 'False')
+        elif name == 'Timestamp':
+            # Parquet has no second unit: timestamps come back in milliseconds
+            column = pc.strftime(pc.cast(column, pa.timestamp('s', tz='UTC')), format=TIMESTAMP_FORMAT)
+        elif name == 'ParentCommentID':
+            column = pc.fill_null(column, '')
+        columns.append(column)
+        names.append(name)
+    rows = pa.RecordBatch.from_arrays(columns, names=names).to_pylist()
+    if 'ParentCommentText' in names:
+        for row in rows:
+            # As in the JSONL files, comments without a parent text have no ParentCommentText field
+            if row['ParentCommentText'] is None:
+                del row['ParentCommentText']
+    return rows
+
+
+def scan_comments(store_dir: str, columns: Optional[List[str]] = None, where: Optional[List[str]] = None,
+                  batch_size: int = SCAN_BATCH_ROWS) -> Iterator[Dict]:
+    """Comments of the store as dicts, reading only `columns` and only the files and row groups that can
+    match `where` (see filter_expression)"""
+    dataset = open_store(store_dir)
+    scanner = dataset.scanner(columns=columns, filter=filter_expression(dataset, where), batch_size=batch_size)
+    for batch in scanner.to_batches():
+        yield from as_rows(batch)
+
+
+def count_comments(store_dir: str, where: Optional[List[str]] = None) -> int:
+    dataset = open_store(store_dir)
+    return dataset.count_rows(filter=filter_expression(dataset, where))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact per-video comment files into a partitioned Parquet store")
+    parser.add_argument('comments', help="Folder of comments_*.jsonl (or MAP_Precomments_*.jsonl) files")
+    parser.add_argument('store', help="Folder of the comment store")
+    parser.add_argument('--force', action='store_true', help="Write every partition again")
+    args = parser.parse_args()
+
+    stats = compact(args.comments, args.store, args.force)
+    print(f"{stats['files']} files in {stats['partitions']} partitions: {stats['files_changed']} new or grown files, "
+          f"{stats['partitions_written']} partitions written ({stats['rows']} comments), "
+          f"{stats['partitions_removed']} removed, {stats['files_skipped']} files skipped (errors above)")
+
+
+if __name__ == '__main__':
+    main()
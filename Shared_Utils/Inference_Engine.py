@@ -0,0 +1,102 @@
+import time
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Optional, Tuple
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a text (about 4 characters per token for English)"""
+    return len(text) // 4 + 1
+
+
+class RateLimiter:
+    """Client-side limits on requests per minute and tokens per minute.
+
+    Both limits are token buckets refilled continuously. Like the API, which enforces a per-minute limit
+    over shorter periods, a burst can only use `burst_seconds` worth of budget. A request reserves its
+    estimated tokens before being sent; settle() corrects the bucket with the tokens the API reports.
+    A request larger than the bucket waits for a full bucket and leaves the budget below zero, so the
+    requests after it wait until its tokens are paid back.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                 burst_seconds: float = 1.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_capacity = max(1.0, (requests_per_minute or 0) * burst_seconds / 60)
+        self.token_capacity = max(1.0, (tokens_per_minute or 0) * burst_seconds / 60)
+        self.request_budget = self.request_capacity
+        self.token_budget = self.token_capacity
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        if self.requests_per_minute:
+            self.request_budget = min(self.request_capacity,
+                                      self.request_budget + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self.token_budget = min(self.token_capacity, self.token_budget + elapsed * self.tokens_per_minute / 60)
+
+    async def acquire(self, tokens: int = 0) -> None:
+        """Wait until one more request of `tokens` tokens fits in both limits, then reserve all its tokens"""
+        # A single request larger than the burst budget would never fit: it waits for a full bucket instead
+        needed = min(tokens, self.token_capacity)
+        # Waiting requests are served in arrival order: the lock is held while sleeping
+        async with self.lock:
+            while True:
+                self._refill()
+                wait = 0.0
+                if self.requests_per_minute and self.request_budget < 1:
+                    wait = max(wait, (1 - self.request_budget) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute and self.token_budget < needed:
+                    wait = max(wait, (needed - self.token_budget) * 60 / self.tokens_per_minute)
+                if wait <= 0:
+                    break
+                # Short sleeps, so tokens given back by settle() in the meantime are not waited for
+                wait = min(wait, 0.25)
+                self.waited += wait
+                await asyncio.sleep(wait)
+            if self.requests_per_minute:
+                self.request_budget -= 1
+            if self.tokens_per_minute:
+                self.token_budget -= tokens
+
+    def settle(self, reserved: int, used: int) -> None:
+        """Give back (or take) the difference between the reserved and the reported tokens"""
+        if self.tokens_per_minute:
+            self.token_budget = min(self.token_capacity, self.token_budget + reserved - used)
+
+
+async def run_ordered(items: Iterable, worker: Callable[..., Awaitable], max_in_flight: int = 8,
+                      window: Optional[int] = None) -> AsyncIterator[Tuple[object, object]]:
+    """Run `worker(item)` for every item with at most max_in_flight calls at once; yield (item, result) in input order.
+
+    Items are taken from the iterable lazily: at most `window` (default 4 x max_in_flight) of them are
+    started ahead of the one being waited for, so a slow item does not stall the others and memory stays flat.
+    """
+    max_in_flight = max(1, max_in_flight)
+    window = window or 4 * max_in_flight
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def bounded(item):
+        async with semaphore:
+            return await worker(item)
+
+    iterator = iter(items)
+    pending = deque()
+    try:
+        for item in iterator:
+            pending.append((item, asyncio.ensure_future(bounded(item))))
+            if len(pending) >= window:
+                item, task = pending.popleft()
+                yield item, await task
+        while pending:
+            item, task = pending.popleft()
+            yield item, await task
+    finally:
+        for _, task in pending:
+            task.cancel()
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from Metrics import get_metrics
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'llm_cache.sqlite')
+
+
+def cache_key(model, system, user, **params):
+    """Hash of everything that decides the answer: model, system prompt, user text and decoding parameters"""
+    payload = json.dumps([model, system, user, params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LLMCache:
+    """Content-addressed SQLite cache of chat completion answers, shared by the labelling scripts.
+
+    Identical comments ("Lol", "Facts", copy-paste spam) are only paid for once, across files, scripts and
+    runs. When the cache grows past max_bytes the least recently used answers are evicted; the last-use
+    times of hits are written in batches.
+    """
+
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, max_bytes=512 * 1024 * 1024, touch_every=200,
+                 evict_every=200):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.touch_every = touch_every
+        self.evict_every = evict_every
+        self.lock = threading.Lock()
+        self.metrics = get_metrics()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.touched = {}          # key -> last use time, not yet written
+        self.puts_since_check = 0
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        # One connection used under self.lock; the WAL journal lets other processes read while we write
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS llm_cache (
+                                 key TEXT PRIMARY KEY,
+                                 model TEXT,
+                                 response TEXT NOT NULL,
+                                 size INTEGER NOT NULL,
+                                 created_at REAL NOT NULL,
+                                 last_used REAL NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)')
+
+    def get(self, key):
+        """The cached answer for key, or None"""
+        with self.lock:
+            row = self.conn.execute('SELECT response FROM llm_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                self.metrics.cache('llm_responses', False)
+                return None
+            self.hits += 1
+            self.metrics.cache('llm_responses', True)
+            self.touched[key] = time.time()
+            if len(self.touched) >= self.touch_every:
+                self._write_touches()
+            return row[0]
+
+    def put(self, key, response, model=None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO llm_cache (key, model, response, size, created_at, last_used) '
+                              'VALUES (?, ?, ?, ?, ?, ?)',
+                              (key, model, response, len(key) + len(response.encode('utf-8')), now, now))
+            self.puts_since_check += 1
+            if self.puts_since_check >= self.evict_every:
+                self._evict()
+
+    def _write_touches(self):
+        if self.touched:
+            self.conn.executemany('UPDATE llm_cache SET last_used = ? WHERE key = ?',
+                                  [(used, key) for key, used in self.touched.items()])
+            self.touched = {}
+
+    def _evict(self):
+        # Called with the lock held: drop the least recently used answers until the cache is back under 90% of max_bytes
+        self.puts_since_check = 0
+        self._write_touches()
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        to_free = total - int(self.max_bytes * 0.9)
+        keys = []
+        for key, size in self.conn.execute('SELECT key, size FROM llm_cache ORDER BY last_used'):
+            keys.append((key,))
+            to_free -= size
+            if to_free <= 0:
+                break
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany('DELETE FROM llm_cache WHERE key = ?', keys)
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.evicted += len(keys)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stored_bytes(self):
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self._write_touches()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __str__(self):
+        return (f"{self.hits} hits / {self.hits + self.misses} lookups ({100 * self.hit_rate():.1f}% hit rate), "
+                f"{self.evicted} evicted")
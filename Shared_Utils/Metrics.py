@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Dollars per million tokens: (prompt, cached prompt, completion). Dated snapshots (gpt-4o-2024-08-06) use
+# the price of their family; models missing here are counted in tokens but not in dollars
+PRICES = {
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4.1': (2.00, 0.50, 8.00),
+    'gpt-4.1-mini': (0.40, 0.10, 1.60),
+    'gpt-4-turbo': (10.00, 10.00, 30.00),
+    'gpt-4': (30.00, 30.00, 60.00),
+    'gpt-3.5-turbo': (0.50, 0.50, 1.50),
+}
+BATCH_DISCOUNT = 0.5  # the Batch API costs half the price of normal requests
+
+HELP = {
+    'api_request_seconds': 'Time of each API request (every attempt, retries included)',
+    'api_requests_total': 'API requests by endpoint and outcome (ok, or the error class or HTTP status)',
+    'api_retries_total': 'Requests sent again after an error',
+    'cache_hits_total': 'Answers found in a response cache',
+    'cache_misses_total': 'Lookups not found in a response cache',
+    'quota_units_total': 'YouTube Data API quota units spent',
+    'llm_tokens_total': 'Tokens reported by the chat completions API, by kind (prompt, completion, cached)',
+    'llm_cost_dollars_total': 'Estimated cost of the chat completions, from the PRICES table',
+}
+
+
+def model_price(model):
+    """(prompt, cached prompt, completion) price of model, or None when it is not in PRICES"""
+    if model in PRICES:
+        return PRICES[model]
+    family = max((name for name in PRICES if model and model.startswith(name + '-')), key=len, default=None)
+    return PRICES[family] if family else None
+
+
+def error_outcome(error):
+    """Outcome label of a failed request: the HTTP status when there is one, the exception name otherwise"""
+    status = getattr(error, 'status_code', None)
+    return str(status) if status is not None else type(error).__name__
+
+
+def usage_tokens(usage):
+    """(prompt, completion, cached) tokens of a usage object of the openai client or a usage dict of the raw API"""
+    if usage is None:
+        return 0, 0, 0
+    if isinstance(usage, dict):
+        details = usage.get('prompt_tokens_details') or {}
+        return usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0), details.get('cached_tokens', 0) or 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return (usage.prompt_tokens or 0, usage.completion_tokens or 0,
+            (getattr(details, 'cached_tokens', 0) or 0) if details is not None else 0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{str(value)}"' for name, value in labels) + '}'
+
+
+class Histogram:
+    """Request counts per latency bucket, with their sum, as in a Prometheus histogram"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is above every bound
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate of the q quantile, interpolated inside its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = self.buckets[index - 1] if index else 0.0
+                high = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Counters and latency histograms of one run, shared by every thread and task of the process.
+
+    Nothing is written unless a destination is given: log_path gets JSON lines (the events and, every
+    `interval` seconds, a snapshot of every metric), prom_path gets the Prometheus text format of the
+    metrics, rewritten every `interval` seconds, and port serves the same text over HTTP (/metrics).
+    """
+
+    def __init__(self, script=None, log_path=None, prom_path=None, port=None, interval=15.0):
+        self.script = script or os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+        self.log_path = log_path
+        self.prom_path = prom_path
+        self.port = port
+        self.interval = interval
+        self.started = time.time()
+        self.counters = {}       # (name, labels) -> value
+        self.histograms = {}     # (name, labels) -> Histogram
+        self.lock = threading.Lock()
+        self.log_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.httpd = None
+
+    @property
+    def enabled(self):
+        return bool(self.log_path or self.prom_path or self.port)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def request(self, endpoint, seconds, outcome='ok'):
+        """One API request (one attempt) to endpoint, e.g. commentThreads.list or chat.completions"""
+        self.observe('api_request_seconds', seconds, endpoint=endpoint)
+        self.inc('api_requests_total', endpoint=endpoint, outcome=outcome)
+
+    def retry(self, endpoint, outcome, delay):
+        self.inc('api_retries_total', endpoint=endpoint, outcome=outcome)
+        self.log('retry', endpoint=endpoint, outcome=outcome, delay=round(delay, 3))
+
+    def cache(self, cache, hit):
+        self.inc('cache_hits_total' if hit else 'cache_misses_total', cache=cache)
+
+    def completion(self, model, usage, batch=False):
+        """Tokens and estimated cost of one chat completion from its usage"""
+        prompt, completion, cached = usage_tokens(usage)
+        if not (prompt or completion):
+            return
+        self.inc('llm_tokens_total', prompt, model=model, kind='prompt')
+        self.inc('llm_tokens_total', completion, model=model, kind='completion')
+        self.inc('llm_tokens_total', cached, model=model, kind='cached')
+        price = model_price(model)
+        if price is not None:
+            prompt_price, cached_price, completion_price = price
+            cost = ((prompt - cached) * prompt_price + cached * cached_price + completion * completion_price) / 1e6
+            self.inc('llm_cost_dollars_total', cost * (BATCH_DISCOUNT if batch else 1), model=model)
+
+    def log(self, event, **fields):
+        """Write one JSON line to the log file (when there is one)"""
+        if not self.log_path:
+            return
+        line = json.dumps(dict({'time': round(time.time(), 3), 'script': self.script, 'event': event}, **fields))
+        with self.log_lock, open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    def snapshot(self):
+        """Every counter, and count/mean/p50/p99 (ms) of every latency histogram, as plain JSON values"""
+        with self.lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, []).append(dict(labels, value=round(value, 6)))
+            latency = {}
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                endpoint = dict(labels).get('endpoint', name)
+                latency[endpoint] = {'count': histogram.count,
+                                     'mean_ms': round(1000 * histogram.total / max(histogram.count, 1), 1),
+                                     'p50_ms': round(1000 * histogram.quantile(0.5), 1),
+                                     'p99_ms': round(1000 * histogram.quantile(0.99), 1)}
+        return {'uptime_s': round(time.time() - self.started, 1), 'counters': counters, 'latency': latency}
+
+    def prometheus_text(self):
+        script = (('script', self.script),)
+        lines = []
+        with self.lock:
+            names = sorted({name for name, _ in self.counters} | {name for name, _ in self.histograms})
+            for name in names:
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                series = sorted((labels, value) for (series_name, labels), value in self.counters.items()
+                                if series_name == name)
+                if series:
+                    lines.append(f"# TYPE {name} counter")
+                    lines.extend(f"{name}{format_labels(script + labels)} {value:g}" for labels, value in series)
+                    continue
+                lines.append(f"# TYPE {name} histogram")
+                for (series_name, labels), histogram in sorted(self.histograms.items()):
+                    if series_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(script + labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(script + labels)} {histogram.total:.6f}")
+                    lines.append(f"{name}_count{format_labels(script + labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Rewrite the Prometheus file and log a snapshot"""
+        if self.prom_path:
+            tmp_path = f"{self.prom_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, self.prom_path)
+        self.log('metrics', **self.snapshot())
+
+    def _serve(self):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                payload = metrics.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('0.0.0.0', self.port), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f"Could not write the metrics: {e}")
+
+    def start(self):
+        """Start the periodic writer (and the HTTP endpoint); the last write happens at exit"""
+        if not self.enabled or self.thread is not None:
+            return self
+        for path in (self.log_path, self.prom_path):
+            if path and os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.port:
+            try:
+                self._serve()
+            except OSError as e:
+                print(f"Could not serve the metrics on port {self.port}: {e}")
+        self.log('start', argv=sys.argv[1:], pid=os.getpid())
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+        return self
+
+    def close(self):
+        if self.thread is None or self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.write()
+        self.log('end', uptime_s=round(time.time() - self.started, 1))
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """The metrics of this process, configured from the environment the first time:
+    METRICS_LOG (JSON lines file), METRICS_FILE (Prometheus text file), METRICS_PORT (HTTP endpoint),
+    METRICS_INTERVAL (seconds between writes, 15 by default) and METRICS_SCRIPT (name in every line)"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            port = os.environ.get('METRICS_PORT')
+            _metrics = Metrics(script=os.environ.get('METRICS_SCRIPT'), log_path=os.environ.get('METRICS_LOG'),
+                               prom_path=os.environ.get('METRICS_FILE'), port=int(port) if port else None,
+                               interval=float(os.environ.get('METRICS_INTERVAL', 15))).start()
+        return _metrics
@@ -0,0 +1,343 @@
+import os
+import re
+import json
+import zlib
+import sqlite3
+import argparse
+from collections import Counter
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+MENTION = re.compile(r'@\S+')
+NON_WORD = re.compile(r'[\W_]+')
+
+CHUNK = 2000          # comments read, signed and written per batch
+SHINGLE_BLOCK = 8192  # shingles hashed per numpy product
+LOOKUP_BATCH = 500    # ids looked up per query (under SQLite's limit of bound parameters)
+MIN_LENGTH = 10       # normalized texts shorter than this (emoji-only "🔥🔥", "!!!", "lol") are never grouped
+
+
+def normalize(text: Optional[str]) -> str:
+    """Lower case without @mentions, emoji and punctuation: the variations copy-paste comments come with"""
+    return ' '.join(NON_WORD.sub(' ', MENTION.sub(' ', (text or '').lower())).split())
+
+
+def shingle_hashes(texts: List[str], k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+    """Hashes of the k-byte shingles of every text (the whole text, padded, when it is shorter), and the
+    number of shingles of each text, computed over all the texts at once"""
+    encoded = [text.encode('utf-8').ljust(k) for text in texts]
+    lengths = np.fromiter((len(text) for text in encoded), dtype=np.int64, count=len(encoded))
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8).astype(np.uint64)
+    rolling = np.zeros(len(data) - k + 1, dtype=np.uint64)
+    for offset in range(k):
+        rolling = rolling * np.uint64(257) + data[offset:len(data) - k + 1 + offset]
+    # Shingles that start in one text and end in the next are left out
+    counts = lengths - k + 1
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    return rolling[positions], counts
+
+
+class MinHasher:
+    """MinHash signatures of many texts at once: one (shingles x permutations) numpy product per chunk"""
+
+    def __init__(self, num_perm: int = 64, k: int = 5, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        # Multiply-shift hashing: the high 32 bits of a * hash + b (mod 2**64) with a random odd a
+        self.a = (rng.randint(0, 1 << 62, size=num_perm, dtype=np.int64).astype(np.uint64) << np.uint64(1)) | np.uint64(1)
+        self.b = rng.randint(0, 1 << 62, size=num_perm, dtype=np.int64).astype(np.uint64)
+        self.num_perm = num_perm
+        self.k = k
+
+    def signatures(self, texts: List[str]) -> np.ndarray:
+        """(len(texts), num_perm) uint32 signatures of already normalized texts"""
+        hashes, counts = shingle_hashes(texts, self.k)
+        ends = np.cumsum(counts)
+        signatures = np.empty((len(texts), self.num_perm), dtype=np.uint32)
+        first = 0
+        # Blocks of about SHINGLE_BLOCK shingles: the (permutations x shingles) product then stays in the CPU cache
+        while first < len(texts):
+            start = ends[first] - counts[first]
+            last = max(first + 1, int(np.searchsorted(ends, start + SHINGLE_BLOCK, side='right')))
+            block = hashes[start:ends[last - 1]]
+            permuted = np.multiply(self.a[:, None], block[None, :])
+            permuted += self.b[:, None]
+            permuted >>= np.uint64(32)
+            # Permutations as rows: reduceat over contiguous rows is an order of magnitude faster than over columns
+            offsets = ends[first:last] - counts[first:last] - start
+            signatures[first:last] = np.minimum.reduceat(permuted, offsets, axis=1).T
+            first = last
+        return signatures
+
+
+class NearDuplicateIndex:
+    """Streaming LSH index of cluster representatives.
+
+    Each comment is compared with the representatives sharing at least one LSH band with it. It joins
+    the most similar one when their estimated Jaccard similarity reaches `threshold` (a tight cluster),
+    and otherwise becomes the representative of a new cluster. Only representatives are kept in
+    memory: a signature and one bucket entry per band, whatever the number of duplicates.
+
+    Comments whose normalized text is shorter than min_length (emoji or punctuation only, a word or two)
+    say too little to be matched with others: each one is its own representative and is labelled alone.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, bands: int = 8, k: int = 5, seed: int = 1,
+                 min_length: int = MIN_LENGTH):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.min_length = min_length
+        self.short = 0                                  # comments left out of the clusters as too short
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm, k, seed)
+        self.buckets = [dict() for _ in range(bands)]   # band key -> cluster number
+        self.signatures = np.zeros((1024, num_perm), dtype=np.uint32)
+        self.representatives = []                       # cluster number -> CommentID
+        self.band_coefficients = np.random.RandomState(seed + 1).randint(
+            1, 1 << 62, size=self.rows, dtype=np.int64).astype(np.uint64)
+
+    def band_keys(self, signatures: np.ndarray, contexts: Optional[List[str]] = None) -> np.ndarray:
+        """(n, bands) uint64 keys; with contexts, only comments of the same context can share a key"""
+        shaped = signatures.astype(np.uint64).reshape(len(signatures), self.bands, self.rows)
+        keys = (shaped * self.band_coefficients).sum(axis=2) + np.arange(self.bands, dtype=np.uint64)
+        if contexts is not None:
+            salts = np.fromiter((zlib.crc32(context.encode('utf-8')) for context in contexts), dtype=np.uint64,
+                                count=len(contexts))
+            keys ^= (salts * np.uint64(0x9E3779B97F4A7C15))[:, None]
+        return keys
+
+    def add(self, comment_ids: List[str], texts: List[str],
+            contexts: Optional[List[str]] = None) -> List[Tuple[str, float]]:
+        """(representative CommentID, similarity) of every comment; new representatives get themselves and 1.0"""
+        normalized = [normalize(text) for text in texts]
+        signatures = self.hasher.signatures(normalized)
+        keys = self.band_keys(signatures, contexts).tolist()
+        assigned = []
+        for comment_id, text, signature, comment_keys in zip(comment_ids, normalized, signatures, keys):
+            if len(text) < self.min_length:
+                self.short += 1
+                assigned.append((comment_id, 1.0))
+                continue
+            candidates = {self.buckets[band].get(key) for band, key in enumerate(comment_keys)}
+            candidates.discard(None)
+            best, best_similarity = None, 0.0
+            if candidates:
+                numbers = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+                similarities = (self.signatures[numbers] == signature).mean(axis=1)
+                position = int(similarities.argmax())
+                best, best_similarity = int(numbers[position]), float(similarities[position])
+            if best is not None and best_similarity >= self.threshold:
+                assigned.append((self.representatives[best], round(best_similarity, 3)))
+                continue
+
+            number = len(self.representatives)
+            if number == len(self.signatures):
+                self.signatures = np.concatenate([self.signatures, np.zeros_like(self.signatures)])
+            self.signatures[number] = signature
+            self.representatives.append(comment_id)
+            for band, key in enumerate(comment_keys):
+                self.buckets[band].setdefault(key, number)
+            assigned.append((comment_id, 1.0))
+        return assigned
+
+    def __len__(self):
+        return len(self.representatives)
+
+
+class ClusterMap:
+    """CommentID -> (representative, similarity) of a reduce run, and the labels of the representatives"""
+
+    def __init__(self, db_path: str):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS members (
+                                 id TEXT PRIMARY KEY,
+                                 representative TEXT NOT NULL,
+                                 similarity REAL NOT NULL) WITHOUT ROWID''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS labels (
+                                 representative TEXT PRIMARY KEY,
+                                 record TEXT NOT NULL) WITHOUT ROWID''')
+
+    def reset(self) -> None:
+        self.conn.execute('DELETE FROM members')
+        self.conn.execute('DELETE FROM labels')
+
+    def write(self, table: str, rows: List[Tuple]) -> None:
+        placeholders = ', '.join('?' * len(rows[0]))
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany(f'INSERT OR REPLACE INTO {table} VALUES ({placeholders})', rows)
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def lookup(self, query: str, ids: Iterable[str]) -> Dict:
+        found = {}
+        ids = list(set(ids))
+        for start in range(0, len(ids), LOOKUP_BATCH):
+            chunk = ids[start:start + LOOKUP_BATCH]
+            rows = self.conn.execute(query.format(','.join('?' * len(chunk))), chunk)
+            found.update((row[0], row[1:]) for row in rows)
+        return found
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def jsonl_files(path: str) -> List[str]:
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.jsonl')]
+    return [path]
+
+
+def read_records(path: str) -> Iterator[Dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            # A last line cut by a crash of the writer is left out
+            if line.strip() and line.endswith('\n'):
+                yield json.loads(line)
+
+
+def output_file(input_path: str, input_root: str, output_root: str, rename: bool = False) -> str:
+    if not os.path.isdir(input_root):
+        return output_root
+    name = os.path.basename(input_path)
+    if rename:
+        # Same names as the stance outputs
+        name = name.replace('MAP_Precomments_', 'Label_')
+    return os.path.join(output_root, name)
+
+
+def reduce_comments(input_path: str, output_path: str, map_path: str, threshold: float = 0.8,
+                    with_parent: bool = False, num_perm: int = 64, bands: int = 8) -> Counter:
+    """Write only the representative of every near-duplicate cluster, in the same files and format"""
+    index = NearDuplicateIndex(threshold=threshold, num_perm=num_perm, bands=bands)
+    cluster_map = ClusterMap(map_path)
+    cluster_map.reset()
+    stats = Counter()
+    if os.path.isdir(input_path):
+        os.makedirs(output_path, exist_ok=True)
+    try:
+        for path in jsonl_files(input_path):
+            target = output_file(path, input_path, output_path)
+            records = read_records(path)
+            with open(target + '.tmp', 'w', encoding='utf-8') as out:
+                while True:
+                    chunk = list(islice(records, CHUNK))
+                    if not chunk:
+                        break
+                    contexts = [str(record.get('ParentCommentText', record.get('VideoID', '')))
+                                for record in chunk] if with_parent else None
+                    assigned = index.add([record['CommentID'] for record in chunk],
+                                         [record.get('CommentText') for record in chunk], contexts)
+                    cluster_map.write('members', [(record['CommentID'], representative, similarity)
+                                                  for record, (representative, similarity) in zip(chunk, assigned)])
+                    for record, (representative, _) in zip(chunk, assigned):
+                        stats['comments'] += 1
+                        if representative == record['CommentID']:
+                            out.write(json.dumps(record) + '\n')
+                            stats['representatives'] += 1
+            os.replace(target + '.tmp', target)
+    finally:
+        cluster_map.close()
+    stats['short'] = index.short
+    return stats
+
+
+def expand_labels(labelled_path: str, input_path: str, output_path: str, map_path: str) -> Counter:
+    """Give every comment of input_path the labels of its representative, with their provenance"""
+    cluster_map = ClusterMap(map_path)
+    stats = Counter()
+    if os.path.isdir(input_path):
+        os.makedirs(output_path, exist_ok=True)
+    try:
+        for path in jsonl_files(labelled_path):
+            records = read_records(path)
+            while True:
+                chunk = list(islice(records, CHUNK))
+                if not chunk:
+                    break
+                cluster_map.write('labels', [(record['CommentID'], json.dumps(record)) for record in chunk])
+
+        for path in jsonl_files(input_path):
+            target = output_file(path, input_path, output_path, rename=True)
+            records = read_records(path)
+            with open(target + '.tmp', 'w', encoding='utf-8') as out:
+                while True:
+                    chunk = list(islice(records, CHUNK))
+                    if not chunk:
+                        break
+                    members = cluster_map.lookup('SELECT id, representative, similarity FROM members '
+                                                 'WHERE id IN ({})', (record['CommentID'] for record in chunk))
+                    labels = cluster_map.lookup('SELECT representative, record FROM labels WHERE representative IN ({})',
+                                                (member[0] for member in members.values()))
+                    for record in chunk:
+                        stats['comments'] += 1
+                        representative, similarity = members.get(record['CommentID'], (None, None))
+                        if representative not in labels:
+                            stats['unlabelled'] += 1
+                            continue
+                        # The representative's output, with this comment's own fields where the output has them
+                        labelled = json.loads(labels[representative][0])
+                        result = {key: record.get(key, value) for key, value in labelled.items()}
+                        if representative != record['CommentID']:
+                            result.pop('cached_tokens', None)
+                            result.update(LabelSource='near_duplicate', RepresentativeID=representative,
+                                          DuplicateSimilarity=similarity)
+                            stats['propagated'] += 1
+                        else:
+                            result.update(LabelSource='labelled', RepresentativeID=representative,
+                                          DuplicateSimilarity=1.0)
+                        out.write(json.dumps(result) + '\n')
+            os.replace(target + '.tmp', target)
+    finally:
+        cluster_map.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Label one comment per near-duplicate cluster")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    reduce_parser = subparsers.add_parser('reduce', help="Keep one representative per cluster")
+    reduce_parser.add_argument('input', help="Comments file, or folder of .jsonl files (comments_*, MAP_Precomments_*)")
+    reduce_parser.add_argument('output', help="Representatives only: a file, or a folder with the same file names")
+    reduce_parser.add_argument('--map', required=True, help="Cluster map written for the expand step (SQLite)")
+    reduce_parser.add_argument('--threshold', type=float, default=0.8,
+                               help="Estimated Jaccard similarity of character 5-grams needed to join a cluster")
+    reduce_parser.add_argument('--with-parent', action='store_true',
+                               help="Only group comments with the same ParentCommentText (for stance inputs)")
+    reduce_parser.add_argument('--num-perm', type=int, default=64)
+    reduce_parser.add_argument('--bands', type=int, default=8)
+
+    expand_parser = subparsers.add_parser('expand', help="Copy the labels of the representatives to their clusters")
+    expand_parser.add_argument('labelled', help="Output of the labelling script on the representatives (file or folder)")
+    expand_parser.add_argument('input', help="The input given to reduce")
+    expand_parser.add_argument('output', help="Labels of every comment: a file, or a folder (Label_ names)")
+    expand_parser.add_argument('--map', required=True)
+    args = parser.parse_args()
+
+    if args.command == 'reduce':
+        stats = reduce_comments(args.input, args.output, args.map, args.threshold, args.with_parent,
+                                args.num_perm, args.bands)
+        saved = stats['comments'] - stats['representatives']
+        print(f"{stats['comments']} comments, {stats['representatives']} clusters: {saved} near-duplicates "
+              f"will get the label of their representative ({100 * saved / max(stats['comments'], 1):.1f}% of the "
+              f"API calls saved); {stats['short']} comments too short to compare (emoji or punctuation only, a "
+              f"word or two) are labelled on their own")
+    else:
+        stats = expand_labels(args.labelled, args.input, args.output, args.map)
+        print(f"{stats['comments']} comments: {stats['propagated']} labels propagated from a representative, "
+              f"{stats['unlabelled']} without a label (their representative has no result)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import re
+from collections import Counter
+from typing import Dict, Optional
+
+DEFAULT_RULES = {
+    'empty': True,                # nothing but whitespace
+    'emoji_only': True,           # emoji, symbols and punctuation only
+    'timestamp': True,            # video timestamps ("2:35", "1:02:10") with nothing else but emoji/punctuation
+    'link_only': True,            # links with nothing else but emoji/punctuation
+    'min_chars': 3,               # fewer letters/digits than this (after the above is removed) is too short; 0 = off
+    'non_english': True,          # mostly non-Latin script, or stopwords of another language and none of English
+    'min_latin_share': 0.5,       # share of the letters that must be Latin for the text to count as English
+    'min_words_for_language': 4,  # texts with fewer words are never called non-English by their stopwords
+}
+
+TIMESTAMP = re.compile(r'\b\d{1,2}:\d{2}(?::\d{2})?\b')
+URL = re.compile(r'https?://\S+|www\.\S+')
+WORD = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)?")
+
+# Frequent function words; words that are also common in English (a, in, is, no...) are left out of the others
+STOPWORDS = {
+    'en': set('the and is are to of that it you this for not with they be have on we was what but so just all '
+              'do my me he she them their our your if at or as by from will would can should there about who '
+              'why how when because been were has had than then out more an'.split()),
+    'de': set('der die das und ist nicht ich sie es ein eine zu mit auf den für sind auch wir was wie aber '
+              'noch nur dem des sich bei oder wenn schon kein keine'.split()),
+    'fr': set('le la les et est pas je vous il un une des du que qui pour ce sur avec sont mais nous ils '
+              'au aux cette ces leur très être'.split()),
+    'es': set('el los las y es que de un una por para con se lo su pero más como muy son está esto eso '
+              'hay del al ya'.split()),
+    'it': set('il è che di non un una per con sono ma come della anche più questo questa gli dei nel sul '
+              'molto'.split()),
+    'pt': set('os é que de não um uma para com mas como por está são isso muito uma também mais nós'.split()),
+    'nl': set('het en een niet van dat ik je op te zijn met voor maar ook wat er dit die wel nog geen'.split()),
+}
+
+
+def is_latin(char: str) -> bool:
+    # Basic Latin, Latin-1 and the Latin Extended blocks
+    return ord(char) < 0x250 or 0x1E00 <= ord(char) <= 0x1EFF
+
+
+def guess_language(text: str) -> Optional[str]:
+    """The language whose stopwords appear most in text, or None when no stopword is found"""
+    words = [word.lower() for word in WORD.findall(text)]
+    hits = {language: sum(word in stopwords for word in words) for language, stopwords in STOPWORDS.items()}
+    best = max(hits, key=lambda language: (hits[language], language == 'en'))
+    return best if hits[best] else None
+
+
+class Prefilter:
+    """Rule-based check that labels trivially neutral comments locally, before any API call.
+
+    reason() gives why a comment needs no API call ('empty', 'emoji_only', 'timestamp', 'link_only',
+    'too_short', 'non_english') or None; check() does the same and counts the comments skipped per reason.
+    """
+
+    def __init__(self, rules: Optional[Dict] = None):
+        unknown = set(rules or {}) - set(DEFAULT_RULES)
+        if unknown:
+            raise ValueError(f"Unknown prefilter rules: {', '.join(sorted(unknown))}")
+        self.rules = {**DEFAULT_RULES, **(rules or {})}
+        self.counts = Counter()
+        self.checked = 0
+
+    def reason(self, text: Optional[str]) -> Optional[str]:
+        rules = self.rules
+        text = text or ''
+        if not text.strip():
+            return 'empty' if rules['empty'] else None
+
+        without_timestamps = TIMESTAMP.sub(' ', URL.sub(' ', text))
+        residual = ''.join(char for char in without_timestamps if char.isalnum())
+        if not residual:
+            if TIMESTAMP.search(text):
+                return 'timestamp' if rules['timestamp'] else None
+            if URL.search(text):
+                return 'link_only' if rules['link_only'] else None
+            return 'emoji_only' if rules['emoji_only'] else None
+        if rules['min_chars'] and len(residual) < rules['min_chars']:
+            return 'too_short'
+
+        if rules['non_english']:
+            letters = [char for char in residual if char.isalpha()]
+            if letters and sum(map(is_latin, letters)) / len(letters) < rules['min_latin_share']:
+                return 'non_english'
+            if len(WORD.findall(without_timestamps)) >= rules['min_words_for_language']:
+                language = guess_language(without_timestamps)
+                if language is not None and language != 'en':
+                    return 'non_english'
+        return None
+
+    def check(self, text: Optional[str]) -> Optional[str]:
+        reason = self.reason(text)
+        self.checked += 1
+        if reason is not None:
+            self.counts[reason] += 1
+        return reason
+
+    @property
+    def saved(self) -> int:
+        return sum(self.counts.values())
+
+    def __str__(self):
+        share = 100 * self.saved / self.checked if self.checked else 0.0
+        reasons = ', '.join(f"{reason} {count}" for reason, count in self.counts.most_common())
+        return (f"{self.saved} of {self.checked} comments labelled locally ({share:.1f}%)"
+                + (f": {reasons}" if reasons else ''))
@@ -0,0 +1,124 @@
+import os
+import json
+import random
+import hashlib
+import argparse
+from collections import Counter, defaultdict
+
+import yaml
+
+from Prefilter import Prefilter
+
+
+def read_labelled(paths):
+    """Labelled comments from output files of the labelling scripts (files or folders of .jsonl files)"""
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.jsonl')]
+        for file_path in files:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+def llm_neutral(item):
+    """Whether the LLM label is the one the prefilter gives (no technique / stance 1), None when unlabelled"""
+    if 'Techniques' in item:
+        return item['Techniques'] == []
+    if 'Stance_Labels' in item:
+        labels = list(item['Stance_Labels'].values())
+        return None if any(label is None for label in labels) else all(label == 1 for label in labels)
+    if item.get('Stance_Label') is not None:
+        return item['Stance_Label'] == 1
+    return None
+
+
+def in_holdout(comment_id, share):
+    # Fixed split on the CommentID hash: the same comments stay held out whatever the files or their order
+    return int(hashlib.sha256(str(comment_id).encode('utf-8')).hexdigest()[:8], 16) / 2 ** 32 < share
+
+
+def evaluate(items, prefilter, n_examples=5):
+    stats = Counter()
+    per_reason = defaultdict(Counter)
+    examples = defaultdict(list)
+    for item in items:
+        # Labels given by the prefilter itself would always agree with it
+        if 'Prefilter' in item:
+            stats['prefiltered'] += 1
+            continue
+        neutral = llm_neutral(item)
+        if neutral is None:
+            continue
+        stats['comments'] += 1
+        stats['llm_neutral'] += neutral
+        reason = prefilter.reason(item.get('CommentText'))
+        if reason is None:
+            continue
+        stats['filtered'] += 1
+        stats['agree'] += neutral
+        per_reason[reason]['filtered'] += 1
+        per_reason[reason]['agree'] += neutral
+        if not neutral and len(examples[reason]) < n_examples:
+            examples[reason].append(item)
+    return stats, per_reason, examples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agreement of the prefilter with LLM labels on held-out comments")
+    parser.add_argument('paths', nargs='+', help="Output files (or folders) of Divisive_Rhetoric.py or Stance_Engine.py")
+    parser.add_argument('--rules', default=None, help="YAML file overriding the prefilter rules")
+    parser.add_argument('--min-chars', type=int, default=None, help="Shortcut for the min_chars rule (2 for stance)")
+    parser.add_argument('--holdout-share', type=float, default=0.2, help="Share of the comments held out")
+    parser.add_argument('--split', choices=['holdout', 'tune', 'all'], default='holdout',
+                        help="Evaluate on the held-out comments (default), on the others (to tune rules) or on all")
+    parser.add_argument('--sample', type=int, default=None, help="Evaluate a random sample of this size")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--examples', type=int, default=5, help="Disagreements printed per rule")
+    args = parser.parse_args()
+
+    rules = {}
+    if args.rules:
+        with open(args.rules, 'r') as f:
+            rules.update(yaml.safe_load(f) or {})
+    if args.min_chars is not None:
+        rules['min_chars'] = args.min_chars
+    prefilter = Prefilter(rules)
+
+    items = read_labelled(args.paths)
+    if args.split != 'all':
+        keep_holdout = args.split == 'holdout'
+        items = (item for item in items if in_holdout(item.get('CommentID'), args.holdout_share) == keep_holdout)
+    if args.sample:
+        items = list(items)
+        items = random.Random(args.seed).sample(items, min(args.sample, len(items)))
+
+    stats, per_reason, examples = evaluate(items, prefilter, args.examples)
+    if stats['prefiltered']:
+        print(f"{stats['prefiltered']} comments labelled by the prefilter, not by the LLM, are left out; for numbers "
+              f"that cover them, evaluate the output of a run made without the prefilter")
+    if not stats['comments']:
+        print("No labelled comments found")
+        return
+
+    comments, filtered = stats['comments'], stats['filtered']
+    print(f"{comments} labelled comments ({args.split} split), {100 * stats['llm_neutral'] / comments:.1f}% "
+          f"neutral according to the LLM")
+    print(f"Prefilter: {filtered} labelled locally ({100 * filtered / comments:.1f}% of the API calls saved), "
+          f"agreement with the LLM {100 * stats['agree'] / max(filtered, 1):.1f}%, "
+          f"{100 * stats['agree'] / max(stats['llm_neutral'], 1):.1f}% of the neutral comments caught")
+    print(f"{'rule':<12} {'comments':>9} {'agreement':>10}")
+    for reason, counts in sorted(per_reason.items(), key=lambda entry: -entry[1]['filtered']):
+        print(f"{reason:<12} {counts['filtered']:>9} {100 * counts['agree'] / counts['filtered']:>9.1f}%")
+
+    for reason, items in examples.items():
+        print(f"\nLabelled neutral by '{reason}' but not by the LLM:")
+        for item in items:
+            label = item.get('Techniques', item.get('Stance_Labels', item.get('Stance_Label')))
+            print(f"  {item.get('CommentID')}: {item.get('CommentText')!r} -> {label}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,531 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import yaml
+from collections import Counter
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from openai import AsyncOpenAI
+from tqdm import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Shared_Utils'))
+from LLM_Cache import LLMCache, DEFAULT_CACHE_PATH, cache_key
+from Inference_Engine import RateLimiter, estimate_tokens, run_ordered
+from Prefilter import Prefilter
+from Metrics import get_metrics, error_outcome
+from Comment_Store import is_store, scan_comments
+from Batch_Jobs import (batch_request, batch_parts, completion_text, read_batch_results, results_path_for,
+                        write_batch_files)
+
+STANCE_DIR = os.path.dirname(os.path.abspath(__file__))
+# One <topic>.txt system prompt per topic; a new topic only needs a new file
+PROMPTS_DIR = os.path.join(STANCE_DIR, 'Topic_Prompts')
+# Wording of the combined requests (all topics in one request): header.txt, then the topics, then footer.txt
+COMBINED_PROMPT_DIR = os.path.join(STANCE_DIR, 'Combined_Prompt')
+# Model and decoding settings: what changes the answers is kept out of the code, as the prompts are
+MODEL_SETTINGS_PATH = os.path.join(STANCE_DIR, 'model.yaml')
+
+with open(MODEL_SETTINGS_PATH, 'r') as settings_file:
+    MODEL_SETTINGS = yaml.safe_load(settings_file)
+MODEL = MODEL_SETTINGS['model_name']
+MAX_TOKENS = MODEL_SETTINGS['max_tokens']
+TEMPERATURE = MODEL_SETTINGS['temperature']
+
+# Requests sent at the same time, and client-side limits (None = no limit) to set to the account's rate limits
+MAX_IN_FLIGHT = 16
+MAX_RETRIES = 5
+RETRY_DELAY = 1  # seconds before the first retry, doubled (with jitter) at every attempt
+
+# Label given locally to the comments the prefilter skips, and its rules for stance: a two-letter reply
+# ("no", "ok") can still agree or disagree with its parent, so only single characters are too short
+NEUTRAL = 1
+PREFILTER_RULES = {'min_chars': 2}
+
+
+def available_topics(prompts_dir: str = PROMPTS_DIR) -> List[str]:
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(prompts_dir) if name.endswith('.txt'))
+
+
+def load_topic_prompts(topics: List[str], prompts_dir: str = PROMPTS_DIR) -> Dict[str, str]:
+    """{topic: system prompt}, read from the prompt files"""
+    prompts = {}
+    for topic in topics:
+        path = os.path.join(prompts_dir, f"{topic}.txt")
+        if not os.path.exists(path):
+            raise ValueError(f"No prompt for topic '{topic}' (available: {', '.join(available_topics(prompts_dir))})")
+        # newline='' keeps the prompt byte for byte, so the response cache keys do not change
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            prompts[topic] = f.read()
+    return prompts
+
+
+def load_combined_wording(name: str) -> str:
+    # newline='' keeps the text byte for byte, so the response cache keys do not change
+    with open(os.path.join(COMBINED_PROMPT_DIR, f"{name}.txt"), 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+def combined_prompt(prompts: Dict[str, str]) -> str:
+    """One system prompt asking for the stance towards every topic, answered as a JSON object"""
+    example = json.dumps({topic: index % 3 for index, topic in enumerate(prompts)})
+    sections = [f"Topic: {topic}\n{prompt.strip()}\n" for topic, prompt in prompts.items()]
+    return (load_combined_wording('header').strip() + '\n\n' + '\n'.join(sections) + '\n'
+            + load_combined_wording('footer').format(example=example))
+
+
+def parse_combined_output(output: Optional[str], topics: List[str]) -> Dict[str, int]:
+    """The stances found in a combined answer; topics missing or not 0-2 are left out (and asked on their own)"""
+    if not output:
+        return {}
+    # Models sometimes wrap the object in a code block or add a sentence around it
+    match = re.search(r'\{.*\}', output, re.DOTALL)
+    try:
+        answer = json.loads(match.group(0)) if match else {}
+    except ValueError:
+        return {}
+    if not isinstance(answer, dict):
+        return {}
+    stances = {}
+    for topic in topics:
+        value = answer.get(topic)
+        if isinstance(value, str) and value.strip().isdigit():
+            value = int(value.strip())
+        if isinstance(value, int) and not isinstance(value, bool) and value in (0, 1, 2):
+            stances[topic] = value
+    return stances
+
+
+def user_content(item: Dict) -> str:
+    parent_comment = item.get('ParentCommentText', item.get('VideoID'))
+    response_comment = item['CommentText']
+    return f"Parent Comment: {parent_comment}\nComment: {response_comment}"
+
+
+def output_name(filename: str) -> str:
+    # Create output filename by replacing MAP_Precomments with Label_
+    return filename.replace('MAP_Precomments_', 'Label_')
+
+
+def input_files(input_dir: str) -> List[str]:
+    return sorted(filename for filename in os.listdir(input_dir) if filename.endswith('.jsonl'))
+
+
+def input_groups(input_dir: str, where: Optional[List[str]] = None) -> Iterator[Tuple[str, str, Iterable[Dict]]]:
+    """(name, output filename, comments) of every input file, or of every video of a comment store.
+
+    A comment store (Shared_Utils/Comment_Store.py) gives the same Label_{video_id}.jsonl outputs as the
+    MAP_Precomments files it was compacted from; where selects partitions and rows (e.g. Period=P1).
+    """
+    if is_store(input_dir):
+        # Rows of a video are next to each other in the store
+        for video_id, items in groupby(scan_comments(input_dir, where=where), key=itemgetter('VideoID')):
+            yield f"video {video_id}", f"Label_{video_id}.jsonl", items
+        return
+    for filename in input_files(input_dir):
+        with open(os.path.join(input_dir, filename), 'r') as file:
+            yield filename, output_name(filename), (json.loads(line) for line in file)
+
+
+def format_stats(run_stats: Counter) -> str:
+    seconds = max(run_stats['seconds'], 1e-9)
+    prompt_cache = run_stats['cached_tokens'] / run_stats['prompt_tokens'] if run_stats['prompt_tokens'] else 0.0
+    return (f"{run_stats['comments']} comments in {run_stats['seconds']:.1f}s "
+            f"({run_stats['comments'] / seconds:.1f} comments/sec): {run_stats['requests']} requests, "
+            f"{run_stats['cache_hits'] + run_stats['shared']} answered from the response cache or an identical pair, "
+            f"{run_stats['prefiltered']} labelled locally by the prefilter, "
+            f"{run_stats['retries']} retries, {run_stats['failed']} failed; "
+            f"prompt cache: {run_stats['cached_tokens']}/{run_stats['prompt_tokens']} prompt tokens "
+            f"({100 * prompt_cache:.1f}%)")
+
+
+class StanceEngine:
+    """Stance labelling of comment pairs towards one or more topics.
+
+    With one topic the output keeps the Stance_Label field of the original scripts. With several topics
+    every input file is still read and written once, and the labels go to Stance_Labels ({topic: label}).
+    By default each topic is asked in its own request; with combined=True one request asks for every
+    topic at once and answers with a JSON object. Topics missing from that answer are asked on their own.
+    """
+
+    def __init__(self, topics: List[str], prompts_dir: str = PROMPTS_DIR, combined: bool = False,
+                 workers: int = MAX_IN_FLIGHT, requests_per_minute: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None, cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+                 model: str = MODEL, prefilter: Optional[Prefilter] = None):
+        self.topics = list(topics)
+        self.prompts = load_topic_prompts(self.topics, prompts_dir)
+        self.combined = combined and len(self.topics) > 1
+        self.combined_prompt = combined_prompt(self.prompts) if self.combined else None
+        self.combined_max_tokens = MAX_TOKENS + MODEL_SETTINGS['combined_tokens_per_topic'] * len(self.topics)
+        self.workers = workers
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.model = model
+        # Answers already paid for (by this engine or the rhetoric script) are reused from the shared cache
+        self.cache = LLMCache(cache_path) if cache_path else None
+        # Requests, retries, failures and prompt-cache tokens of the whole run
+        self.stats = Counter()
+        # Comments labelled NEUTRAL for every topic without an API call (emoji only, timestamps, non-English...)
+        self.prefilter = prefilter
+
+    def key(self, system_prompt: str, content: str, max_tokens: int = MAX_TOKENS) -> str:
+        return cache_key(self.model, system_prompt, content, max_tokens=max_tokens, temperature=TEMPERATURE)
+
+    def cache_get(self, key: str) -> Optional[str]:
+        return self.cache.get(key) if self.cache is not None else None
+
+    def cache_put(self, key: str, content: str) -> None:
+        if self.cache is not None:
+            self.cache.put(key, content, model=self.model)
+
+    def prefilter_reason(self, item: Dict) -> Optional[str]:
+        """Rule of the prefilter that labels the comment locally, or None when it goes to the API"""
+        return self.prefilter.check(item.get('CommentText')) if self.prefilter is not None else None
+
+    def requests_per_comment(self) -> int:
+        return 1 if self.combined else len(self.topics)
+
+    def set_labels(self, item: Dict, labels: Dict[str, Optional[int]]) -> None:
+        if len(self.topics) == 1:
+            item['Stance_Label'] = labels.get(self.topics[0])
+        else:
+            item['Stance_Labels'] = {topic: labels.get(topic) for topic in self.topics}
+
+    def label_comments(self, data: List[Dict]) -> List[Dict]:
+        """Label every comment pair, `workers` requests at a time; the output keeps the input order"""
+        return asyncio.run(self.label_comments_async(data))
+
+    async def label_comments_async(self, data: List[Dict]) -> List[Dict]:
+        # One client per run: the async HTTP connections belong to the event loop of this run
+        client = AsyncOpenAI(api_key=os.environ.get("ADD_API_KEY"), max_retries=0)
+        rate_limiter = RateLimiter(self.requests_per_minute, self.tokens_per_minute)
+        metrics = get_metrics()
+        in_flight = {}
+        start = time.perf_counter()
+        run_stats = Counter()
+
+        async def request(messages, max_tokens):
+            """One chat completion, retried with exponential backoff; None when every attempt failed"""
+            reserved = sum(estimate_tokens(message["content"]) for message in messages) + max_tokens
+            for attempt in range(MAX_RETRIES):
+                sent = None
+                try:
+                    await rate_limiter.acquire(reserved)
+                    sent = time.perf_counter()
+                    response = await client.chat.completions.create(
+                        messages=messages,
+                        model=self.model,
+                        max_tokens=max_tokens,
+                        temperature=TEMPERATURE
+                    )
+                    metrics.request('chat.completions', time.perf_counter() - sent)
+                    metrics.completion(self.model, response.usage)
+                    run_stats['requests'] += 1
+                    if response.usage is not None:
+                        rate_limiter.settle(reserved, response.usage.total_tokens)
+                    return response
+                except Exception as e:
+                    if sent is not None:
+                        metrics.request('chat.completions', time.perf_counter() - sent, error_outcome(e))
+                    if attempt == MAX_RETRIES - 1:
+                        print(f"Request failed after {MAX_RETRIES} attempts: {e}")
+                        metrics.log('request_failed', endpoint='chat.completions', error=str(e)[:200])
+                        return None
+                    run_stats['retries'] += 1
+                    delay = random.uniform(0, min(60, RETRY_DELAY * 2 ** attempt))
+                    metrics.retry('chat.completions', error_outcome(e), delay)
+                    print(f"Attempt {attempt + 1} failed with error: {e}, retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+
+        async def answer(system_prompt, content, max_tokens=MAX_TOKENS):
+            """(answer, response) for one prompt; response is None when the answer came from the cache"""
+            key = self.key(system_prompt, content, max_tokens)
+            cached = self.cache_get(key)
+            if cached is not None:
+                run_stats['cache_hits'] += 1
+                return cached, None
+            # An identical pair already waiting for its answer is not sent a second time
+            if key in in_flight:
+                run_stats['shared'] += 1
+                shared, _ = await asyncio.shield(in_flight[key])
+                return shared, None
+
+            future = asyncio.get_running_loop().create_future()
+            in_flight[key] = future
+            output, response = None, None
+            try:
+                response = await request([
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": content}
+                ], max_tokens)
+                if response is not None and response.choices:
+                    output = response.choices[0].message.content
+                if output is not None:
+                    self.cache_put(key, output)
+            finally:
+                del in_flight[key]
+                future.set_result((output, response))
+            return output, response
+
+        def record_usage(item, response):
+            usage = getattr(response, 'usage', None)
+            if usage is not None and getattr(usage, 'prompt_tokens_details', None) is not None:
+                cached_tokens = usage.prompt_tokens_details.cached_tokens or 0
+                item['cached_tokens'] = item.get('cached_tokens', 0) + cached_tokens
+                run_stats['prompt_tokens'] += usage.prompt_tokens
+                run_stats['cached_tokens'] += cached_tokens
+
+        async def label_topic(item, topic, content):
+            output, response = await answer(self.prompts[topic], content)
+            record_usage(item, response)
+            try:
+                return int(output.strip())
+            except (ValueError, AttributeError):
+                print(f"Unexpected answer for comment {item.get('CommentID', 'unknown')} ({topic}): {output!r}")
+                return None
+
+        async def label_item(item):
+            # A failure only affects its own item
+            item = item.copy()
+            labels = {}
+            reason = self.prefilter_reason(item)
+            if reason is not None:
+                run_stats['prefiltered'] += 1
+                self.set_labels(item, {topic: NEUTRAL for topic in self.topics})
+                # Marked, so these labels are not taken for the model's (e.g. by Prefilter_Eval.py)
+                item['Prefilter'] = reason
+                return item
+            try:
+                content = user_content(item)
+                if self.combined:
+                    output, response = await answer(self.combined_prompt, content, self.combined_max_tokens)
+                    record_usage(item, response)
+                    labels = parse_combined_output(output, self.topics)
+                    if len(labels) < len(self.topics):
+                        run_stats['combined_fallbacks'] += 1
+                missing = [topic for topic in self.topics if topic not in labels]
+                results = await asyncio.gather(*(label_topic(item, topic, content) for topic in missing))
+                labels.update(zip(missing, results))
+            except Exception as e:
+                print(f"Error processing comment {item.get('CommentID', 'unknown')}: {e}")
+            if any(labels.get(topic) is None for topic in self.topics):
+                run_stats['failed'] += 1
+            self.set_labels(item, labels)
+            return item
+
+        labeled_data = []
+        try:
+            with tqdm(total=len(data), desc="Labelling comments") as progress:
+                async for _, item in run_ordered(data, label_item, max_in_flight=self.workers):
+                    labeled_data.append(item)
+                    progress.update(1)
+        finally:
+            await client.close()
+
+        run_stats['comments'] += len(labeled_data)
+        run_stats['seconds'] += time.perf_counter() - start
+        self.stats.update(run_stats)
+        print(f"{format_stats(run_stats)} with {self.workers} workers")
+        return labeled_data
+
+    def process_file(self, input_file: str, output_file: str) -> None:
+        with open(input_file, 'r') as file:
+            data = [json.loads(line) for line in file]
+
+        labeled_data = self.label_comments(data)
+        save_labels(labeled_data, output_file)
+
+    def process_dir(self, input_dir: str, output_dir: str, where: Optional[List[str]] = None) -> None:
+        os.makedirs(output_dir, exist_ok=True)
+        written = set()
+        for name, output_filename, items in input_groups(input_dir, where):
+            print(f"Processing {name}...")
+            labeled_data = self.label_comments(list(items))
+            # A video stored under two partitions is appended to the same output
+            save_labels(labeled_data, os.path.join(output_dir, output_filename), append=output_filename in written)
+            written.add(output_filename)
+            print(f"Completed processing {name}")
+        print(f"Total: {format_stats(self.stats)}")
+        if self.prefilter is not None:
+            print(f"Prefilter: {self.prefilter}, {self.prefilter.saved * self.requests_per_comment()} API calls saved")
+
+    def batch_prompts(self) -> List[Tuple[str, str, int]]:
+        """(custom_id suffix, system prompt, max_tokens) of the requests sent for each comment"""
+        if self.combined:
+            return [('all', self.combined_prompt, self.combined_max_tokens)]
+        return [(topic, self.prompts[topic], MAX_TOKENS) for topic in self.topics]
+
+    def build_batch(self, input_dir: str, batch_path: str, where: Optional[List[str]] = None) -> None:
+        """Write the comments of input_dir as a Batch API request file (custom_id = CommentID/topic)"""
+        seen_keys = set()
+        counts = Counter()
+
+        def requests():
+            for _, _, items in input_groups(input_dir, where):
+                for item in items:
+                    if self.prefilter_reason(item) is not None:
+                        counts['prefilter'] += 1
+                        continue
+                    content = user_content(item)
+                    for suffix, system_prompt, max_tokens in self.batch_prompts():
+                        key = self.key(system_prompt, content, max_tokens)
+                        # Pairs already answered, or requested for an identical pair, are filled in at merge time
+                        if key in seen_keys or self.cache_get(key) is not None:
+                            counts['cached'] += 1
+                            continue
+                        seen_keys.add(key)
+                        counts['requests'] += 1
+                        yield batch_request(f"{item['CommentID']}/{suffix}", {
+                            "messages": [
+                                {"role": "system", "content": system_prompt},
+                                {"role": "user", "content": content}
+                            ],
+                            "model": self.model,
+                            "max_tokens": max_tokens,
+                            "temperature": TEMPERATURE
+                        })
+
+        os.makedirs(os.path.dirname(batch_path) or '.', exist_ok=True)
+        parts = write_batch_files(requests(), batch_path)
+        if not parts:
+            print("Nothing to submit: every comment is already cached, run --batch merge")
+            return
+        print(f"{counts['requests']} requests written to {', '.join(parts)} "
+              f"({counts['cached']} answered from the cache or by an identical comment, "
+              f"{counts['prefilter']} comments labelled locally by the prefilter)")
+        print(f"Next: python ../Shared_Utils/Batch_Jobs.py {batch_path}, then the same command with --batch merge")
+
+    def merge_batch(self, input_dir: str, output_dir: str, batch_path: str, where: Optional[List[str]] = None) -> None:
+        """Label the files of input_dir from the batch results, in the same output format as a normal run"""
+        results_paths = [results_path_for(path) for path in batch_parts(batch_path)]
+        responses = dict(read_batch_results(results_paths))
+        missing = 0
+        # Identical pairs were requested once: the others get the answer of the first one (or of the cache)
+        by_key = {}
+
+        def batch_answer(item, suffix, system_prompt, content, max_tokens):
+            body = responses.get(f"{item['CommentID']}/{suffix}")
+            output = completion_text(body)
+            key = self.key(system_prompt, content, max_tokens)
+            if output is not None:
+                by_key[key] = output
+                self.cache_put(key, output)
+                usage = (body or {}).get('usage') or {}
+                get_metrics().completion(self.model, usage, batch=True)
+                if usage.get('prompt_tokens_details') is not None:
+                    cached_tokens = usage['prompt_tokens_details'].get('cached_tokens', 0)
+                    item['cached_tokens'] = item.get('cached_tokens', 0) + cached_tokens
+                return output
+            return by_key[key] if key in by_key else self.cache_get(key)
+
+        os.makedirs(output_dir, exist_ok=True)
+        written = set()
+        for name, output_filename, items in input_groups(input_dir, where):
+            labeled_data = []
+            for item in items:
+                content = user_content(item)
+                labels = {}
+                reason = self.prefilter_reason(item)
+                if reason is not None:
+                    labels = {topic: NEUTRAL for topic in self.topics}
+                    item['Prefilter'] = reason
+                elif self.combined:
+                    output = batch_answer(item, 'all', self.combined_prompt, content, self.combined_max_tokens)
+                    labels = parse_combined_output(output, self.topics)
+                for topic in self.topics:
+                    if topic in labels:
+                        continue
+                    # Topics left out of a combined answer can only come from the cache here
+                    output = batch_answer(item, topic, self.prompts[topic], content, MAX_TOKENS)
+                    try:
+                        labels[topic] = int(output.strip())
+                    except (ValueError, AttributeError):
+                        labels[topic] = None
+                if any(label is None for label in labels.values()):
+                    missing += 1
+                self.set_labels(item, labels)
+                labeled_data.append(item)
+
+            save_labels(labeled_data, os.path.join(output_dir, output_filename), append=output_filename in written)
+            written.add(output_filename)
+            print(f"Merged batch results for {name}")
+
+        if missing:
+            print(f"{missing} comments have no usable answer in the batch results (their label is None); "
+                  f"run without --batch to label them")
+
+    def close(self) -> None:
+        if self.cache is not None:
+            print(f"Response cache: {self.cache}")
+            self.cache.close()
+
+
+def save_labels(labeled_data: List[Dict], output_file: str, append: bool = False) -> None:
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, 'a' if append else 'w') as file:
+        for entry in labeled_data:
+            file.write(json.dumps(entry) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stance of comment pairs towards one or more topics")
+    parser.add_argument('-t', '--topics', nargs='+', required=True,
+                        help=f"Topics to label (prompt files in {PROMPTS_DIR}: {', '.join(available_topics())})")
+    parser.add_argument('-i', '--input-dir', required=True,
+                        help="Folder of MAP_Precomments_*.jsonl files, or a comment store compacted from them")
+    parser.add_argument('--where', nargs='+', default=None,
+                        help="Comment store only: partitions and rows to label, e.g. Source=BBC Period=P1,P2")
+    parser.add_argument('-o', '--output-dir', required=True, help="Folder for the Label_*.jsonl files")
+    parser.add_argument('--combined', action='store_true',
+                        help="Ask for every topic in one request per comment instead of one request per topic")
+    parser.add_argument('--workers', type=int, default=MAX_IN_FLIGHT, help="Requests sent to the API at the same time")
+    parser.add_argument('--requests-per-minute', type=int, default=None)
+    parser.add_argument('--tokens-per-minute', type=int, default=None)
+    parser.add_argument('--prompts-dir', default=PROMPTS_DIR)
+    parser.add_argument('--batch', choices=['build', 'merge'], default=None,
+                        help="Write a Batch API request file, or merge its results, instead of calling the API")
+    parser.add_argument('--batch-path', default=None, help="Batch request file (default: in the output folder)")
+    parser.add_argument('--prefilter', action='store_true',
+                        help="Label emoji-only, timestamp, one-character and non-English comments 1 without an API call")
+    parser.add_argument('--prefilter-rules', default=None, help="YAML file overriding rules of Shared_Utils/Prefilter.py")
+    args = parser.parse_args(argv)
+
+    try:
+        prefilter = None
+        if args.prefilter:
+            rules = dict(PREFILTER_RULES)
+            if args.prefilter_rules:
+                with open(args.prefilter_rules, 'r') as f:
+                    rules.update(yaml.safe_load(f) or {})
+            prefilter = Prefilter(rules)
+        engine = StanceEngine(args.topics, prompts_dir=args.prompts_dir, combined=args.combined,
+                              workers=args.workers, requests_per_minute=args.requests_per_minute,
+                              tokens_per_minute=args.tokens_per_minute, prefilter=prefilter)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    batch_path = args.batch_path or os.path.join(args.output_dir, 'stance_batch.jsonl')
+    try:
+        if args.batch == 'build':
+            engine.build_batch(args.input_dir, batch_path, args.where)
+        elif args.batch == 'merge':
+            engine.merge_batch(args.input_dir, args.output_dir, batch_path, args.where)
+        else:
+            engine.process_dir(args.input_dir, args.output_dir, args.where)
+    except (ValueError, ImportError) as e:
+        # A --where that cannot be read, or a comment store without pyarrow installed
+        print(e)
+        sys.exit(1)
+    finally:
+        engine.close()
+
+
+if __name__ == "__main__":
+    main()